@@ -1,4 +1,6 @@
 from django.contrib import admin
-from .models import Appointment
+from .models import Appointment, Resource, WaitlistEntry
 
-admin.site.register(Appointment)
\ No newline at end of file
+admin.site.register(Appointment)
+admin.site.register(WaitlistEntry)
+admin.site.register(Resource)
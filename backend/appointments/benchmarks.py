@@ -0,0 +1,244 @@
+"""
+Query-plan and latency benchmarks for the appointment hot paths.
+
+Used by the ``benchmark_appointments`` management command. The synthetic
+dataset is generated inside a transaction that the command rolls back, so it
+can be pointed at a copy of a real database without leaving rows behind.
+"""
+
+import re
+import statistics
+import time as clock
+from datetime import date, datetime, time, timedelta
+
+from django.db import connection
+from django.db.models import Count, Q
+from django.test.utils import CaptureQueriesContext
+
+from core.db import is_postgres
+from doctors.models import Doctor, Specialization
+from patients.models import Patient
+from users.models import User
+
+from .models import Appointment
+
+SEQ_SCAN_PATTERNS = [
+    re.compile(r"Seq Scan on appointments_appointment\b"),
+    re.compile(r"\bSCAN appointments_appointment\b(?! USING)"),
+]
+
+
+def generate_dataset(appointments=100_000, doctors=50, patients=5_000, days=730):
+    """
+    Bulk insert a synthetic, conflict-free schedule: every doctor gets
+    consecutive 30 minute slots from 09:00, and at any given slot each doctor
+    sees a different patient.
+    """
+    if patients < doctors:
+        raise ValueError("Need at least as many patients as doctors.")
+
+    creator = User.objects.create_user(
+        email="benchmark-manager@example.invalid", password=None, role="manager"
+    )
+    specialization, _ = Specialization.objects.get_or_create(
+        name="Benchmark", defaults={"description": "Synthetic benchmark data"}
+    )
+    doctor_users = User.objects.bulk_create(
+        User(email=f"benchmark-doctor-{i}@example.invalid", role="doctor")
+        for i in range(doctors)
+    )
+    doctor_rows = Doctor.objects.bulk_create(
+        Doctor(user=user, specialization=specialization) for user in doctor_users
+    )
+    patient_rows = Patient.objects.bulk_create(
+        Patient(
+            first_name=f"Patient{i}",
+            last_name=f"Synthetic{i % 97}",
+            birth_date=date(1950, 1, 1) + timedelta(days=i % 20_000),
+            gender="male" if i % 2 else "female",
+            created_by=creator,
+        )
+        for i in range(patients)
+    )
+
+    slots_per_day = max(1, -(-appointments // (doctors * days)))
+    first_day = date.today() - timedelta(days=days // 2)
+    statuses = ["completed", "completed", "scheduled", "canceled", "in_queue"]
+    batch = []
+    for n in range(appointments):
+        doctor_index = n % doctors
+        slot_index = n // doctors
+        day, slot = divmod(slot_index, slots_per_day)
+        starts = datetime.combine(first_day + timedelta(days=day), time(9)) + timedelta(minutes=30 * slot)
+        appointment = Appointment(
+            patient=patient_rows[(slot_index * doctors + doctor_index) % patients],
+            doctor=doctor_rows[doctor_index],
+            appointment_date=starts.date(),
+            appointment_time=starts.time(),
+            duration=30,
+            status=statuses[n % len(statuses)],
+            is_active=n % 50 != 0,
+            created_by=creator,
+        )
+        appointment.sync_denormalized_fields()
+        batch.append(appointment)
+        if len(batch) >= 5_000:
+            Appointment.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Appointment.objects.bulk_create(batch)
+
+    if is_postgres():
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE appointments_appointment")
+    return creator, doctor_rows, patient_rows
+
+
+def hot_queries(doctor, patient):
+    """
+    Return {name: queryset} mirroring the queries issued by the list
+    endpoint, AppointmentSerializer.validate and the reports views.
+    """
+    from .serializers import AppointmentSerializer
+
+    today = date.today()
+    active = Appointment.objects.filter(is_active=True).order_by("-appointment_date", "-id")
+    sample = Appointment.objects.filter(doctor=doctor).order_by("starts_at").first()
+    starts_at = sample.starts_at if sample else datetime.now()
+    ends_at = starts_at + timedelta(minutes=30)
+    # Keyset equivalent of list_deep_page
+    cursor = active.values("appointment_date", "id")[5_000:5_001].first() or {
+        "appointment_date": today,
+        "id": 0,
+    }
+
+    return {
+        "list_first_page": active[:10],
+        "list_deep_page": active[5_000:5_010],
+        "list_keyset_page": active.filter(
+            Q(appointment_date__lt=cursor["appointment_date"])
+            | Q(appointment_date=cursor["appointment_date"], id__lt=cursor["id"])
+        )[:10],
+        "list_doctor": active.filter(doctor=doctor)[:10],
+        "list_patient": Appointment.objects.filter(patient=patient).order_by("appointment_date")[:10],
+        "list_status_day": active.filter(status="scheduled", appointment_date=today)[:10],
+        # The patient lookup with the conflict probe of a booking
+        "validate_booking": AppointmentSerializer.probe_slot(
+            Patient.objects.filter(pk=patient.pk),
+            Appointment.objects.blocking().overlapping(starts_at, ends_at),
+            doctor,
+        ),
+        "report_status_counts": Appointment.objects.values("status").annotate(count=Count("id")),
+        "report_daily_completed": Appointment.objects.filter(
+            status="completed", appointment_date__gte=today - timedelta(days=7)
+        ).values("appointment_date").annotate(count=Count("id")),
+    }
+
+
+def run_benchmarks(queries, repeat=5):
+    """
+    Run each queryset `repeat` times and capture its plan.
+
+    Returns {name: {"median_ms", "seq_scan", "plan"}}.
+    """
+    results = {}
+    for name, queryset in queries.items():
+        timings = []
+        for _ in range(repeat):
+            started = clock.perf_counter()
+            list(queryset.all())
+            timings.append((clock.perf_counter() - started) * 1000)
+        plan = queryset.explain()
+        results[name] = {
+            "median_ms": round(statistics.median(timings), 3),
+            "seq_scan": any(pattern.search(plan) for pattern in SEQ_SCAN_PATTERNS),
+            "plan": plan,
+        }
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare results with a baseline run and describe every query that started
+    scanning the appointment table sequentially or got more than `tolerance`
+    times slower.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result["seq_scan"] and not previous["seq_scan"]:
+            regressions.append(f"{name}: now scans appointments_appointment sequentially")
+        if previous["median_ms"] > 0 and result["median_ms"] > previous["median_ms"] * tolerance:
+            regressions.append(
+                f"{name}: {result['median_ms']}ms vs {previous['median_ms']}ms baseline"
+            )
+    return regressions
+
+
+def find_booking_regressions(booking, baseline, tolerance):
+    """
+    Compare the booking figures with a baseline run: any extra statement per
+    booking, or a slowdown of more than `tolerance` times, is a regression.
+    """
+    if not booking or not baseline:
+        return []
+    regressions = []
+    if booking["queries_per_booking"] > baseline["queries_per_booking"]:
+        regressions.append(
+            f"booking: {booking['queries_per_booking']} queries vs "
+            f"{baseline['queries_per_booking']} baseline"
+        )
+    if baseline["median_ms"] > 0 and booking["median_ms"] > baseline["median_ms"] * tolerance:
+        regressions.append(f"booking: {booking['median_ms']}ms vs {baseline['median_ms']}ms baseline")
+    return regressions
+
+
+def benchmark_booking(doctors, patients, user, bookings=200):
+    """
+    Book appointments through AppointmentViewSet.create and report the
+    statements and latency per booking.
+    """
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    from .views import AppointmentViewSet
+
+    factory = APIRequestFactory()
+    view = AppointmentViewSet.as_view({"post": "create"})
+    # Well past the synthetic dataset, so every booking is conflict free
+    day = date.today() + timedelta(days=1_000)
+
+    timings, query_counts = [], []
+    for n in range(bookings):
+        doctor_index = n % len(doctors)
+        slot_index = n // len(doctors)
+        starts = datetime.combine(day, time(9)) + timedelta(minutes=30 * slot_index)
+        patient = patients[(slot_index * len(doctors) + doctor_index) % len(patients)]
+        request = factory.post(
+            "/api/appointments/",
+            {
+                "patient_uuid": str(patient.patient_id),
+                "doctor_id": doctors[doctor_index].id,
+                "appointment_date": starts.date().isoformat(),
+                "appointment_time": starts.time().isoformat(),
+                "duration": 30,
+                "billing_amount": "100.00",
+            },
+            format="json",
+        )
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            started = clock.perf_counter()
+            response = view(request)
+            timings.append((clock.perf_counter() - started) * 1000)
+        if response.status_code != 201:
+            raise ValueError(f"Booking failed: {response.data}")
+        query_counts.append(len(queries))
+
+    return {
+        "bookings": bookings,
+        "median_ms": round(statistics.median(timings), 3),
+        "queries_per_booking": statistics.median(query_counts),
+        "max_queries": max(query_counts),
+    }
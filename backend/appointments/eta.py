@@ -0,0 +1,146 @@
+"""
+Estimated start times for today's queue.
+
+Every doctor has running statistics of their actual consult lengths (count,
+mean and sum of squared deviations, updated with Welford's method) in the
+cache. They are updated as appointments complete, so estimating the queue
+never looks at past appointments: it reads today's queue with the check-in
+times of its patients and the doctors' statistics with one cache lookup,
+and walks the queue once.
+
+A consult is taken to start at check-in or when the doctor finished the
+previous one that day, whichever is later; the status log has no consult
+start. The count is capped at WINDOW, so the mean follows a doctor's recent
+consults rather than their whole history.
+
+With the default per-process cache every worker keeps its own statistics;
+deployments with several workers should configure a shared cache.
+"""
+
+import math
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+CACHE_KEY = "appointments:consult-stats:{}"
+WINDOW = 200
+MIN_SAMPLES = 5
+MAX_CONSULT_MINUTES = 240
+
+
+def cache_key(doctor_id):
+    return CACHE_KEY.format(doctor_id)
+
+
+def empty_stats():
+    return {"count": 0, "mean": 0.0, "m2": 0.0, "last_completed": None}
+
+
+def add_sample(stats, minutes):
+    """
+    Fold one consult length into the statistics (Welford's update).
+    """
+    count = min(stats["count"] + 1, WINDOW)
+    delta = minutes - stats["mean"]
+    mean = stats["mean"] + delta / count
+    m2 = stats["m2"] + delta * (minutes - mean)
+    if stats["count"] >= WINDOW:
+        # Keep the variance on the same window as the mean
+        m2 *= (WINDOW - 1) / WINDOW
+    return {**stats, "count": count, "mean": mean, "m2": m2}
+
+
+def summarize(stats):
+    """
+    Mean and standard deviation of the consult lengths in minutes.
+    """
+    count = stats["count"]
+    return {
+        "mean": round(stats["mean"], 1) if count else None,
+        "stddev": round(math.sqrt(stats["m2"] / (count - 1)), 1) if count > 1 else None,
+        "samples": count,
+    }
+
+
+def last_completed_today(stats, now):
+    """
+    The doctor's last completion, if it was today.
+    """
+    if stats["last_completed"] is None:
+        return None
+    last = datetime.fromisoformat(stats["last_completed"])
+    return last if timezone.localdate(last) == timezone.localdate(now) else None
+
+
+def record_completions(completions, completed_at):
+    """
+    Update the statistics for appointments completed at `completed_at`,
+    given as (doctor_id, checked_in_at) pairs; checked_in_at is None for
+    appointments completed without being queued, which add no sample.
+
+    Concurrent completions for the same doctor may drop a sample.
+    """
+    by_doctor = {}
+    for doctor_id, checked_in_at in sorted(
+        completions, key=lambda pair: (pair[0], pair[1] is None, pair[1])
+    ):
+        by_doctor.setdefault(doctor_id, []).append(checked_in_at)
+
+    current = cache.get_many([cache_key(doctor_id) for doctor_id in by_doctor])
+    updated = {}
+    for doctor_id, check_ins in by_doctor.items():
+        key = cache_key(doctor_id)
+        stats = current.get(key) or empty_stats()
+        previous = last_completed_today(stats, completed_at)
+        for checked_in_at in check_ins:
+            if checked_in_at is None:
+                continue
+            started_at = max(checked_in_at, previous) if previous else checked_in_at
+            minutes = (completed_at - started_at).total_seconds() / 60
+            # Completing several of a doctor's appointments at once yields
+            # zero-length consults after the first; those are bookkeeping
+            if 0 < minutes <= MAX_CONSULT_MINUTES:
+                stats = add_sample(stats, minutes)
+            previous = completed_at
+        updated[key] = {**stats, "last_completed": completed_at.isoformat()}
+    cache.set_many(updated, timeout=None)
+
+
+def expected_minutes(stats, appointment):
+    if stats["count"] >= MIN_SAMPLES:
+        return stats["mean"]
+    return appointment.duration
+
+
+def estimate_queue(appointments, check_ins, now=None):
+    """
+    Estimated start times for in-queue appointments, given in serving order,
+    with `check_ins` mapping their pks to when they were queued.
+
+    Returns {doctor_id: {"stats": ..., "queue": [(appointment, start)]}}.
+    The first patient of a doctor is taken to be in consult already; later
+    ones start when the one ahead is expected to finish, but not before now.
+    """
+    now = now or timezone.now()
+    queues = {}
+    for appointment in appointments:
+        queues.setdefault(appointment.doctor_id, []).append(appointment)
+    current = cache.get_many([cache_key(doctor_id) for doctor_id in queues])
+
+    estimates = {}
+    for doctor_id, queue in queues.items():
+        stats = current.get(cache_key(doctor_id)) or empty_stats()
+        head = queue[0]
+        known = [
+            moment
+            for moment in (check_ins.get(head.pk), last_completed_today(stats, now))
+            if moment is not None
+        ]
+        start = min(max(known), now) if known else now
+        rows = []
+        for appointment in queue:
+            rows.append((appointment, start))
+            start = max(start + timedelta(minutes=expected_minutes(stats, appointment)), now)
+        estimates[doctor_id] = {"stats": stats, "queue": rows}
+    return estimates
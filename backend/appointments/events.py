@@ -0,0 +1,100 @@
+"""
+Appointment status events for the live queue board.
+
+Status changes are published after the surrounding transaction commits and
+fanned out to the subscribed server-sent-event streams. The broker lives in
+process memory, so every ASGI worker only sees the changes made through it;
+deployments with several workers need a shared broker with the same
+publish()/subscribe() interface.
+"""
+
+import asyncio
+import threading
+
+from django.db import transaction
+from django.utils import timezone
+
+
+class Subscription:
+    """
+    Queue of events for one stream, bound to the event loop that created it.
+    """
+
+    def __init__(self, broker, doctor_id=None, maxsize=100):
+        self.broker = broker
+        self.doctor_id = doctor_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def wants(self, event):
+        return self.doctor_id is None or event["doctor_id"] == self.doctor_id
+
+    def offer(self, event):
+        # Runs on the subscriber's loop; a stalled client loses its oldest
+        # events rather than growing without bound.
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, doctor_id=None):
+        """
+        Register a stream for one doctor's events, or all events when
+        doctor_id is None. Must be called from a running event loop.
+        """
+        subscription = Subscription(self, doctor_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, event):
+        """
+        Deliver an event to every matching subscription. Safe to call from
+        any thread.
+        """
+        with self._lock:
+            subscriptions = [s for s in self._subscriptions if s.wants(event)]
+        for subscription in subscriptions:
+            if not subscription.loop.is_closed():
+                subscription.loop.call_soon_threadsafe(subscription.offer, event)
+
+
+broker = InProcessBroker()
+
+
+def appointment_event(appointment):
+    return {
+        "appointment_id": str(appointment.appointment_id),
+        "doctor_id": appointment.doctor_id,
+        "patient_id": appointment.patient_id,
+        "patient_name": f"{appointment.patient.first_name} {appointment.patient.last_name}",
+        "appointment_date": appointment.appointment_date.isoformat(),
+        "appointment_time": appointment.appointment_time.strftime("%H:%M"),
+        "status": appointment.status,
+    }
+
+
+def publish_status_change(appointment):
+    """
+    Publish an appointment's new status once the current transaction
+    commits. Only today's appointments are shown on the queue board.
+    """
+    if appointment.appointment_date != timezone.localdate():
+        return
+    event = appointment_event(appointment)
+    transaction.on_commit(lambda: broker.publish(event))
@@ -1,4 +1,9 @@
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db.models import Q
 from django_filters import rest_framework as filters
+from rest_framework.filters import SearchFilter
+
+from core.db import is_postgres
 from .models import Appointment
 
 
@@ -14,6 +19,7 @@ class AppointmentFilter(filters.FilterSet):
     doctor = filters.NumberFilter()
     patient = filters.NumberFilter()
     specialization = filters.NumberFilter(field_name='doctor__specialization')
+    resource = filters.NumberFilter(field_name="resources")
     ordering = filters.OrderingFilter(
         fields=(
             ("appointment_date", "appointment_date"),
@@ -23,4 +29,38 @@ class AppointmentFilter(filters.FilterSet):
 
     class Meta:
         model = Appointment
-        fields = ["appointment_date", "status", "doctor", "patient", "specialization"]
+        fields = ["appointment_date", "status", "doctor", "patient", "specialization", "resource"]
+
+
+class AppointmentSearchFilter(SearchFilter):
+    """
+    Searches patient and doctor names through the denormalized, lowercased
+    Appointment.search_text column, plus status names.
+
+    On PostgreSQL the substring match is served by a pg_trgm GIN index, close
+    misspellings also match through trigram word similarity, and results are
+    ranked by similarity unless an explicit ordering is
+    requested. Other backends fall back to a plain LIKE.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = [term.lower() for term in self.get_search_terms(request)]
+        if not terms:
+            return queryset
+
+        postgres = is_postgres()
+        statuses = [value for value, _ in Appointment.APP_STATUS_CHOICES]
+        for term in terms:
+            condition = Q(search_text__contains=term)
+            if postgres:
+                condition |= Q(search_text__trigram_word_similar=term)
+            matching = [status for status in statuses if term in status]
+            if matching:
+                condition |= Q(status__in=matching)
+            queryset = queryset.filter(condition)
+
+        if postgres and "ordering" not in request.query_params:
+            queryset = queryset.annotate(
+                search_rank=TrigramWordSimilarity(" ".join(terms), "search_text")
+            ).order_by("-search_rank", "-appointment_date", "-id")
+        return queryset
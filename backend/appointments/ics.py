@@ -0,0 +1,172 @@
+"""
+Per-doctor iCalendar feeds.
+
+Calendar apps poll a feed URL carrying the doctor's CalendarFeed token. The
+feed row has a version that goes up, in the same transaction, whenever one
+of the doctor's appointments changes, see touch_calendars(). It lives in the
+database rather than the cache so that every server process, and management
+commands such as imports, see the same version. The ETag and the cached body
+are keyed by it, so polling an unchanged feed answers 304 or serves the
+cached body after reading the feed row alone. A feed that has changed is
+streamed from the database as it is read and cached on the way out.
+"""
+
+import hashlib
+from datetime import timedelta, timezone as dt_timezone
+
+from django.core.cache import cache
+from django.db.models import F
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+
+from .models import Appointment, CalendarFeed
+
+BODY_KEY = "appointments:calendar-body:{}:{}"
+DAYS_BEFORE = 90
+DAYS_AFTER = 365
+# Larger feeds are streamed on every change without being cached
+MAX_CACHED_BYTES = 1_000_000
+BODY_TIMEOUT = 24 * 60 * 60
+PRODID = "-//Clinic//Appointments//EN"
+
+
+def touch_calendars(doctor_ids):
+    """
+    Give the doctors' feeds a new version, as part of the current
+    transaction. Doctors without a feed cost nothing more than the query.
+    """
+    doctor_ids = {doctor_id for doctor_id in doctor_ids if doctor_id is not None}
+    if doctor_ids:
+        CalendarFeed.objects.filter(doctor_id__in=doctor_ids).update(version=F("version") + 1)
+
+
+def escape(text):
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def fold(line):
+    """
+    Split a content line into 75-octet lines, as RFC 5545 requires.
+    """
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts, start, limit = [], 0, 75
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Do not split a multi-byte character
+        while end < len(encoded) and encoded[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode())
+        start, limit = end, 74
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def utc(moment):
+    return moment.astimezone(dt_timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def feed_window(today=None):
+    today = today or timezone.localdate()
+    return today - timedelta(days=DAYS_BEFORE), today + timedelta(days=DAYS_AFTER)
+
+
+def feed_lines(doctor, date_from, date_to):
+    """
+    Yield the feed one event at a time, reading appointments in chunks.
+    """
+    yield (
+        "BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+        f"PRODID:{PRODID}\r\nCALSCALE:GREGORIAN\r\nMETHOD:PUBLISH\r\n"
+    )
+    yield fold(f"X-WR-CALNAME:{escape(str(doctor))}")
+    appointments = (
+        Appointment.objects.live()
+        .blocking()
+        .filter(doctor=doctor, appointment_date__range=(date_from, date_to))
+        .order_by("starts_at")
+        .values_list(
+            "appointment_id",
+            "starts_at",
+            "ends_at",
+            "updated_at",
+            "status",
+            "notes",
+            "patient__first_name",
+            "patient__last_name",
+        )
+    )
+    for row in appointments.iterator(chunk_size=500):
+        appointment_id, starts_at, ends_at, updated_at, status, notes, first_name, last_name = row
+        lines = [
+            "BEGIN:VEVENT",
+            f"UID:{appointment_id}@appointments",
+            f"DTSTAMP:{utc(updated_at)}",
+            f"LAST-MODIFIED:{utc(updated_at)}",
+            f"DTSTART:{utc(starts_at)}",
+            f"DTEND:{utc(ends_at)}",
+            f"SUMMARY:{escape(f'{first_name} {last_name}')}",
+            f"CATEGORIES:{status.upper()}",
+        ]
+        if notes:
+            lines.append(f"DESCRIPTION:{escape(notes)}")
+        lines.append("END:VEVENT")
+        yield "".join(fold(line) for line in lines)
+    yield "END:VCALENDAR\r\n"
+
+
+def cache_as_streamed(chunks, key):
+    """
+    Pass the chunks through, keeping a copy to cache once all are sent,
+    unless the feed grows past MAX_CACHED_BYTES.
+    """
+    parts, size = [], 0
+    for chunk in chunks:
+        yield chunk
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > MAX_CACHED_BYTES:
+                parts = None
+    if parts is not None:
+        cache.set(key, "".join(parts), BODY_TIMEOUT)
+
+
+def doctor_calendar_feed(request, token):
+    """
+    The doctor's appointments from DAYS_BEFORE days ago to DAYS_AFTER days
+    ahead, as text/calendar. Canceled and deleted appointments are left out,
+    so calendar apps drop them.
+    """
+    feed = CalendarFeed.objects.select_related("doctor__user").filter(token=token).first()
+    if feed is None:
+        raise Http404("Unknown calendar feed.")
+    doctor = feed.doctor
+
+    date_from, date_to = feed_window()
+    # The token too, as a feed issued again starts over at version 0
+    etag = quote_etag(hashlib.sha1(f"{feed.token}|{feed.version}|{date_from}".encode()).hexdigest())
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+        return HttpResponseNotModified(headers=headers)
+
+    key = BODY_KEY.format(doctor.pk, etag.strip('"'))
+    body = cache.get(key)
+    content_type = "text/calendar; charset=utf-8"
+    if body is not None:
+        response = HttpResponse(body, content_type=content_type, headers=headers)
+    else:
+        response = StreamingHttpResponse(
+            cache_as_streamed(feed_lines(doctor, date_from, date_to), key),
+            content_type=content_type,
+            headers=headers,
+        )
+    response["Content-Disposition"] = f'inline; filename="doctor-{doctor.pk}.ics"'
+    return response
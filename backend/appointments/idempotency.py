@@ -0,0 +1,88 @@
+"""
+Idempotency-Key support for booking requests.
+
+The first request with a key claims it by inserting an IdempotencyKey row in
+the same transaction as the booking. A retry is answered from the stored
+response with one indexed lookup. A retry that races the original waits on
+the unique index until the original commits, then gets the stored response.
+"""
+
+import hashlib
+import json
+
+from django.db import IntegrityError, transaction
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method} {request.path}\n{body}".encode()).hexdigest()
+
+
+def replay(record, fingerprint):
+    if record.fingerprint != fingerprint:
+        return Response(
+            {"error": f"This {HEADER} was already used for a different request."},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+        )
+    if record.response_status is None:
+        return Response(
+            {"error": f"A request with this {HEADER} is still being processed."},
+            status=status.HTTP_409_CONFLICT,
+        )
+    return Response(
+        record.response_body,
+        status=record.response_status,
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+def idempotent(request, run):
+    """
+    Call `run()` (which returns a Response) at most once per user and
+    Idempotency-Key. Only successful responses are stored; a failed request
+    releases the key so it can be retried.
+    """
+    key = request.headers.get(HEADER)
+    if not key:
+        return run()
+    if len(key) > MAX_KEY_LENGTH:
+        return Response(
+            {"error": f"{HEADER} must be at most {MAX_KEY_LENGTH} characters."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    # Fingerprint before run(), which may rewrite request.data
+    fingerprint = request_fingerprint(request)
+    record = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+    if record is not None:
+        if not record.is_expired:
+            return replay(record, fingerprint)
+        record.delete()
+
+    claimed = False
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                user=request.user, key=key, fingerprint=fingerprint
+            )
+            claimed = True
+            response = run()
+            if not status.is_success(response.status_code):
+                transaction.set_rollback(True)
+                return response
+            record.response_status = response.status_code
+            record.response_body = response.data
+            record.save(update_fields=["response_status", "response_body"])
+            return response
+    except IntegrityError:
+        if claimed:
+            raise
+        # A concurrent request with the same key committed first
+        return replay(IdempotencyKey.objects.get(user=request.user, key=key), fingerprint)
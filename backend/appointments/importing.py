@@ -0,0 +1,487 @@
+"""
+Bulk import of existing appointments from CSV or iCalendar files.
+
+Rows are parsed as the file is read and handled in chunks. The patients and
+doctors of a chunk are resolved with one query each, and conflicts are
+checked in memory against the busy ranges of every doctor-day and
+patient-day the chunk touches, each loaded from the database once per
+import. The valid rows of a chunk are inserted with bulk_create in one
+transaction.
+
+CSV files have a header row with these columns:
+
+    patient_uuid or patient_email
+    doctor_id, doctor_license or doctor_email
+    appointment_date (YYYY-MM-DD), appointment_time (HH:MM)
+    duration (minutes, default 30), status (default scheduled), notes
+    billing_amount, billing_method (a payment is created when an amount is given)
+
+In iCalendar files every VEVENT is a row. DTSTART and DTEND or DURATION
+give the slot, DESCRIPTION the notes and STATUS:CANCELLED cancels; the
+other columns are read from X- properties named after them, e.g.
+X-PATIENT-EMAIL or X-DOCTOR-LICENSE.
+"""
+
+import csv
+import re
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from uuid import UUID
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_time
+
+from billing.models import Payment
+from doctors.models import Doctor
+from patients.models import Patient
+from reports.rollups import Deltas
+
+from .ics import touch_calendars
+from .models import Appointment, is_slot_conflict
+from .partitioning import CROSSES_PARTITION, crosses_partition
+
+FORMATS = ["csv", "ics"]
+CHUNK_SIZE = 1_000
+MAX_ERRORS = 100
+MAX_DURATION = 480
+STATUSES = {value for value, _ in Appointment.APP_STATUS_CHOICES}
+BILLING_METHODS = {value for value, _ in Payment.PAYMENT_METHOD_CHOICES}
+ICS_DURATION = re.compile(r"^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_csv(stream):
+    """
+    Yield (line number, row) for every data row of a CSV file.
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, {
+            (key or "").strip().lower(): (value or "").strip() for key, value in row.items()
+        }
+
+
+def unfold(stream):
+    """
+    Yield (line number, content line) with folded lines joined back.
+    """
+    pending, start = None, 0
+    for number, line in enumerate(stream, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and pending is not None:
+            pending += line[1:]
+            continue
+        if pending is not None:
+            yield start, pending
+        pending, start = line, number
+    if pending is not None:
+        yield start, pending
+
+
+def unescape(value):
+    return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+
+def parse_ics_datetime(value, params):
+    """
+    Return an aware datetime for a DATE-TIME value in UTC (trailing Z), in
+    the zone named by TZID, or floating (read in the clinic's time zone).
+    """
+    moment = datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return moment.replace(tzinfo=ZoneInfo("UTC"))
+    if "TZID" in params:
+        try:
+            return moment.replace(tzinfo=ZoneInfo(params["TZID"]))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise RowError(f"Unknown time zone {params['TZID']}.")
+    return timezone.make_aware(moment)
+
+
+def parse_ics_duration(value):
+    match = ICS_DURATION.match(value)
+    if not match or not any(match.groups()):
+        raise RowError(f"Invalid DURATION {value}.")
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+
+def ics_event_row(properties):
+    """
+    Map the properties of one VEVENT to the CSV columns.
+    """
+    row = {}
+    for name, (params, value) in properties.items():
+        if name.startswith("X-"):
+            row[name[2:].lower().replace("-", "_")] = value.strip()
+    if "DTSTART" not in properties:
+        raise RowError("VEVENT without DTSTART.")
+    try:
+        params, value = properties["DTSTART"]
+        starts_at = parse_ics_datetime(value, params)
+        if "DTEND" in properties:
+            params, value = properties["DTEND"]
+            length = parse_ics_datetime(value, params) - starts_at
+        elif "DURATION" in properties:
+            length = parse_ics_duration(properties["DURATION"][1])
+        else:
+            length = None
+    except ValueError as e:
+        raise RowError(str(e) if isinstance(e, RowError) else "Invalid DTSTART or DTEND.")
+
+    local = timezone.localtime(starts_at)
+    row["appointment_date"] = local.date().isoformat()
+    row["appointment_time"] = local.time().isoformat()
+    if length is not None:
+        row["duration"] = str(int(length.total_seconds() // 60))
+    if "DESCRIPTION" in properties:
+        row["notes"] = unescape(properties["DESCRIPTION"][1])
+    if properties.get("STATUS", (None, ""))[1].upper() == "CANCELLED":
+        row["status"] = "canceled"
+    return row
+
+
+def read_ics(stream):
+    """
+    Yield (line number, row) for every VEVENT of an iCalendar file. An event
+    that cannot be read yields a RowError in place of the row.
+    """
+    properties, start = None, 0
+    for number, line in unfold(stream):
+        name, _, value = line.partition(":")
+        name, *params = name.split(";")
+        name = name.upper()
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            properties, start = {}, number
+        elif name == "END" and value.upper() == "VEVENT" and properties is not None:
+            try:
+                yield start, ics_event_row(properties)
+            except RowError as e:
+                yield start, e
+            properties = None
+        elif properties is not None:
+            params = dict(param.split("=", 1) for param in params if "=" in param)
+            properties[name] = (params, value)
+
+
+def clean_row(row):
+    """
+    Validate the scalar columns of a row, returning the cleaned values.
+    """
+    if isinstance(row, RowError):
+        raise row
+    try:
+        appointment_date = parse_date(row.get("appointment_date", ""))
+        appointment_time = parse_time(row.get("appointment_time", ""))
+    except ValueError:
+        appointment_date = appointment_time = None
+    if appointment_date is None or appointment_time is None:
+        raise RowError("appointment_date and appointment_time are required (YYYY-MM-DD, HH:MM).")
+    try:
+        duration = int(row.get("duration") or 30)
+    except ValueError:
+        raise RowError("duration must be a number of minutes.")
+    if not 1 <= duration <= MAX_DURATION:
+        raise RowError(f"duration must be between 1 and {MAX_DURATION} minutes.")
+    if crosses_partition(appointment_date, appointment_time, duration):
+        raise RowError(CROSSES_PARTITION)
+    status = (row.get("status") or "scheduled").lower()
+    if status not in STATUSES:
+        raise RowError(f"Invalid status {status}.")
+
+    billing_amount = None
+    if row.get("billing_amount"):
+        try:
+            billing_amount = Decimal(row["billing_amount"])
+            if not billing_amount.is_finite():
+                raise InvalidOperation
+        except InvalidOperation:
+            raise RowError("billing_amount must be a number.")
+        if billing_amount <= 0:
+            raise RowError("billing_amount must be positive.")
+        try:
+            # Digits and decimal places the payment column holds
+            Payment._meta.get_field("amount").run_validators(billing_amount)
+        except ValidationError as e:
+            raise RowError(f"billing_amount: {' '.join(e.messages)}")
+    billing_method = row.get("billing_method") or "Cash"
+    if billing_method not in BILLING_METHODS:
+        raise RowError(f"Invalid billing_method {billing_method}.")
+
+    patient_key = next(
+        ((column, row[column]) for column in ("patient_uuid", "patient_email") if row.get(column)),
+        None,
+    )
+    doctor_key = next(
+        (
+            (column, row[column])
+            for column in ("doctor_id", "doctor_license", "doctor_email")
+            if row.get(column)
+        ),
+        None,
+    )
+    if patient_key is None:
+        raise RowError("patient_uuid or patient_email is required.")
+    if doctor_key is None:
+        raise RowError("doctor_id, doctor_license or doctor_email is required.")
+    try:
+        if patient_key[0] == "patient_uuid":
+            patient_key = ("patient_uuid", UUID(patient_key[1]))
+        else:
+            patient_key = ("patient_email", patient_key[1].lower())
+    except ValueError:
+        raise RowError("Invalid patient_uuid.")
+    try:
+        if doctor_key[0] == "doctor_id":
+            doctor_key = ("doctor_id", int(doctor_key[1]))
+        elif doctor_key[0] == "doctor_email":
+            doctor_key = ("doctor_email", doctor_key[1].lower())
+    except ValueError:
+        raise RowError("Invalid doctor_id.")
+
+    return {
+        "patient_key": patient_key,
+        "doctor_key": doctor_key,
+        "appointment_date": appointment_date,
+        "appointment_time": appointment_time,
+        "duration": duration,
+        "status": status,
+        "notes": row.get("notes") or None,
+        "billing_amount": billing_amount,
+        "billing_method": billing_method,
+    }
+
+
+def resolve_patients(keys):
+    """
+    Return {key: patient} for (column, value) keys, with one query.
+    """
+    uuids = [value for column, value in keys if column == "patient_uuid"]
+    emails = [value for column, value in keys if column == "patient_email"]
+    found = {}
+    for patient in Patient.objects.filter(
+        Q(patient_id__in=uuids) | Q(email__in=emails), is_active=True
+    ):
+        found[("patient_uuid", patient.patient_id)] = patient
+        if patient.email:
+            found[("patient_email", patient.email.lower())] = patient
+    return found
+
+
+def resolve_doctors(keys):
+    """
+    Return {key: doctor} for (column, value) keys, with one query.
+    """
+    values = defaultdict(list)
+    for column, value in keys:
+        values[column].append(value)
+    found = {}
+    doctors = Doctor.objects.select_related("user").filter(
+        Q(id__in=values["doctor_id"])
+        | Q(license_number__in=values["doctor_license"])
+        | Q(user__email__in=values["doctor_email"]),
+        user__is_active=True,
+    )
+    for doctor in doctors:
+        found[("doctor_id", doctor.id)] = doctor
+        if doctor.license_number:
+            found[("doctor_license", doctor.license_number)] = doctor
+        found[("doctor_email", doctor.user.email.lower())] = doctor
+    return found
+
+
+def nearby(day):
+    return (day - timedelta(days=1), day, day + timedelta(days=1))
+
+
+class BusyIndex:
+    """
+    Busy ranges of doctors and patients by day, loaded from the database one
+    set of days at a time and extended with every imported row.
+    """
+
+    def __init__(self):
+        # {(owner, id, day): [(starts_at, ends_at), ...]} by start day. An
+        # appointment may run past midnight, so lookups also read the days
+        # either side
+        self.ranges = defaultdict(list)
+        self.loaded = set()
+
+    def load(self, keys):
+        """
+        Load the existing blocking appointments of the given (owner, id,
+        day) keys not loaded yet, with one query.
+        """
+        wanted = set()
+        for owner, owner_id, day in keys:
+            for load_day in nearby(day):
+                if (owner, owner_id, load_day) not in self.loaded:
+                    wanted.add((owner, owner_id, load_day))
+        if not wanted:
+            return
+        doctor_ids = {owner_id for owner, owner_id, _ in wanted if owner == "doctor"}
+        patient_ids = {owner_id for owner, owner_id, _ in wanted if owner == "patient"}
+        days = {day for _, _, day in wanted}
+        rows = (
+            Appointment.objects.blocking()
+            .filter(Q(doctor_id__in=doctor_ids) | Q(patient_id__in=patient_ids), appointment_date__in=days)
+            .values_list("doctor_id", "patient_id", "appointment_date", "starts_at", "ends_at")
+        )
+        for doctor_id, patient_id, day, starts_at, ends_at in rows:
+            for key in (("doctor", doctor_id, day), ("patient", patient_id, day)):
+                if key in wanted:
+                    self.ranges[key].append((starts_at, ends_at))
+        self.loaded |= wanted
+
+    def overlaps(self, owner, owner_id, day, starts_at, ends_at):
+        return any(
+            busy_start < ends_at and starts_at < busy_end
+            for check_day in nearby(day)
+            for busy_start, busy_end in self.ranges.get((owner, owner_id, check_day), ())
+        )
+
+    def add(self, owner, owner_id, day, starts_at, ends_at):
+        self.ranges[(owner, owner_id, day)].append((starts_at, ends_at))
+
+
+class Importer:
+    """
+    Import parsed rows in chunks. ``summary`` holds the running counts and
+    the first MAX_ERRORS row errors.
+    """
+
+    def __init__(self, created_by, chunk_size=CHUNK_SIZE, dry_run=False, progress=None):
+        self.created_by = created_by
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.progress = progress
+        self.busy = BusyIndex()
+        self.doctors = {}
+        self.summary = {"rows": 0, "created": 0, "failed": 0, "errors": []}
+
+    def fail(self, line, message):
+        self.summary["failed"] += 1
+        if len(self.summary["errors"]) < MAX_ERRORS:
+            self.summary["errors"].append({"row": line, "error": message})
+
+    def run(self, rows):
+        chunk = []
+        try:
+            for line, row in rows:
+                self.summary["rows"] += 1
+                try:
+                    chunk.append((line, clean_row(row)))
+                except RowError as e:
+                    self.fail(line, str(e))
+                if len(chunk) >= self.chunk_size:
+                    self.import_chunk(chunk)
+                    chunk = []
+        except UnicodeDecodeError:
+            # Earlier chunks are already in; report how far the import got
+            self.fail(None, "The file is not valid UTF-8; the rest of it was not read.")
+        if chunk:
+            self.import_chunk(chunk)
+        return self.summary
+
+    def import_chunk(self, chunk):
+        patients = resolve_patients({row["patient_key"] for _, row in chunk})
+        # Branches have few doctors, so they are kept for the whole import
+        missing = {row["doctor_key"] for _, row in chunk} - self.doctors.keys()
+        if missing:
+            resolved = resolve_doctors(missing)
+            self.doctors.update({key: resolved.get(key) for key in missing})
+
+        ready = []
+        for line, row in chunk:
+            patient = patients.get(row["patient_key"])
+            doctor = self.doctors.get(row["doctor_key"])
+            if patient is None:
+                self.fail(line, f"Unknown or inactive patient {row['patient_key'][1]}.")
+            elif doctor is None:
+                self.fail(line, f"Unknown or inactive doctor {row['doctor_key'][1]}.")
+            else:
+                starts_at, ends_at = Appointment.slot_bounds(
+                    row["appointment_date"], row["appointment_time"], row["duration"]
+                )
+                ready.append((line, row, patient, doctor, starts_at, ends_at))
+
+        self.busy.load(
+            key
+            for _, row, patient, doctor, _, _ in ready
+            for key in (
+                ("doctor", doctor.pk, row["appointment_date"]),
+                ("patient", patient.pk, row["appointment_date"]),
+            )
+        )
+        appointments, payments, lines = [], [], []
+        for line, row, patient, doctor, starts_at, ends_at in ready:
+            day = row["appointment_date"]
+            if row["status"] != "canceled":
+                if self.busy.overlaps("doctor", doctor.pk, day, starts_at, ends_at):
+                    self.fail(line, "Doctor already has an appointment at this time.")
+                    continue
+                if self.busy.overlaps("patient", patient.pk, day, starts_at, ends_at):
+                    self.fail(line, "Patient already has an appointment at this time.")
+                    continue
+                self.busy.add("doctor", doctor.pk, day, starts_at, ends_at)
+                self.busy.add("patient", patient.pk, day, starts_at, ends_at)
+
+            appointment = Appointment(
+                patient=patient,
+                doctor=doctor,
+                appointment_date=day,
+                appointment_time=row["appointment_time"],
+                duration=row["duration"],
+                status=row["status"],
+                notes=row["notes"],
+                created_by=self.created_by,
+            )
+            appointment.sync_denormalized_fields()
+            appointments.append(appointment)
+            lines.append(line)
+            if row["billing_amount"] is not None:
+                payments.append(
+                    Payment(
+                        patient=patient,
+                        appointment=appointment,
+                        amount=row["billing_amount"],
+                        method=row["billing_method"],
+                        status=Appointment.PAYMENT_STATUS_FOR.get(row["status"], "Pending"),
+                    )
+                )
+
+        if appointments and not self.dry_run:
+            try:
+                with transaction.atomic():
+                    Appointment.objects.bulk_create(appointments)
+                    Payment.objects.bulk_create(payments)
+                    touch_calendars({appointment.doctor_id for appointment in appointments})
+                    Deltas().add_new(appointments, payments).apply_on_commit()
+            except IntegrityError as e:
+                if not is_slot_conflict(e):
+                    raise
+                # Someone booked one of the slots while the chunk was checked
+                for line in lines:
+                    self.fail(line, "Conflicts with an appointment booked during the import.")
+                appointments = []
+        self.summary["created"] += len(appointments)
+        if self.progress:
+            self.progress(self.summary)
+
+
+def import_appointments(stream, file_format, created_by, **options):
+    """
+    Import the appointments of a CSV or iCalendar text stream. Returns the
+    summary: rows read, appointments created, rows failed and the first
+    row errors.
+    """
+    rows = read_ics(stream) if file_format == "ics" else read_csv(stream)
+    return Importer(created_by, **options).run(rows)
@@ -0,0 +1,59 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from appointments.ics import touch_calendars
+from appointments.models import Appointment
+from reports.rollups import Deltas, appointment_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves deleted and completed appointments older than the cutoff to the "
+        "archive, out of the list endpoint and the appointment reports"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days",
+            type=int,
+            default=365,
+            help="Archive appointments dated more than this many days ago.",
+        )
+        parser.add_argument("--batch-size", type=int, default=5_000)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        before = timezone.localdate() - timedelta(days=options["older_than_days"])
+        archivable = Appointment.objects.archivable(before)
+
+        if options["dry_run"]:
+            self.stdout.write(f"{archivable.count()} appointments before {before} would be archived")
+            return
+
+        # Short transactions, so bookings are not held up by one long move
+        archived = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    archivable.select_for_update()
+                    .order_by("pk")
+                    .values_list("pk", "doctor_id", "appointment_date", "status", "is_active")[
+                        : options["batch_size"]
+                    ]
+                )
+                if not rows:
+                    break
+                archived += Appointment.objects.filter(pk__in=[row[0] for row in rows]).update(archived=True)
+                touch_calendars({row[1] for row in rows})
+                deltas = Deltas()
+                for _, doctor_id, appointment_date, status, is_active in rows:
+                    key = (appointment_date, doctor_id, status, is_active)
+                    deltas.add_appointment(appointment_key(*key, False), -1)
+                    deltas.add_appointment(appointment_key(*key, True))
+                deltas.apply_on_commit()
+            self.stdout.write(f"  {archived} archived")
+
+        self.stdout.write(self.style.SUCCESS(f"Archived {archived} appointments before {before}"))
@@ -0,0 +1,109 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from appointments.benchmarks import (
+    benchmark_booking,
+    find_booking_regressions,
+    find_regressions,
+    generate_dataset,
+    hot_queries,
+    run_benchmarks,
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the appointment list, validation and report queries on a "
+        "synthetic dataset and captures their EXPLAIN plans. All generated "
+        "rows are rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--appointments", type=int, default=100_000)
+        parser.add_argument("--doctors", type=int, default=50)
+        parser.add_argument("--patients", type=int, default=5_000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--bookings",
+            type=int,
+            default=200,
+            help="Appointments to book through the create endpoint (0 to skip).",
+        )
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument(
+            "--baseline",
+            help="JSON results of a previous run; fail on plan or latency regressions.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=2.0,
+            help="Allowed slowdown factor against the baseline (default: 2.0).",
+        )
+        parser.add_argument("--show-plans", action="store_true")
+
+    def handle(self, *args, **options):
+        booking = None
+        try:
+            with transaction.atomic():
+                self.stdout.write(f"Generating {options['appointments']} appointments...")
+                creator, doctors, patients = generate_dataset(
+                    appointments=options["appointments"],
+                    doctors=options["doctors"],
+                    patients=options["patients"],
+                )
+                results = run_benchmarks(
+                    hot_queries(doctors[0], patients[0]), repeat=options["repeat"]
+                )
+                if options["bookings"]:
+                    booking = benchmark_booking(
+                        doctors, patients, creator, bookings=options["bookings"]
+                    )
+                raise Rollback
+        except Rollback:
+            pass
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        baseline = {}
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        for name, result in results.items():
+            flag = "SEQ SCAN" if result["seq_scan"] else "index"
+            self.stdout.write(f"{name:<28}{result['median_ms']:>10.2f} ms  {flag}")
+            if options["show_plans"]:
+                self.stdout.write(result["plan"] + "\n")
+
+        if booking:
+            self.stdout.write(
+                f"{'booking':<28}{booking['median_ms']:>10.2f} ms  "
+                f"{booking['queries_per_booking']} queries/booking "
+                f"(max {booking['max_queries']}, n={booking['bookings']})"
+            )
+            before = baseline.get("booking")
+            if before:
+                self.stdout.write(
+                    f"{'booking (baseline)':<28}{before['median_ms']:>10.2f} ms  "
+                    f"{before['queries_per_booking']} queries/booking"
+                )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"queries": results, "booking": booking}, f, indent=2)
+
+        if options["baseline"]:
+            regressions = find_regressions(results, baseline["queries"], options["tolerance"])
+            regressions += find_booking_regressions(
+                booking, baseline.get("booking"), options["tolerance"]
+            )
+            if regressions:
+                raise CommandError("Query regressions:\n" + "\n".join(regressions))
+            self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,65 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from appointments.importing import CHUNK_SIZE, FORMATS, import_appointments
+from users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports existing appointments from a CSV or iCalendar file, e.g. when "
+        "onboarding a branch. See appointments/importing.py for the columns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file")
+        parser.add_argument(
+            "--format", choices=FORMATS, help="File format (default: from the file extension)."
+        )
+        parser.add_argument(
+            "--created-by", required=True, help="Email of the user recorded as creating the appointments."
+        )
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+        parser.add_argument(
+            "--dry-run", action="store_true", help="Validate every row without inserting any."
+        )
+
+    def handle(self, *args, **options):
+        path = Path(options["file"])
+        file_format = options["format"] or path.suffix.lstrip(".").lower()
+        if file_format not in FORMATS:
+            raise CommandError("Cannot tell the file format; pass --format csv or --format ics.")
+        created_by = User.objects.filter(email__iexact=options["created_by"]).first()
+        if created_by is None:
+            raise CommandError(f"No user with email {options['created_by']}.")
+
+        def progress(summary):
+            self.stdout.write(
+                f"  {summary['rows']} rows read, {summary['created']} imported, {summary['failed']} failed"
+            )
+
+        try:
+            stream = path.open(encoding="utf-8-sig", newline="")
+        except OSError as e:
+            raise CommandError(str(e))
+        with stream:
+            summary = import_appointments(
+                stream,
+                file_format,
+                created_by,
+                chunk_size=options["chunk_size"],
+                dry_run=options["dry_run"],
+                progress=progress,
+            )
+
+        for error in summary["errors"]:
+            self.stderr.write(f"  row {error['row']}: {error['error']}")
+        if summary["failed"] > len(summary["errors"]):
+            self.stderr.write(f"  ... and {summary['failed'] - len(summary['errors'])} more")
+        verb = "Would import" if options["dry_run"] else "Imported"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} {summary['created']} of {summary['rows']} appointments, {summary['failed']} failed"
+            )
+        )
@@ -0,0 +1,60 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from appointments.partitioning import (
+    convert_to_partitioned,
+    ensure_partitions,
+    is_partitioned,
+    month_start,
+    next_month,
+)
+from core.db import is_postgres
+
+
+class Command(BaseCommand):
+    help = (
+        "Partitions the appointment table by month on PostgreSQL and creates "
+        "the partitions for the coming months. Run monthly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert",
+            action="store_true",
+            help="Rebuild an unpartitioned table as a partitioned one. Locks the table while rows are copied.",
+        )
+        parser.add_argument("--months-ahead", type=int, default=3)
+
+    def handle(self, *args, **options):
+        if not is_postgres():
+            raise CommandError("Partitioning is only supported on PostgreSQL.")
+
+        last_month = month_start(date.today())
+        for _ in range(options["months_ahead"]):
+            last_month = next_month(last_month)
+
+        with transaction.atomic():
+            if not is_partitioned():
+                if not options["convert"]:
+                    raise CommandError(
+                        "The appointment table is not partitioned yet. Run with --convert."
+                    )
+                dropped = convert_to_partitioned(options["months_ahead"])
+                self.stdout.write(self.style.SUCCESS("Converted the appointment table"))
+                for name in dropped:
+                    self.stdout.write(
+                        self.style.WARNING(f"Dropped foreign key {name} that referenced appointments")
+                    )
+                if dropped:
+                    self.stdout.write(
+                        "A partitioned table cannot be referenced by those foreign keys. "
+                        "Delete appointments only through Django, which applies on_delete itself."
+                    )
+                return
+
+            created = ensure_partitions(date.today(), last_month)
+        self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions"))
+        for name in created:
+            self.stdout.write(f"  {name}")
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from core.db import PostgresRunSQL, is_postgres
+
+
+def backfill_slot_range(apps, schema_editor):
+    Appointment = apps.get_model("appointments", "Appointment")
+    batch = []
+    queryset = Appointment.objects.only("appointment_date", "appointment_time", "duration")
+    for appointment in queryset.iterator(chunk_size=2000):
+        starts_at = timezone.make_aware(
+            datetime.combine(appointment.appointment_date, appointment.appointment_time)
+        )
+        appointment.starts_at = starts_at
+        appointment.ends_at = starts_at + timedelta(minutes=appointment.duration)
+        batch.append(appointment)
+        if len(batch) >= 2000:
+            Appointment.objects.bulk_update(batch, ["starts_at", "ends_at"])
+            batch = []
+    if batch:
+        Appointment.objects.bulk_update(batch, ["starts_at", "ends_at"])
+
+
+SLOT_RANGE = "tstzrange(starts_at, ends_at, '[)')"
+BLOCKING = "is_active AND status <> 'canceled'"
+# Overlapping pairs listed when the constraints cannot be added
+MAX_LISTED_CONFLICTS = 50
+
+
+def check_slot_conflicts(apps, schema_editor):
+    """
+    The old validator let some overlapping bookings through. The exclusion
+    constraints cannot be added while any are left, so list them and stop
+    with instructions instead of failing halfway on the constraint.
+    """
+    if not is_postgres(schema_editor.connection):
+        return
+    conflicts = []
+    with schema_editor.connection.cursor() as cursor:
+        for column in ("doctor_id", "patient_id"):
+            cursor.execute(
+                f"""
+                SELECT a.{column}, a.id, a.starts_at, a.ends_at, b.id, b.starts_at, b.ends_at
+                FROM appointments_appointment a
+                JOIN appointments_appointment b
+                  ON b.{column} = a.{column} AND b.id > a.id
+                 AND b.starts_at < a.ends_at AND a.starts_at < b.ends_at
+                WHERE a.is_active AND a.status <> 'canceled'
+                  AND b.is_active AND b.status <> 'canceled'
+                ORDER BY a.{column}, a.starts_at
+                LIMIT %s
+                """,
+                [MAX_LISTED_CONFLICTS],
+            )
+            conflicts += [
+                (column.removesuffix("_id"), owner_id, a_id, *map(timezone.localtime, (a_start, a_end)),
+                 b_id, *map(timezone.localtime, (b_start, b_end)))
+                for owner_id, a_id, a_start, a_end, b_id, b_start, b_end in cursor.fetchall()
+            ]
+    if conflicts:
+        lines = [
+            f"  {owner} {owner_id}: appointment {a_id} ({a_start:%Y-%m-%d %H:%M}-{a_end:%H:%M}) "
+            f"overlaps appointment {b_id} ({b_start:%Y-%m-%d %H:%M}-{b_end:%H:%M})"
+            for owner, owner_id, a_id, a_start, a_end, b_id, b_start, b_end in conflicts
+        ]
+        raise RuntimeError(
+            "Cannot add the appointment slot constraints: these active appointments overlap "
+            f"(at most {MAX_LISTED_CONFLICTS} pairs per doctor and patient are listed):\n"
+            + "\n".join(lines)
+            + "\nMove, cancel or deactivate one appointment of each pair, then run migrate again."
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0002_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="appointment",
+            name="starts_at",
+            field=models.DateTimeField(editable=False, null=True, verbose_name="starts at"),
+        ),
+        migrations.AddField(
+            model_name="appointment",
+            name="ends_at",
+            field=models.DateTimeField(editable=False, null=True, verbose_name="ends at"),
+        ),
+        migrations.RunPython(backfill_slot_range, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="appointment",
+            name="starts_at",
+            field=models.DateTimeField(editable=False, verbose_name="starts at"),
+        ),
+        migrations.AlterField(
+            model_name="appointment",
+            name="ends_at",
+            field=models.DateTimeField(editable=False, verbose_name="ends at"),
+        ),
+        migrations.RunPython(check_slot_conflicts, migrations.RunPython.noop),
+        PostgresRunSQL(
+            "CREATE EXTENSION IF NOT EXISTS btree_gist;",
+            migrations.RunSQL.noop,
+        ),
+        PostgresRunSQL(
+            f"""
+            ALTER TABLE appointments_appointment
+            ADD CONSTRAINT appointments_doctor_slot_excl
+            EXCLUDE USING gist (doctor_id WITH =, {SLOT_RANGE} WITH &&)
+            WHERE ({BLOCKING});
+            """,
+            "ALTER TABLE appointments_appointment DROP CONSTRAINT appointments_doctor_slot_excl;",
+        ),
+        PostgresRunSQL(
+            f"""
+            ALTER TABLE appointments_appointment
+            ADD CONSTRAINT appointments_patient_slot_excl
+            EXCLUDE USING gist (patient_id WITH =, {SLOT_RANGE} WITH &&)
+            WHERE ({BLOCKING});
+            """,
+            "ALTER TABLE appointments_appointment DROP CONSTRAINT appointments_patient_slot_excl;",
+        ),
+    ]
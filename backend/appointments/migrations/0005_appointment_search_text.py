@@ -0,0 +1,54 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Concat, Lower
+
+from core.db import PostgresRunSQL
+
+
+def backfill_search_text(apps, schema_editor):
+    Appointment = apps.get_model("appointments", "Appointment")
+    Patient = apps.get_model("patients", "Patient")
+    User = apps.get_model("users", "User")
+    patient_name = Patient.objects.filter(pk=OuterRef("patient_id")).values(
+        name=Concat("first_name", Value(" "), "last_name")
+    )[:1]
+    doctor_name = User.objects.filter(doctor_profile=OuterRef("doctor_id")).values(
+        name=Concat("first_name", Value(" "), "last_name")
+    )[:1]
+    Appointment.objects.update(
+        search_text=Lower(
+            Concat(
+                Subquery(patient_name),
+                Value(" "),
+                Subquery(doctor_name),
+                output_field=models.TextField(),
+            )
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("appointments", "0004_appointment_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="appointment",
+            name="search_text",
+            field=models.TextField(default="", editable=False, verbose_name="search text"),
+        ),
+        migrations.RunPython(backfill_search_text, migrations.RunPython.noop),
+        PostgresRunSQL(
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            migrations.RunSQL.noop,
+        ),
+        PostgresRunSQL(
+            """
+            CREATE INDEX appt_search_trgm_idx ON appointments_appointment
+            USING gin (search_text gin_trgm_ops) WHERE is_active;
+            """,
+            "DROP INDEX IF EXISTS appt_search_trgm_idx;",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 19:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0006_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='archived',
+            field=models.BooleanField(default=False, editable=False, verbose_name='archived'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2 on 2026-10-18 19:28
+
+import django.core.validators
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0007_appointment_archived'),
+        ('doctors', '0003_alter_doctor_bio_alter_doctor_license_number_and_more'),
+        ('patients', '0006_merge_20250428_2231'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WaitlistEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='entry ID')),
+                ('date_from', models.DateField(verbose_name='earliest date')),
+                ('date_to', models.DateField(verbose_name='latest date')),
+                ('time_from', models.TimeField(blank=True, null=True, verbose_name='earliest time')),
+                ('time_to', models.TimeField(blank=True, null=True, verbose_name='latest time')),
+                ('duration', models.PositiveIntegerField(default=30, validators=[django.core.validators.MinValueValidator(1)], verbose_name='duration (minutes)')),
+                ('priority', models.PositiveSmallIntegerField(default=0, verbose_name='priority')),
+                ('auto_book', models.BooleanField(default=False, verbose_name='auto book')),
+                ('billing_amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True, verbose_name='billing amount')),
+                ('billing_method', models.CharField(default='Cash', max_length=50, verbose_name='billing method')),
+                ('notes', models.TextField(blank=True, null=True, verbose_name='notes')),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('offered', 'Offered'), ('booked', 'Booked'), ('withdrawn', 'Withdrawn')], default='waiting', max_length=20, verbose_name='status')),
+                ('offered_date', models.DateField(blank=True, null=True, verbose_name='offered date')),
+                ('offered_time', models.TimeField(blank=True, null=True, verbose_name='offered time')),
+                ('offered_duration', models.PositiveIntegerField(blank=True, null=True, verbose_name='offered duration (minutes)')),
+                ('offered_at', models.DateTimeField(blank=True, null=True, verbose_name='offered at')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+                ('appointment', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='appointments.appointment', verbose_name='appointment')),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name='waitlist_entries', to=settings.AUTH_USER_MODEL, verbose_name='created by')),
+                ('doctor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to='doctors.doctor', verbose_name='doctor')),
+                ('offered_doctor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='doctors.doctor', verbose_name='offered doctor')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to='patients.patient', verbose_name='patient')),
+                ('specialization', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='waitlist_entries', to='doctors.specialization', verbose_name='specialization')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('doctor__isnull', False), ('status', 'waiting')), fields=['doctor', '-priority', 'created_at'], name='waitlist_doctor_queue_idx'), models.Index(condition=models.Q(('doctor__isnull', True), ('status', 'waiting')), fields=['specialization', '-priority', 'created_at'], name='waitlist_spec_queue_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(('doctor__isnull', False), ('specialization__isnull', False), _connector='OR'), name='waitlist_doctor_or_specialization')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2 on 2026-10-18 19:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0008_waitlistentry'),
+        ('doctors', '0003_alter_doctor_bio_alter_doctor_license_number_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appointment_date', models.DateField(verbose_name='appointment date')),
+                ('from_status', models.CharField(choices=[('scheduled', 'Scheduled'), ('completed', 'Completed'), ('canceled', 'Canceled'), ('in_queue', 'In Queue')], max_length=20, verbose_name='from status')),
+                ('to_status', models.CharField(choices=[('scheduled', 'Scheduled'), ('completed', 'Completed'), ('canceled', 'Canceled'), ('in_queue', 'In Queue')], max_length=20, verbose_name='to status')),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='occurred at')),
+                ('appointment', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='status_events', to='appointments.appointment', verbose_name='appointment')),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='changed by')),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='appointment_status_events', to='doctors.doctor', verbose_name='doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['appointment_date', 'doctor'], name='appt_event_day_doctor_idx')],
+            },
+        ),
+    ]
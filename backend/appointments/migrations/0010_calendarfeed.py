@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 19:45
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0009_appointmentstatusevent'),
+        ('doctors', '0003_alter_doctor_bio_alter_doctor_license_number_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CalendarFeed',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, unique=True, verbose_name='token')),
+                ('issued_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='issued at')),
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='calendar_feed', to='doctors.doctor', verbose_name='doctor')),
+            ],
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2 on 2026-10-18 19:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from core.db import PostgresRunSQL
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0010_calendarfeed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Resource',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='name')),
+                ('kind', models.CharField(choices=[('room', 'Room'), ('equipment', 'Equipment')], max_length=20, verbose_name='kind')),
+                ('description', models.TextField(blank=True, default='', verbose_name='description')),
+                ('is_active', models.BooleanField(default=True, verbose_name='is active')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated at')),
+            ],
+            options={
+                'ordering': ['kind', 'name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ResourceBooking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('starts_at', models.DateTimeField(verbose_name='starts at')),
+                ('ends_at', models.DateTimeField(verbose_name='ends at')),
+                ('blocking', models.BooleanField(default=True, verbose_name='blocking')),
+                ('appointment', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='resource_bookings', to='appointments.appointment', verbose_name='appointment')),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='bookings', to='appointments.resource', verbose_name='resource')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='resources',
+            field=models.ManyToManyField(blank=True, related_name='appointments', through='appointments.ResourceBooking', to='appointments.resource', verbose_name='resources'),
+        ),
+        migrations.AddIndex(
+            model_name='resourcebooking',
+            index=models.Index(condition=models.Q(('blocking', True)), fields=['resource', 'ends_at'], name='resource_booking_busy_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='resourcebooking',
+            constraint=models.UniqueConstraint(fields=('appointment', 'resource'), name='unique_resource_per_appointment'),
+        ),
+        # Backs the resource check in AppointmentSerializer.validate against
+        # concurrent bookings, like the slot constraints of migration 0003
+        PostgresRunSQL(
+            """
+            ALTER TABLE appointments_resourcebooking
+            ADD CONSTRAINT appointments_resource_slot_excl
+            EXCLUDE USING gist (resource_id WITH =, tstzrange(starts_at, ends_at, '[)') WITH &&)
+            WHERE (blocking);
+            """,
+            "ALTER TABLE appointments_resourcebooking DROP CONSTRAINT appointments_resource_slot_excl;",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0011_resources'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='calendarfeed',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='version'),
+        ),
+    ]
@@ -1,12 +1,110 @@
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator
 
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Concat, Lower
+
 from patients.models import Patient
 from doctors.models import Doctor
 from medications.models import Medication
+from users.models import User
 
 import uuid
+from datetime import datetime, timedelta
+
+
+# SQLSTATE raised by PostgreSQL when an exclusion constraint is violated.
+EXCLUSION_VIOLATION = "23P01"
+
+
+def is_slot_conflict(error):
+    """
+    Return True if an IntegrityError was raised by one of the slot exclusion
+    constraints, i.e. a concurrent booking took the same time range.
+    """
+    return getattr(error.__cause__, "pgcode", None) == EXCLUSION_VIOLATION
+
+
+def build_search_text(patient, doctor_user):
+    """
+    Lowercased patient and doctor names, as stored in Appointment.search_text.
+    """
+    return (
+        f"{patient.first_name} {patient.last_name} "
+        f"{doctor_user.first_name} {doctor_user.last_name}"
+    ).lower()
+
+
+class AppointmentQuerySet(models.QuerySet):
+    def blocking(self):
+        """
+        Appointments that occupy their slot. Canceled and deleted
+        appointments free the time range they were booked for.
+        """
+        return self.filter(is_active=True).exclude(status="canceled")
+
+    def with_details(self):
+        """
+        Load everything AppointmentSerializer renders, so that serializing a
+        page costs a fixed number of queries whatever its size. Payments are
+        prefetched into ``payments`` and resources into ``booked_resources``.
+        """
+        return self.select_related(
+            "patient", "doctor__user", "doctor__specialization", "created_by"
+        ).prefetch_related(
+            models.Prefetch("payment_set", to_attr="payments"),
+            models.Prefetch("resources", to_attr="booked_resources"),
+        )
+
+    def refresh_search_text(self):
+        """
+        Rebuild search_text from the current patient and doctor names with a
+        single UPDATE, e.g. after a rename. The rows count as updated, so the
+        calendar ETag built from updated_at changes with the names it shows.
+        """
+        patient_name = Patient.objects.filter(pk=OuterRef("patient_id")).values(
+            name=Concat("first_name", Value(" "), "last_name")
+        )[:1]
+        doctor_name = User.objects.filter(doctor_profile=OuterRef("doctor_id")).values(
+            name=Concat("first_name", Value(" "), "last_name")
+        )[:1]
+        return self.update(
+            search_text=Lower(
+                Concat(
+                    Subquery(patient_name),
+                    Value(" "),
+                    Subquery(doctor_name),
+                    output_field=models.TextField(),
+                )
+            ),
+            updated_at=timezone.now(),
+        )
+
+    def live(self):
+        """
+        Appointments that have not been archived. On a partitioned table this
+        predicate limits the scan to the live partitions.
+        """
+        return self.filter(archived=False)
+
+    def archivable(self, before):
+        """
+        Live appointments dated before `before` that are deleted or completed
+        and can be moved to the archive.
+        """
+        return self.live().filter(
+            models.Q(is_active=False) | models.Q(status="completed"),
+            appointment_date__lt=before,
+        )
+
+    def overlapping(self, starts_at, ends_at):
+        """
+        Appointments whose [starts_at, ends_at) range overlaps the given one.
+        """
+        return self.filter(starts_at__lt=ends_at, ends_at__gt=starts_at)
 
 
 class Appointment(models.Model):
@@ -21,6 +119,20 @@ class Appointment(models.Model):
         ("in_queue", "In Queue"),
     ]
 
+    # Allowed status changes; completed and canceled are final
+    STATUS_TRANSITIONS = {
+        "scheduled": {"in_queue", "completed", "canceled"},
+        "in_queue": {"completed", "canceled"},
+        "completed": set(),
+        "canceled": set(),
+    }
+
+    # Payment status that follows an appointment status change
+    PAYMENT_STATUS_FOR = {
+        "completed": "Paid",
+        "canceled": "Failed",
+    }
+
     appointment_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name=_("appointment ID"))
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="appointments", verbose_name=_("patient"))
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name="appointments", verbose_name=_("doctor"))
@@ -34,4 +146,328 @@ class Appointment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("created at"))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_("updated at"))
 
+    # Denormalized slot range, kept in sync by save(). On PostgreSQL the
+    # (doctor, range) and (patient, range) pairs are guarded by GiST
+    # exclusion constraints, see migration 0003.
+    starts_at = models.DateTimeField(editable=False, verbose_name=_("starts at"))
+    ends_at = models.DateTimeField(editable=False, verbose_name=_("ends at"))
+
+    # Denormalized names for the trigram-indexed search, see migration 0005
+    search_text = models.TextField(default="", editable=False, verbose_name=_("search text"))
+
+    # Set by the archive_appointments command. On a partitioned PostgreSQL
+    # table archived rows live in their own partition, see partitioning.py.
+    archived = models.BooleanField(default=False, editable=False, verbose_name=_("archived"))
+
+    # Rooms and devices held for the slot, see ResourceBooking
+    resources = models.ManyToManyField("Resource", through="ResourceBooking", blank=True, related_name="appointments", verbose_name=_("resources"))
+
+    SLOT_FIELDS = ("appointment_date", "appointment_time", "duration")
+    SEARCH_FIELDS = ("patient", "doctor")
+    # Fields copied onto the appointment's resource bookings
+    BOOKING_FIELDS = SLOT_FIELDS + ("status", "is_active")
+    ROLLUP_FIELDS = ("appointment_date", "doctor_id", "status", "is_active", "archived")
+
+    class Meta:
+        indexes = [
+            # Default list ordering and keyset pagination
+            models.Index(
+                fields=["-appointment_date", "-id"],
+                condition=models.Q(is_active=True),
+                name="appt_active_date_idx",
+            ),
+            # Doctor-scoped lists
+            models.Index(
+                fields=["doctor", "-appointment_date", "-id"],
+                condition=models.Q(is_active=True),
+                name="appt_doctor_active_date_idx",
+            ),
+            models.Index(fields=["patient", "appointment_date"], name="appt_patient_date_idx"),
+            # Status filters and report queries
+            models.Index(fields=["status", "appointment_date"], name="appt_status_date_idx"),
+        ]
+
+    objects = AppointmentQuerySet.as_manager()
+
+    @staticmethod
+    def slot_bounds(appointment_date, appointment_time, duration):
+        """
+        Return the aware (starts_at, ends_at) datetimes of a slot.
+        """
+        starts_at = timezone.make_aware(datetime.combine(appointment_date, appointment_time))
+        return starts_at, starts_at + timedelta(minutes=int(duration))
+
+    def sync_slot(self):
+        """
+        Recompute starts_at/ends_at from the date, time and duration fields.
+        """
+        self.appointment_date = self._meta.get_field("appointment_date").to_python(self.appointment_date)
+        self.appointment_time = self._meta.get_field("appointment_time").to_python(self.appointment_time)
+        self.starts_at, self.ends_at = self.slot_bounds(
+            self.appointment_date, self.appointment_time, self.duration
+        )
+
+    def sync_search_text(self):
+        self.search_text = build_search_text(self.patient, self.doctor.user)
+
+    def sync_denormalized_fields(self):
+        """
+        Refresh every derived column. save() does this itself; it must be
+        called explicitly before bulk_create().
+        """
+        self.sync_slot()
+        self.sync_search_text()
+
+    @property
+    def is_blocking(self):
+        """
+        Whether the appointment holds its slot, as in AppointmentQuerySet.blocking().
+        """
+        return self.is_active and self.status != "canceled"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Moving an appointment to another doctor changes both calendars
+        instance._loaded_doctor_id = instance.__dict__.get("doctor_id")
+        # Changing these moves it between report rollups, see reports/rollups.py
+        instance._loaded_rollup_values = {
+            name: instance.__dict__.get(name) for name in cls.ROLLUP_FIELDS
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            self.sync_denormalized_fields()
+        else:
+            update_fields = set(update_fields)
+            if update_fields & set(self.SLOT_FIELDS):
+                self.sync_slot()
+                update_fields |= {"starts_at", "ends_at"}
+            if update_fields & set(self.SEARCH_FIELDS):
+                self.sync_search_text()
+                update_fields.add("search_text")
+            kwargs["update_fields"] = update_fields
+        super().save(*args, **kwargs)
+        if not adding and (update_fields is None or update_fields & set(self.BOOKING_FIELDS)):
+            self.resource_bookings.update(
+                starts_at=self.starts_at, ends_at=self.ends_at, blocking=self.is_blocking
+            )
+
+    def book_resources(self, resources):
+        """
+        Hold `resources` for the appointment's slot. For a new appointment.
+        """
+        ResourceBooking.objects.bulk_create(
+            ResourceBooking(
+                appointment=self,
+                resource=resource,
+                starts_at=self.starts_at,
+                ends_at=self.ends_at,
+                blocking=self.is_blocking,
+            )
+            for resource in resources
+        )
+
+    def set_resources(self, resources):
+        """
+        Hold exactly `resources`, releasing any other resource.
+        """
+        resources = list(resources)
+        self.resource_bookings.exclude(resource__in=resources).delete()
+        held = set(self.resource_bookings.values_list("resource_id", flat=True))
+        self.book_resources(resource for resource in resources if resource.pk not in held)
+
+
+class Resource(models.Model):
+    """
+    A room or a device that serves one appointment at a time.
+    """
+
+    KIND_CHOICES = [
+        ("room", "Room"),
+        ("equipment", "Equipment"),
+    ]
+
+    name = models.CharField(max_length=100, unique=True, verbose_name=_("name"))
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name=_("kind"))
+    description = models.TextField(blank=True, default="", verbose_name=_("description"))
+    is_active = models.BooleanField(default=True, verbose_name=_("is active"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("created at"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("updated at"))
+
+    class Meta:
+        ordering = ["kind", "name"]
+
+    def __str__(self):
+        return self.name
+
+
+class ResourceBooking(models.Model):
+    """
+    A resource held by an appointment. The slot range is copied from the
+    appointment, and kept in step by Appointment.save() and
+    transition_appointments, so the bookings of any number of resources are
+    checked with one probe of the (resource, ends_at) index. On PostgreSQL
+    a GiST exclusion constraint backs the check, see migration 0011.
+    """
+
+    # No database constraint, see WaitlistEntry.appointment
+    appointment = models.ForeignKey(Appointment, on_delete=models.CASCADE, db_constraint=False, related_name="resource_bookings", verbose_name=_("appointment"))
+    resource = models.ForeignKey(Resource, on_delete=models.PROTECT, related_name="bookings", verbose_name=_("resource"))
+    starts_at = models.DateTimeField(verbose_name=_("starts at"))
+    ends_at = models.DateTimeField(verbose_name=_("ends at"))
+    # False once the appointment is canceled or deleted
+    blocking = models.BooleanField(default=True, verbose_name=_("blocking"))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["appointment", "resource"], name="unique_resource_per_appointment"),
+        ]
+        indexes = [
+            models.Index(
+                # Bookings that end after a slot starts are the ones that can
+                # overlap it; past bookings are skipped
+                fields=["resource", "ends_at"],
+                condition=models.Q(blocking=True),
+                name="resource_booking_busy_idx",
+            ),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response of a booking made with an Idempotency-Key header, so a
+    retried request is answered from here instead of booking again.
+    """
+
+    TTL = timedelta(hours=24)
+
+    key = models.CharField(max_length=255, verbose_name=_("key"))
+    user = models.ForeignKey("users.User", on_delete=models.CASCADE, related_name="idempotency_keys", verbose_name=_("user"))
+    fingerprint = models.CharField(max_length=64, verbose_name=_("request fingerprint"))
+    response_status = models.PositiveSmallIntegerField(null=True, verbose_name=_("response status"))
+    response_body = models.JSONField(null=True, encoder=DjangoJSONEncoder, verbose_name=_("response body"))
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name=_("created at"))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "key"], name="unique_idempotency_key_per_user"),
+        ]
+
+    @property
+    def is_expired(self):
+        return self.created_at < timezone.now() - self.TTL
+
+
+class CalendarFeed(models.Model):
+    """
+    Secret token of a doctor's iCalendar feed. Calendar apps cannot log in,
+    so the token in the feed URL is the credential; rotating it revokes
+    every copy of the old URL. ``version`` goes up with every change to the
+    doctor's appointments, see ics.touch_calendars().
+    """
+
+    doctor = models.OneToOneField(Doctor, on_delete=models.CASCADE, related_name="calendar_feed", verbose_name=_("doctor"))
+    token = models.UUIDField(default=uuid.uuid4, unique=True, verbose_name=_("token"))
+    issued_at = models.DateTimeField(default=timezone.now, verbose_name=_("issued at"))
+    version = models.PositiveBigIntegerField(default=0, verbose_name=_("version"))
+
+    def rotate(self):
+        self.token = uuid.uuid4()
+        self.issued_at = timezone.now()
+        self.save(update_fields=["token", "issued_at"])
+
+
+class AppointmentStatusEvent(models.Model):
+    """
+    Append-only log of appointment status changes, written by
+    transition_appointments with one INSERT per batch. Used for wait-time
+    and consult-length analytics.
+    """
+
+    # No database constraint, see WaitlistEntry.appointment; events are kept
+    # when an appointment row goes away
+    appointment = models.ForeignKey(Appointment, on_delete=models.DO_NOTHING, db_constraint=False, related_name="status_events", verbose_name=_("appointment"))
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name="appointment_status_events", verbose_name=_("doctor"))
+    appointment_date = models.DateField(verbose_name=_("appointment date"))
+    from_status = models.CharField(max_length=20, choices=Appointment.APP_STATUS_CHOICES, verbose_name=_("from status"))
+    to_status = models.CharField(max_length=20, choices=Appointment.APP_STATUS_CHOICES, verbose_name=_("to status"))
+    changed_by = models.ForeignKey("users.User", on_delete=models.SET_NULL, null=True, blank=True, related_name="+", verbose_name=_("changed by"))
+    occurred_at = models.DateTimeField(default=timezone.now, verbose_name=_("occurred at"))
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["appointment_date", "doctor"], name="appt_event_day_doctor_idx"),
+        ]
+
+
+class WaitlistEntry(models.Model):
+    """
+    A patient waiting for a slot with a doctor, or with any doctor of a
+    specialization, inside a date and time-of-day window. When an appointment
+    is canceled the freed slot goes to the matching entry with the highest
+    priority, oldest first; see waitlist.py.
+    """
+
+    STATUS_CHOICES = [
+        ("waiting", "Waiting"),
+        ("offered", "Offered"),
+        ("booked", "Booked"),
+        ("withdrawn", "Withdrawn"),
+    ]
+
+    entry_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name=_("entry ID"))
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="waitlist_entries", verbose_name=_("patient"))
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, null=True, blank=True, related_name="waitlist_entries", verbose_name=_("doctor"))
+    specialization = models.ForeignKey("doctors.Specialization", on_delete=models.CASCADE, null=True, blank=True, related_name="waitlist_entries", verbose_name=_("specialization"))
+    date_from = models.DateField(verbose_name=_("earliest date"))
+    date_to = models.DateField(verbose_name=_("latest date"))
+    time_from = models.TimeField(null=True, blank=True, verbose_name=_("earliest time"))
+    time_to = models.TimeField(null=True, blank=True, verbose_name=_("latest time"))
+    duration = models.PositiveIntegerField(validators=[MinValueValidator(1)], default=30, verbose_name=_("duration (minutes)"))
+    priority = models.PositiveSmallIntegerField(default=0, verbose_name=_("priority"))
+    # Book the freed slot straight away instead of offering it
+    auto_book = models.BooleanField(default=False, verbose_name=_("auto book"))
+    billing_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, verbose_name=_("billing amount"))
+    billing_method = models.CharField(max_length=50, default="Cash", verbose_name=_("billing method"))
+    notes = models.TextField(null=True, blank=True, verbose_name=_("notes"))
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="waiting", verbose_name=_("status"))
+    offered_doctor = models.ForeignKey(Doctor, on_delete=models.SET_NULL, null=True, blank=True, related_name="+", verbose_name=_("offered doctor"))
+    offered_date = models.DateField(null=True, blank=True, verbose_name=_("offered date"))
+    offered_time = models.TimeField(null=True, blank=True, verbose_name=_("offered time"))
+    offered_duration = models.PositiveIntegerField(null=True, blank=True, verbose_name=_("offered duration (minutes)"))
+    offered_at = models.DateTimeField(null=True, blank=True, verbose_name=_("offered at"))
+    # No database constraint: a partitioned appointment table cannot be
+    # referenced by a foreign key, see partitioning.py
+    appointment = models.ForeignKey(Appointment, on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False, related_name="+", verbose_name=_("appointment"))
+    created_by = models.ForeignKey("users.User", on_delete=models.RESTRICT, related_name="waitlist_entries", verbose_name=_("created by"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("created at"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("updated at"))
+
+    class Meta:
+        indexes = [
+            # Waiting entries per doctor and per specialization, in the order
+            # they are served: highest priority first, then oldest
+            models.Index(
+                fields=["doctor", "-priority", "created_at"],
+                condition=models.Q(status="waiting", doctor__isnull=False),
+                name="waitlist_doctor_queue_idx",
+            ),
+            models.Index(
+                fields=["specialization", "-priority", "created_at"],
+                condition=models.Q(status="waiting", doctor__isnull=True),
+                name="waitlist_spec_queue_idx",
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(doctor__isnull=False) | models.Q(specialization__isnull=False),
+                name="waitlist_doctor_or_specialization",
+            ),
+        ]
 
+    def __str__(self):
+        return f"Waitlist {self.patient} ({self.status})"
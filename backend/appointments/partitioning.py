@@ -0,0 +1,292 @@
+"""
+Optional PostgreSQL partitioning of the appointment table.
+
+The ``partition_appointments --convert`` command turns
+appointments_appointment into a declaratively partitioned table:
+
+    appointments_appointment                 PARTITION BY LIST (archived)
+      appointments_appointment_archive       FOR VALUES IN (true)
+      appointments_appointment_live          FOR VALUES IN (false)
+                                             PARTITION BY RANGE (appointment_date)
+        appointments_appointment_live_y2025m01
+        ...
+        appointments_appointment_live_default
+
+Queries filtered with Appointment.objects.live() skip the archive, and a
+predicate on appointment_date further prunes them to the matching months.
+Rows move to the archive partition when archive_appointments sets
+``archived``.
+
+PostgreSQL requires every unique constraint of a partitioned table to include
+the partition keys, so:
+
+* the primary key becomes (id, archived, appointment_date) and the
+  appointment_id constraint (appointment_id, archived, appointment_date). Ids
+  still come from one sequence and stay unique.
+* foreign keys that reference appointments (payments, medical records) are
+  dropped and cannot be re-added: a foreign key must point at a unique
+  constraint, and the only ones left include archived and appointment_date,
+  which the referencing tables do not have. The appointment models' own
+  references are declared without one for the same reason. Django still
+  applies on_delete itself, so appointments must only be deleted through
+  the ORM, never with raw SQL.
+* the slot exclusion constraints of migration 0003 cannot span partitions.
+  They are created on every live partition instead, which only holds while
+  no slot runs from one month's partition into the next. The conversion adds
+  a CHECK constraint for that (SLOT_CHECK), and the booking paths reject such
+  slots up front on every database (crosses_partition()), so a table can be
+  partitioned at any time.
+"""
+
+from datetime import date, datetime, timedelta
+
+from django.db import connection as default_connection
+
+from core.db import is_postgres
+
+from .models import Appointment
+
+TABLE = Appointment._meta.db_table
+ARCHIVE = f"{TABLE}_archive"
+LIVE = f"{TABLE}_live"
+DEFAULT = f"{LIVE}_default"
+
+# A slot ends, exclusively, in the month it starts
+SLOT_CHECK = (
+    f'"{TABLE}_slot_within_month" CHECK ('
+    "date_trunc('month', appointment_date + appointment_time"
+    " + make_interval(mins => duration) - interval '1 microsecond')"
+    " = date_trunc('month', appointment_date::timestamp))"
+)
+CROSSES_PARTITION = "An appointment must end in the month it starts."
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def next_month(month):
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def partition_name(month):
+    return f"{LIVE}_y{month.year}m{month.month:02d}"
+
+
+def crosses_partition(appointment_date, appointment_time, duration):
+    """
+    Return True if the slot runs into the next month, and so into another
+    live partition, where the exclusion constraints could not see it.
+    """
+    last_moment = (
+        datetime.combine(appointment_date, appointment_time)
+        + timedelta(minutes=int(duration), microseconds=-1)
+    )
+    return month_start(last_moment.date()) != month_start(appointment_date)
+
+
+def is_partitioned(connection=None):
+    connection = connection or default_connection
+    if not is_postgres(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+        row = cursor.fetchone()
+    return row is not None and row[0] == "p"
+
+
+def table_exists(cursor, name):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+    return cursor.fetchone()[0]
+
+
+def constraints(cursor, table, types):
+    cursor.execute(
+        """
+        SELECT conname, contype, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = ANY(%s)
+        ORDER BY conname
+        """,
+        [table, list(types)],
+    )
+    return cursor.fetchall()
+
+
+def add_exclusions(cursor, partition, exclusions):
+    """
+    Add the slot exclusion constraints, given as (suffix, definition) pairs,
+    to one live partition.
+    """
+    for suffix, definition in exclusions:
+        cursor.execute(
+            f'ALTER TABLE "{partition}" ADD CONSTRAINT "{partition}_{suffix}" {definition}'
+        )
+
+
+def template_exclusions(cursor):
+    # The default partition always exists and carries the current set
+    return [
+        (name[len(DEFAULT) + 1 :], definition)
+        for name, _, definition in constraints(cursor, DEFAULT, "x")
+    ]
+
+
+def create_month_partition(cursor, month, exclusions):
+    """
+    Create the live partition for one month, moving any rows of that month
+    out of the default partition. Returns False if it already exists.
+    """
+    name = partition_name(month)
+    if table_exists(cursor, name):
+        return False
+    bounds = f"FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+    cursor.execute(
+        f'SELECT EXISTS (SELECT 1 FROM "{DEFAULT}" '
+        "WHERE appointment_date >= %s AND appointment_date < %s)",
+        [month, next_month(month)],
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{LIVE}" FOR VALUES {bounds}')
+        add_exclusions(cursor, name, exclusions)
+        return True
+
+    # Attaching a range that the default partition holds rows for fails, so
+    # take the default partition out while its rows are moved over
+    cursor.execute(f'ALTER TABLE "{LIVE}" DETACH PARTITION "{DEFAULT}"')
+    cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{LIVE}" FOR VALUES {bounds}')
+    add_exclusions(cursor, name, exclusions)
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{DEFAULT}" '
+        "WHERE appointment_date >= %s AND appointment_date < %s RETURNING *) "
+        f'INSERT INTO "{LIVE}" SELECT * FROM moved',
+        [month, next_month(month)],
+    )
+    cursor.execute(f'ALTER TABLE "{LIVE}" ATTACH PARTITION "{DEFAULT}" DEFAULT')
+    return True
+
+
+def ensure_partitions(first_month, last_month, connection=None):
+    """
+    Create the missing monthly live partitions from first_month through
+    last_month. Returns the names of the partitions created.
+    """
+    connection = connection or default_connection
+    created = []
+    with connection.cursor() as cursor:
+        exclusions = template_exclusions(cursor)
+        month = month_start(first_month)
+        while month <= last_month:
+            if create_month_partition(cursor, month, exclusions):
+                created.append(partition_name(month))
+            month = next_month(month)
+    return created
+
+
+def convert_to_partitioned(months_ahead=3, connection=None):
+    """
+    Rebuild the appointment table as a partitioned table and copy every row
+    over. Must run inside a transaction; the table is locked until it ends.
+
+    Returns the names of the dropped foreign keys that referenced it.
+    """
+    connection = connection or default_connection
+    old = f"{TABLE}_unpartitioned"
+    with connection.cursor() as cursor:
+        cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+        # Check the deferred foreign keys of earlier writes in this
+        # transaction now, ALTER TABLE refuses to run with pending trigger
+        # events
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+
+        table_constraints = constraints(cursor, TABLE, "pufcx")
+        cursor.execute(
+            """
+            SELECT pg_get_indexdef(indexrelid)
+            FROM pg_index
+            WHERE indrelid = %s::regclass
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+            """,
+            [TABLE],
+        )
+        index_definitions = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            """
+            SELECT conname, conrelid::regclass::text
+            FROM pg_constraint
+            WHERE confrelid = %s::regclass AND contype = 'f'
+            """,
+            [TABLE],
+        )
+        referencing = cursor.fetchall()
+        for name, table in referencing:
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{old}"')
+        cursor.execute(f'ALTER TABLE "{old}" ALTER COLUMN id DROP IDENTITY IF EXISTS')
+        cursor.execute(f'ALTER TABLE "{old}" ALTER COLUMN id DROP DEFAULT')
+        cursor.execute(f'DROP SEQUENCE IF EXISTS "{TABLE}_id_seq"')
+
+        cursor.execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{old}" INCLUDING DEFAULTS INCLUDING STORAGE) '
+            "PARTITION BY LIST (archived)"
+        )
+        cursor.execute(f'CREATE SEQUENCE "{TABLE}_id_seq" OWNED BY "{TABLE}".id')
+        # Fails the conversion if an existing slot already crosses a month
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT {SLOT_CHECK}')
+        cursor.execute(
+            f"ALTER TABLE \"{TABLE}\" ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')"
+        )
+
+        exclusions = []
+        for name, contype, definition in table_constraints:
+            if contype in "pux":
+                # Frees the names of the indexes behind them
+                cursor.execute(f'ALTER TABLE "{old}" DROP CONSTRAINT "{name}"')
+            if contype == "p":
+                cursor.execute(
+                    f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" '
+                    "PRIMARY KEY (id, archived, appointment_date)"
+                )
+            elif contype == "u":
+                # Only appointment_id is unique on the model
+                cursor.execute(
+                    f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" '
+                    "UNIQUE (appointment_id, archived, appointment_date)"
+                )
+            elif contype == "x":
+                exclusions.append((name.removeprefix(f"{Appointment._meta.app_label}_"), definition))
+            else:
+                cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+
+        cursor.execute(f'CREATE TABLE "{ARCHIVE}" PARTITION OF "{TABLE}" FOR VALUES IN (true)')
+        cursor.execute(
+            f'CREATE TABLE "{LIVE}" PARTITION OF "{TABLE}" FOR VALUES IN (false) '
+            "PARTITION BY RANGE (appointment_date)"
+        )
+        cursor.execute(f'CREATE TABLE "{DEFAULT}" PARTITION OF "{LIVE}" DEFAULT')
+        add_exclusions(cursor, DEFAULT, exclusions)
+
+        cursor.execute(f'SELECT min(appointment_date) FROM "{old}" WHERE NOT archived')
+        first_month = cursor.fetchone()[0] or date.today()
+        last_month = month_start(date.today())
+        for _ in range(months_ahead):
+            last_month = next_month(last_month)
+        month = month_start(first_month)
+        while month <= last_month:
+            create_month_partition(cursor, month, exclusions)
+            month = next_month(month)
+
+        cursor.execute(f'INSERT INTO "{TABLE}" SELECT * FROM "{old}"')
+        cursor.execute(
+            f"SELECT setval('{TABLE}_id_seq', COALESCE(max(id), 0) + 1, false) FROM \"{TABLE}\""
+        )
+        cursor.execute(f'DROP TABLE "{old}"')
+        # Run the deferred foreign key checks of the copy now, CREATE INDEX
+        # refuses to run with pending trigger events
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        # Indexes on the parent are created on every partition
+        for definition in index_definitions:
+            cursor.execute(definition)
+        cursor.execute(f'ANALYZE "{TABLE}"')
+    return [name for name, _ in referencing]
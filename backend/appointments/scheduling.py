@@ -0,0 +1,142 @@
+"""
+Slot search helpers.
+
+Busy ranges for every requested doctor are loaded in one query and the free
+slots are found with an in-memory sweep over each doctor's sorted ranges.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import islice
+
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Appointment
+
+
+def busy_ranges(doctor_ids, window_start, window_end, patient=None):
+    """
+    Return {doctor_id: [(starts_at, ends_at), ...]} sorted by start, for all
+    blocking appointments of the doctors that overlap the window. When a
+    patient is given, the patient's own appointments block every doctor.
+    """
+    owners = Q(doctor_id__in=doctor_ids)
+    if patient is not None:
+        owners |= Q(patient=patient)
+    queryset = Appointment.objects.blocking().overlapping(window_start, window_end).filter(owners)
+
+    ranges = defaultdict(list)
+    shared = []
+    rows = queryset.order_by("starts_at").values_list("doctor_id", "patient_id", "starts_at", "ends_at")
+    for doctor_id, patient_id, starts_at, ends_at in rows:
+        if patient is not None and patient_id == patient.pk:
+            shared.append((starts_at, ends_at))
+        else:
+            ranges[doctor_id].append((starts_at, ends_at))
+
+    if shared:
+        for doctor_id in doctor_ids:
+            ranges[doctor_id] = sorted(ranges[doctor_id] + shared)
+    return ranges
+
+
+def sweep_free_slots(busy, day_start, day_end, duration, step, not_before=None):
+    """
+    Yield the start of every free slot of `duration` within [day_start,
+    day_end), aligned to `step` from day_start, given sorted busy ranges.
+    """
+    cursor = day_start
+    if not_before is not None and not_before > cursor:
+        # Round up to the next step boundary
+        steps = -(-(not_before - day_start) // step)
+        cursor = day_start + steps * step
+
+    for busy_start, busy_end in busy:
+        if busy_end <= cursor:
+            continue
+        if busy_start >= day_end:
+            break
+        while cursor + duration <= min(busy_start, day_end):
+            yield cursor
+            cursor += step
+        if busy_end > cursor:
+            steps = -(-(busy_end - day_start) // step)
+            cursor = day_start + steps * step
+
+    while cursor + duration <= day_end:
+        yield cursor
+        cursor += step
+
+
+def find_free_slots(doctors, date_from, date_to, duration, day_start, day_end, step, patient=None):
+    """
+    Return a list of {"doctor", "date", "slots"} entries, one per doctor and
+    day with at least one free slot. `duration` and `step` are timedeltas and
+    `day_start`/`day_end` the working hours as times.
+    """
+    window_start = timezone.make_aware(datetime.combine(date_from, day_start))
+    window_end = timezone.make_aware(datetime.combine(date_to, day_end))
+    busy = busy_ranges([doctor.pk for doctor in doctors], window_start, window_end, patient)
+    now = timezone.now()
+
+    results = []
+    for doctor in doctors:
+        doctor_busy = busy.get(doctor.pk, [])
+        first = 0
+        day = date_from
+        while day <= date_to:
+            opens = timezone.make_aware(datetime.combine(day, day_start))
+            closes = timezone.make_aware(datetime.combine(day, day_end))
+            # Days are visited in order, so ranges that ended before today
+            # never need to be swept again.
+            while first < len(doctor_busy) and doctor_busy[first][1] <= opens:
+                first += 1
+            slots = list(
+                sweep_free_slots(islice(doctor_busy, first, None), opens, closes, duration, step, not_before=now)
+            )
+            if slots:
+                results.append({"doctor": doctor, "date": day, "slots": slots})
+            day += timedelta(days=1)
+    return results
+
+
+def batch_conflicts(slots, doctor, patient):
+    """
+    Check a batch of (starts_at, ends_at) slots for one doctor and patient.
+
+    Returns {index: message} for every slot that overlaps another slot of the
+    batch or an existing booking, using one query for the whole batch.
+    """
+    errors = {}
+
+    # Every slot of the batch shares the doctor and patient, so any overlap
+    # inside the batch is a conflict.
+    order = sorted(range(len(slots)), key=lambda i: slots[i][0])
+    latest_end = None
+    for i in order:
+        starts_at, ends_at = slots[i]
+        if latest_end is not None and starts_at < latest_end:
+            errors[i] = "Overlaps another appointment in this batch"
+        latest_end = max(latest_end, ends_at) if latest_end else ends_at
+
+    windows = Q()
+    for starts_at, ends_at in slots:
+        windows |= Q(starts_at__lt=ends_at, ends_at__gt=starts_at)
+    existing = list(
+        Appointment.objects.blocking()
+        .filter(Q(doctor=doctor) | Q(patient=patient))
+        .filter(windows)
+        .values_list("doctor_id", "starts_at", "ends_at")
+    )
+    for i, (starts_at, ends_at) in enumerate(slots):
+        for doctor_id, busy_start, busy_end in existing:
+            if busy_start < ends_at and starts_at < busy_end:
+                errors.setdefault(
+                    i,
+                    "Doctor already has an appointment at this time"
+                    if doctor_id == doctor.pk
+                    else "Patient already has an appointment at this time",
+                )
+                break
+    return errors
@@ -1,9 +1,39 @@
+from contextlib import contextmanager
+from datetime import time, timedelta
+from decimal import Decimal
 from rest_framework import serializers
-from django.utils import timezone
-from django.core.exceptions import ValidationError
-from .models import Appointment
+from rest_framework.exceptions import NotFound
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from .ics import touch_calendars
+from .importing import FORMATS as IMPORT_FORMATS
+from .models import Appointment, Resource, ResourceBooking, WaitlistEntry, is_slot_conflict
+from .partitioning import CROSSES_PARTITION, crosses_partition
+from .scheduling import batch_conflicts
 from patients.models import Patient
-from doctors.models import Doctor
+from doctors.models import Doctor, Specialization
+from reports.rollups import Deltas
+
+
+BILLING_METHODS = ["Cash", "Credit Card", "Debit Card", "Insurance"]
+
+
+@contextmanager
+def slot_conflict_guard():
+    """
+    Run the wrapped writes atomically and turn a slot exclusion violation,
+    i.e. a booking that raced past validation, into a validation error.
+    """
+    try:
+        # No savepoint: a conflict always aborts the enclosing transaction
+        with transaction.atomic(savepoint=False):
+            yield
+    except IntegrityError as e:
+        if not is_slot_conflict(e):
+            raise
+        raise serializers.ValidationError(
+            {"appointment_time": "This time slot has just been booked"}
+        )
 
 
 class SimplePatientSerializer(serializers.Serializer):
@@ -62,6 +92,19 @@ class SimplePaymentSerializer(serializers.Serializer):
     updated_at = serializers.DateTimeField()
 
 
+class SimpleResourceSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    kind = serializers.CharField()
+
+
+class ResourceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Resource
+        fields = ["id", "name", "kind", "description", "is_active", "created_at", "updated_at"]
+        read_only_fields = ["is_active", "created_at", "updated_at"]
+
+
 class PatientChoiceField(serializers.PrimaryKeyRelatedField):
     def display_value(self, instance):
         return f"{instance.first_name} {instance.last_name}"
@@ -77,6 +120,8 @@ class AppointmentSerializer(serializers.ModelSerializer):
     doctor_name = serializers.SerializerMethodField()
     created_by_name = serializers.SerializerMethodField()
     payment = serializers.SerializerMethodField()
+    resources = serializers.SerializerMethodField()
+    no_show_risk = serializers.SerializerMethodField()
 
     # Nested serializers for related fields
     patient = SimplePatientSerializer(read_only=True)
@@ -84,16 +129,28 @@ class AppointmentSerializer(serializers.ModelSerializer):
     created_by = SimpleUserSerializer(read_only=True)
 
     # Add writeable fields for patient and doctor
+    # Optional when the view already resolved the patient and passed it in
+    # the serializer context
     patient_id = PatientChoiceField(
         queryset=Patient.objects.filter(is_active=True),
         source="patient",
         write_only=True,
+        required=False,
     )
     doctor_id = DoctorChoiceField(
-        queryset=Doctor.objects.filter(user__is_active=True),
+        queryset=Doctor.objects.filter(user__is_active=True).select_related(
+            "user", "specialization"
+        ),
         source="doctor",
         write_only=True,
     )
+    resource_ids = serializers.PrimaryKeyRelatedField(
+        queryset=Resource.objects.filter(is_active=True),
+        source="resources",
+        many=True,
+        write_only=True,
+        required=False,
+    )
 
     class Meta:
         model = Appointment
@@ -117,6 +174,9 @@ class AppointmentSerializer(serializers.ModelSerializer):
             "doctor_name",
             "created_by_name",
             "payment",
+            "resources",
+            "resource_ids",
+            "no_show_risk",
         ]
         read_only_fields = [
             "appointment_id",
@@ -130,6 +190,8 @@ class AppointmentSerializer(serializers.ModelSerializer):
             "doctor",
             "created_by",
             "payment",
+            "resources",
+            "no_show_risk",
         ]
 
     def get_patient_name(self, obj):
@@ -142,20 +204,99 @@ class AppointmentSerializer(serializers.ModelSerializer):
         return f"{obj.created_by.first_name} {obj.created_by.last_name}"
 
     def get_payment(self, obj):
-        try:
-            from billing.models import Payment
-
-            payment = Payment.objects.get(appointment=obj)
-            return SimplePaymentSerializer(payment).data
-        except Payment.DoesNotExist:
+        # ``payments`` is filled by Appointment.objects.with_details() or set
+        # by whoever just created the payment
+        payments = getattr(obj, "payments", None)
+        if payments is None:
+            payments = obj.payment_set.all()
+        payment = next(iter(payments), None)
+        if payment is None:
             return None
+        return SimplePaymentSerializer(payment).data
+
+    def get_resources(self, obj):
+        # ``booked_resources`` is filled by Appointment.objects.with_details()
+        # or set by create() and update()
+        resources = getattr(obj, "booked_resources", None)
+        if resources is None:
+            resources = obj.resources.all()
+        return SimpleResourceSerializer(resources, many=True).data
+
+    def get_no_show_risk(self, obj):
+        # Scored for a whole page by AppointmentViewSet.paginate_queryset
+        return getattr(obj, "no_show_risk", None)
+
+    def create(self, validated_data):
+        resources = validated_data.pop("resources", [])
+        with slot_conflict_guard():
+            appointment = super().create(validated_data)
+            appointment.book_resources(resources)
+        appointment.booked_resources = resources
+        return appointment
+
+    def update(self, instance, validated_data):
+        resources = validated_data.pop("resources", None)
+        with slot_conflict_guard():
+            # save() moves the bookings along with the slot
+            appointment = super().update(instance, validated_data)
+            if resources is not None:
+                appointment.set_resources(resources)
+                appointment.booked_resources = resources
+        return appointment
+
+    def validate_resources(self, starts_at, ends_at, resources):
+        """
+        Raise if any of the resources is held by another appointment in the
+        slot. One range probe covers all of them.
+        """
+        busy = ResourceBooking.objects.filter(
+            resource__in=resources, blocking=True, starts_at__lt=ends_at, ends_at__gt=starts_at
+        )
+        if self.instance is not None:
+            busy = busy.exclude(appointment=self.instance)
+        names = sorted(set(busy.values_list("resource__name", flat=True)))
+        if names:
+            raise serializers.ValidationError(
+                {"resource_ids": f"Already booked at this time: {', '.join(names)}"}
+            )
+
+    @staticmethod
+    def probe_slot(patients, conflicts, doctor):
+        """
+        Annotate the patients with whether the doctor (``doctor_busy``) and
+        the patient (``patient_busy``) already have an appointment in the
+        way, each an index probe that stops at the first one.
+        """
+        return patients.annotate(
+            doctor_busy=Exists(conflicts.filter(doctor=doctor)),
+            patient_busy=Exists(conflicts.filter(patient=OuterRef("pk"))),
+        )
+
+    def find_patient(self, patient_uuid, conflicts, doctor):
+        """
+        Look up the patient booked by UUID, probing the slot in the same
+        query when there is one.
+        """
+        patients = Patient.objects.filter(patient_id=patient_uuid)
+        if conflicts is not None:
+            patients = self.probe_slot(patients, conflicts, doctor)
+        patient = patients.first()
+        if patient is None:
+            raise NotFound("Patient not found.")
+        if not patient.is_active:
+            raise serializers.ValidationError({"patient_uuid": "Patient is not active."})
+        return patient
 
     def validate(self, data):
-        appointment_date = data.get("appointment_date")
-        appointment_time = data.get("appointment_time")
-        duration = data.get("duration", 30)
-        patient = data.get("patient")
+        instance = self.instance
+        patient = data.get("patient") or self.context.get("patient")
+        # Booking by UUID: the patient is found along with the conflicts below
+        patient_uuid = None if patient else self.context.get("patient_uuid")
         doctor = data.get("doctor")
+        if patient is None and patient_uuid is None and instance is None:
+            raise serializers.ValidationError({"patient_id": "This field is required."})
+        if patient is not None:
+            data["patient"] = patient
 
         # Get the request from the context
         request = self.context.get("request", None)
@@ -170,59 +311,427 @@ class AppointmentSerializer(serializers.ModelSerializer):
             data["doctor"] = request.user.doctor_profile
             doctor = data["doctor"]
 
-        if appointment_date and appointment_time:
-            # Convert to datetime for comparison
-            appointment_datetime = timezone.make_aware(
-                timezone.datetime.combine(appointment_date, appointment_time)
+        # An update is checked as the appointment will be saved: the fields
+        # it changes over the ones it keeps
+        slot_changed = instance is None or any(
+            field in data for field in ("appointment_date", "appointment_time", "duration", "doctor", "patient")
+        )
+        if instance is not None:
+            appointment_date = data.get("appointment_date", instance.appointment_date)
+            appointment_time = data.get("appointment_time", instance.appointment_time)
+            duration = data.get("duration", instance.duration)
+            doctor = doctor or instance.doctor
+            patient = patient or instance.patient
+        else:
+            appointment_date = data.get("appointment_date")
+            appointment_time = data.get("appointment_time")
+            duration = data.get("duration", 30)
+
+        conflicts = None
+        if slot_changed and appointment_date and appointment_time:
+            if crosses_partition(appointment_date, appointment_time, duration):
+                raise serializers.ValidationError({"duration": CROSSES_PARTITION})
+            starts_at, ends_at = Appointment.slot_bounds(
+                appointment_date, appointment_time, duration
             )
-            end_time = appointment_datetime + timezone.timedelta(minutes=duration)
-
-            # Check for overlapping appointments for doctor
-            doctor_overlaps = (
-                Appointment.objects.filter(
-                    doctor=doctor,
-                    appointment_date=appointment_date,
-                    is_active=True,
+            conflicts = Appointment.objects.blocking().overlapping(starts_at, ends_at)
+            if instance is not None:
+                conflicts = conflicts.exclude(pk=instance.pk)
+
+        if patient_uuid is not None:
+            patient = data["patient"] = self.find_patient(patient_uuid, conflicts, doctor)
+
+        if conflicts is not None:
+            # One query probes the slot for both the doctor and the patient,
+            # and a clash with the doctor is reported first
+            if patient_uuid is not None:
+                doctor_busy, patient_busy = patient.doctor_busy, patient.patient_busy
+            else:
+                doctor_busy, patient_busy = (
+                    self.probe_slot(Patient.objects.filter(pk=patient.pk), conflicts, doctor)
+                    .values_list("doctor_busy", "patient_busy")
+                    .first()
+                    or (False, False)
                 )
-                .exclude(
-                    appointment_id=(
-                        self.instance.appointment_id if self.instance else None
-                    )
+
+            if doctor_busy:
+                raise serializers.ValidationError(
+                    {
+                        "appointment_time": "Doctor already has an appointment at this time"
+                    }
                 )
-                .filter(
-                    appointment_time__lt=end_time.time(),
-                    appointment_time__gte=appointment_time,
+            if patient_busy:
+                raise serializers.ValidationError(
+                    {
+                        "appointment_time": "Patient already has an appointment at this time"
+                    }
                 )
+
+        # The resources asked for, or those the appointment already holds
+        # when only its slot moves
+        resources = data.get("resources")
+        if resources is None and instance is not None and slot_changed:
+            resources = getattr(instance, "booked_resources", None)
+            if resources is None:
+                resources = list(instance.resources.all())
+        status = data.get("status", instance.status if instance else "scheduled")
+        if resources and status != "canceled" and appointment_date and appointment_time:
+            self.validate_resources(
+                *Appointment.slot_bounds(appointment_date, appointment_time, duration), resources
             )
 
-            if doctor_overlaps.exists():
+        return data
+
+
+class FreeSlotQuerySerializer(serializers.Serializer):
+    """
+    Query parameters of the free-slot search.
+    """
+
+    MAX_DAYS = 31
+
+    date_from = serializers.DateField()
+    date_to = serializers.DateField(required=False)
+    doctor = serializers.IntegerField(required=False)
+    specialization = serializers.IntegerField(required=False)
+    patient = serializers.IntegerField(required=False)
+    duration = serializers.IntegerField(default=30, min_value=1, max_value=480)
+    step = serializers.IntegerField(default=15, min_value=5, max_value=240)
+    day_start = serializers.TimeField(default=time(9, 0))
+    day_end = serializers.TimeField(default=time(17, 0))
+
+    def validate(self, data):
+        data.setdefault("date_to", data["date_from"])
+        if data["date_to"] < data["date_from"]:
+            raise serializers.ValidationError({"date_to": "Must not be before date_from."})
+        if (data["date_to"] - data["date_from"]).days >= self.MAX_DAYS:
+            raise serializers.ValidationError(
+                {"date_to": f"The search window is limited to {self.MAX_DAYS} days."}
+            )
+        if data["day_end"] <= data["day_start"]:
+            raise serializers.ValidationError({"day_end": "Must be after day_start."})
+        return data
+
+
+class BulkSlotSerializer(serializers.Serializer):
+    appointment_date = serializers.DateField()
+    appointment_time = serializers.TimeField()
+    duration = serializers.IntegerField(min_value=1, required=False)
+
+
+class RecurrenceSerializer(serializers.Serializer):
+    start_date = serializers.DateField()
+    appointment_time = serializers.TimeField()
+    interval_days = serializers.IntegerField(default=7, min_value=1)
+    occurrences = serializers.IntegerField(min_value=1)
+
+
+class BulkAppointmentSerializer(serializers.Serializer):
+    """
+    Books a recurring series or an explicit list of appointments for one
+    patient and doctor, with a pending payment for each, in one transaction.
+    """
+
+    MAX_APPOINTMENTS = 100
+
+    patient_uuid = serializers.SlugRelatedField(
+        slug_field="patient_id", queryset=Patient.objects.filter(is_active=True)
+    )
+    doctor_id = DoctorChoiceField(
+        queryset=Doctor.objects.filter(user__is_active=True).select_related(
+            "user", "specialization"
+        ),
+        source="doctor",
+        required=False,
+    )
+    duration = serializers.IntegerField(default=30, min_value=1)
+    notes = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    billing_amount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0.01")
+    )
+    billing_method = serializers.ChoiceField(choices=BILLING_METHODS, default="Cash")
+    recurrence = RecurrenceSerializer(required=False)
+    appointments = BulkSlotSerializer(many=True, required=False)
+
+    def validate(self, data):
+        request = self.context.get("request", None)
+        if request and request.user and request.user.role == "doctor":
+            if not hasattr(request.user, "doctor_profile"):
                 raise serializers.ValidationError(
                     {
-                        "appointment_time": "Doctor already has an appointment at this time"
+                        "doctor": "Your doctor profile is not set up. Please contact the administrator to complete your doctor profile setup."
                     }
                 )
+            data["doctor"] = request.user.doctor_profile
+        if not data.get("doctor"):
+            raise serializers.ValidationError({"doctor_id": "This field is required."})
 
-            # Check for overlapping appointments for patient
-            patient_overlaps = (
-                Appointment.objects.filter(
-                    patient=patient, appointment_date=appointment_date, is_active=True
-                )
-                .exclude(
-                    appointment_id=(
-                        self.instance.appointment_id if self.instance else None
-                    )
+        if ("recurrence" in data) == ("appointments" in data):
+            raise serializers.ValidationError(
+                "Provide either a recurrence or a list of appointments."
+            )
+
+        if "recurrence" in data:
+            recurrence = data["recurrence"]
+            slots = [
+                (
+                    recurrence["start_date"] + timedelta(days=i * recurrence["interval_days"]),
+                    recurrence["appointment_time"],
+                    data["duration"],
                 )
-                .filter(
-                    appointment_time__lt=end_time.time(),
-                    appointment_time__gte=appointment_time,
+                for i in range(recurrence["occurrences"])
+            ]
+        else:
+            slots = [
+                (
+                    slot["appointment_date"],
+                    slot["appointment_time"],
+                    slot.get("duration", data["duration"]),
                 )
+                for slot in data["appointments"]
+            ]
+
+        if not slots or len(slots) > self.MAX_APPOINTMENTS:
+            raise serializers.ValidationError(
+                f"A batch must contain between 1 and {self.MAX_APPOINTMENTS} appointments."
+            )
+
+        errors = batch_conflicts(
+            [Appointment.slot_bounds(*slot) for slot in slots],
+            data["doctor"],
+            data["patient_uuid"],
+        )
+        errors.update((i, CROSSES_PARTITION) for i, slot in enumerate(slots) if crosses_partition(*slot))
+        if errors:
+            raise serializers.ValidationError(
+                {
+                    "appointments": [
+                        {
+                            "appointment_date": slots[i][0],
+                            "appointment_time": slots[i][1],
+                            "error": message,
+                        }
+                        for i, message in sorted(errors.items())
+                    ]
+                }
+            )
+
+        data["slots"] = slots
+        return data
+
+    def create(self, validated_data):
+        from billing.models import Payment
+
+        patient = validated_data["patient_uuid"]
+        appointments = []
+        for appointment_date, appointment_time, duration in validated_data["slots"]:
+            appointment = Appointment(
+                patient=patient,
+                doctor=validated_data["doctor"],
+                appointment_date=appointment_date,
+                appointment_time=appointment_time,
+                duration=duration,
+                notes=validated_data.get("notes"),
+                status="scheduled",
+                created_by=validated_data["created_by"],
             )
+            appointment.sync_denormalized_fields()
+            appointments.append(appointment)
+
+        with slot_conflict_guard():
+            Appointment.objects.bulk_create(appointments)
+            payments = Payment.objects.bulk_create(
+                [
+                    Payment(
+                        patient=patient,
+                        appointment=appointment,
+                        amount=validated_data["billing_amount"],
+                        method=validated_data["billing_method"],
+                        status="Pending",
+                    )
+                    for appointment in appointments
+                ]
+            )
+            touch_calendars([validated_data["doctor"].id])
+            Deltas().add_new(appointments, payments).apply_on_commit()
+        # Everything the response renders is already in memory
+        for appointment, payment in zip(appointments, payments):
+            appointment.payments = [payment]
+            appointment.booked_resources = []
+        return appointments
+
 
-            if patient_overlaps.exists():
+class AppointmentImportSerializer(serializers.Serializer):
+    """
+    Upload of a CSV or iCalendar file of appointments to import.
+    """
+
+    file = serializers.FileField()
+    format = serializers.ChoiceField(choices=IMPORT_FORMATS, required=False)
+    dry_run = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        if "format" not in data:
+            extension = data["file"].name.rsplit(".", 1)[-1].lower()
+            if extension not in IMPORT_FORMATS:
                 raise serializers.ValidationError(
-                    {
-                        "appointment_time": "Patient already has an appointment at this time"
-                    }
+                    {"format": "Cannot tell the file format from its name; pass csv or ics."}
                 )
+            data["format"] = extension
+        return data
+
+
+class AppointmentTransitionSerializer(serializers.Serializer):
+    MAX_APPOINTMENTS = 1000
 
+    appointment_ids = serializers.ListField(
+        child=serializers.UUIDField(), min_length=1, max_length=MAX_APPOINTMENTS
+    )
+    status = serializers.ChoiceField(
+        choices=[
+            choice
+            for choice in Appointment.APP_STATUS_CHOICES
+            if choice[0] != "scheduled"
+        ]
+    )
+
+
+class CalendarQuerySerializer(serializers.Serializer):
+    """
+    Query parameters of the calendar grid. ``doctors`` is a comma separated
+    list of doctor IDs.
+    """
+
+    MAX_DAYS = 42
+    MAX_DOCTORS = 50
+
+    doctors = serializers.CharField()
+    date_from = serializers.DateField()
+    date_to = serializers.DateField()
+
+    def validate_doctors(self, value):
+        try:
+            doctors = sorted({int(part) for part in value.split(",") if part.strip()})
+        except ValueError:
+            raise serializers.ValidationError("Expected a comma separated list of doctor IDs.")
+        if not doctors or len(doctors) > self.MAX_DOCTORS:
+            raise serializers.ValidationError(
+                f"Provide between 1 and {self.MAX_DOCTORS} doctor IDs."
+            )
+        return doctors
+
+    def validate(self, data):
+        if data["date_to"] < data["date_from"]:
+            raise serializers.ValidationError({"date_to": "Must not be before date_from."})
+        if (data["date_to"] - data["date_from"]).days >= self.MAX_DAYS:
+            raise serializers.ValidationError(
+                {"date_to": f"The calendar is limited to {self.MAX_DAYS} days."}
+            )
         return data
+
+
+class WaitlistEntrySerializer(serializers.ModelSerializer):
+    """
+    A waitlist entry. Either a doctor or a specialization is required; an
+    entry without a doctor takes a slot with any doctor of its
+    specialization.
+    """
+
+    patient_uuid = serializers.SlugRelatedField(
+        slug_field="patient_id",
+        queryset=Patient.objects.filter(is_active=True),
+        source="patient",
+        write_only=True,
+    )
+    patient = SimplePatientSerializer(read_only=True)
+    doctor_id = DoctorChoiceField(
+        queryset=Doctor.objects.filter(user__is_active=True),
+        source="doctor",
+        required=False,
+        allow_null=True,
+    )
+    specialization_id = serializers.PrimaryKeyRelatedField(
+        queryset=Specialization.objects.all(),
+        source="specialization",
+        required=False,
+        allow_null=True,
+    )
+    billing_amount = serializers.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        min_value=Decimal("0.01"),
+        required=False,
+        allow_null=True,
+    )
+    billing_method = serializers.ChoiceField(choices=BILLING_METHODS, default="Cash")
+    offered_doctor_id = serializers.IntegerField(read_only=True)
+    appointment_id = serializers.UUIDField(
+        source="appointment.appointment_id", read_only=True, default=None
+    )
+
+    class Meta:
+        model = WaitlistEntry
+        fields = [
+            "entry_id",
+            "patient_uuid",
+            "patient",
+            "doctor_id",
+            "specialization_id",
+            "date_from",
+            "date_to",
+            "time_from",
+            "time_to",
+            "duration",
+            "priority",
+            "auto_book",
+            "billing_amount",
+            "billing_method",
+            "notes",
+            "status",
+            "offered_doctor_id",
+            "offered_date",
+            "offered_time",
+            "offered_duration",
+            "offered_at",
+            "appointment_id",
+            "created_at",
+            "updated_at",
+        ]
+        read_only_fields = [
+            "entry_id",
+            "status",
+            "offered_date",
+            "offered_time",
+            "offered_duration",
+            "offered_at",
+            "created_at",
+            "updated_at",
+        ]
+
+    def validate(self, data):
+        def current(field):
+            if field in data:
+                return data[field]
+            return getattr(self.instance, field, None)
+
+        if current("doctor") is None and current("specialization") is None:
+            raise serializers.ValidationError(
+                {"doctor_id": "Either a doctor or a specialization is required."}
+            )
+        if current("date_to") < current("date_from"):
+            raise serializers.ValidationError({"date_to": "Must not be before date_from."})
+        time_from, time_to = current("time_from"), current("time_to")
+        if time_from is not None and time_to is not None and time_to <= time_from:
+            raise serializers.ValidationError({"time_to": "Must be after time_from."})
+        if current("auto_book") and current("billing_amount") is None:
+            raise serializers.ValidationError(
+                {"billing_amount": "Required to book a freed slot automatically."}
+            )
+        return data
+
+
+class WaitlistAcceptSerializer(serializers.Serializer):
+    billing_amount = serializers.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0.01")
+    )
+    billing_method = serializers.ChoiceField(choices=BILLING_METHODS, default="Cash")
@@ -0,0 +1,54 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from patients.models import Patient
+from users.models import User
+
+from .ics import touch_calendars
+from .models import Appointment
+
+
+@receiver(post_save, sender=Patient)
+def refresh_patient_search_text(sender, instance, created, **kwargs):
+    """
+    Keep Appointment.search_text in step with patient renames. Rows whose
+    text already starts with the current name are left alone, so ordinary
+    saves touch nothing.
+    """
+    if created:
+        return
+    name = f"{instance.first_name} {instance.last_name} ".lower()
+    stale = Appointment.objects.filter(patient=instance).exclude(search_text__startswith=name)
+    # The calendar feeds of these doctors show the patient's name
+    doctor_ids = set(stale.values_list("doctor_id", flat=True).distinct())
+    if doctor_ids:
+        stale.refresh_search_text()
+        touch_calendars(doctor_ids)
+
+
+@receiver(post_save, sender=User)
+def refresh_doctor_search_text(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Keep Appointment.search_text in step with doctor renames. Saves that
+    leave the name as it was loaded, such as the last_login update of every
+    sign-in, cost no query.
+    """
+    if created or instance.role != "doctor":
+        return
+    if update_fields is not None and not {"first_name", "last_name"} & set(update_fields):
+        return
+    current = (instance.first_name, instance.last_name)
+    if getattr(instance, "_loaded_name", None) == current:
+        return
+    instance._loaded_name = current
+    name = f" {instance.first_name} {instance.last_name}".lower()
+    if Appointment.objects.filter(doctor__user=instance).exclude(
+        search_text__endswith=name
+    ).refresh_search_text():
+        touch_calendars([instance.doctor_profile.id])
+
+
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def touch_appointment_calendars(sender, instance, **kwargs):
+    touch_calendars([instance.doctor_id, getattr(instance, "_loaded_doctor_id", None)])
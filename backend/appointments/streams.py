@@ -0,0 +1,143 @@
+"""
+Server-sent-event stream of today's appointment statuses.
+
+The stream is an async view, so it must be served through core.asgi to hold
+connections open without tying up a worker each. A WSGI server would buffer
+the endless response and block a worker on it for good, so under WSGI the
+view answers 503 instead of streaming.
+"""
+
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .events import appointment_event, broker
+from .models import Appointment
+
+HEARTBEAT_SECONDS = 15
+# Roles that may follow every doctor's board
+STAFF_ROLES = ("manager", "secretary")
+
+
+def format_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def authenticate(request):
+    """
+    Resolve the user from the JWT in the Authorization header, or in the
+    ``token`` query parameter since EventSource cannot send headers.
+    """
+    authentication = JWTAuthentication()
+    header = request.headers.get("Authorization")
+    raw_token = (
+        authentication.get_raw_token(header.encode())
+        if header
+        else request.GET.get("token")
+    )
+    if not raw_token:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def resolve_doctor(user, requested):
+    """
+    Return (doctor_id, error_response). Managers and secretaries may pick a
+    doctor or follow all of them; doctors only follow their own board, and
+    nobody else may follow any.
+    """
+    if user.role in STAFF_ROLES:
+        if not requested:
+            return None, None
+        try:
+            return int(requested), None
+        except ValueError:
+            return None, JsonResponse({"error": "Invalid doctor ID."}, status=400)
+    if user.role != "doctor":
+        return None, JsonResponse(
+            {"detail": "You do not have permission to perform this action."}, status=403
+        )
+    if not hasattr(user, "doctor_profile"):
+        return None, JsonResponse(
+            {"error": "Your doctor profile is not set up. Please contact the administrator to complete your doctor profile setup."},
+            status=400,
+        )
+    doctor_id = user.doctor_profile.id
+    if requested and requested != str(doctor_id):
+        return None, JsonResponse(
+            {"detail": "Doctors can only follow their own queue board."}, status=403
+        )
+    return doctor_id, None
+
+
+def todays_queue(doctor_id):
+    queryset = (
+        Appointment.objects.blocking()
+        .filter(appointment_date=timezone.localdate())
+        .select_related("patient")
+        .order_by("appointment_time")
+    )
+    if doctor_id is not None:
+        queryset = queryset.filter(doctor_id=doctor_id)
+    return [appointment_event(appointment) for appointment in queryset]
+
+
+async def event_stream(subscription, snapshot):
+    try:
+        yield format_event("snapshot", snapshot)
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_event("status", event)
+    finally:
+        subscription.close()
+
+
+async def queue_board_stream(request):
+    """
+    Stream a snapshot of today's appointments followed by every status
+    change, for one doctor (``?doctor=<id>``) or all doctors. Doctors get
+    their own board only.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {"error": "The queue board stream is only available when the server runs core.asgi."},
+            status=503,
+        )
+
+    user = await sync_to_async(authenticate)(request)
+    if user is None or not user.is_active:
+        return JsonResponse(
+            {"detail": "Authentication credentials were not provided."}, status=401
+        )
+
+    doctor_id, error = await sync_to_async(resolve_doctor)(user, request.GET.get("doctor"))
+    if error is not None:
+        return error
+
+    # Subscribe before reading the snapshot so no change can slip between
+    subscription = broker.subscribe(doctor_id)
+    try:
+        snapshot = await sync_to_async(todays_queue)(doctor_id)
+    except Exception:
+        subscription.close()
+        raise
+
+    response = StreamingHttpResponse(
+        event_stream(subscription, snapshot), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -1,3 +1,1165 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import tempfile
+from datetime import date, datetime, time, timedelta
+from unittest import skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from appointments.eta import cache_key, estimate_queue, record_completions, summarize
+from appointments.importing import import_appointments
+from appointments.models import (
+    Appointment,
+    AppointmentStatusEvent,
+    CalendarFeed,
+    IdempotencyKey,
+    Resource,
+    ResourceBooking,
+    WaitlistEntry,
+    is_slot_conflict,
+)
+from appointments.partitioning import (
+    CROSSES_PARTITION,
+    convert_to_partitioned,
+    ensure_partitions,
+    is_partitioned,
+    partition_name,
+)
+from appointments.scheduling import sweep_free_slots
+from appointments.serializers import AppointmentSerializer
+from billing.models import Payment
+from core.db import is_postgres
+from core.testing import ClinicTestData
+from users.models import User
+
+
+class AppointmentListQueryBudgetTests(ClinicTestData, APITestCase):
+    """
+    The list endpoint must serialize a page with a fixed number of queries,
+    independent of the page size.
+    """
+
+    # COUNT for the paginator, the page itself, the payment and resource
+    # prefetches and the no-show lookup: the forecast model until one is
+    # trained, the patients' no-show records after that
+    QUERY_BUDGET = 5
+    PATIENTS = 50
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        start = date(2030, 1, 1)
+        for i, patient in enumerate(cls.patients):
+            appointment = cls.create_appointment(patient, cls.doctor, start + timedelta(days=i), time(10, 0))
+            Payment.objects.create(
+                patient=patient, appointment=appointment, amount=100, method="Cash"
+            )
+
+    def list_queries(self, user, page_size):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/appointments/", {"page_size": page_size})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), page_size)
+        self.assertIsNotNone(response.data["results"][0]["payment"])
+        return len(queries)
+
+    def test_manager_list_query_count_is_constant(self):
+        self.assertEqual(self.list_queries(self.manager, 5), self.QUERY_BUDGET)
+        self.assertEqual(self.list_queries(self.manager, 50), self.QUERY_BUDGET)
+
+    def test_doctor_list_query_count_is_constant(self):
+        doctor_user = User.objects.get(pk=self.doctor.user_id)
+        small = self.list_queries(doctor_user, 5)
+        doctor_user = User.objects.get(pk=self.doctor.user_id)
+        large = self.list_queries(doctor_user, 50)
+        self.assertEqual(small, large)
+        # Plus the doctor_profile lookup on the user
+        self.assertLessEqual(large, self.QUERY_BUDGET + 1)
+
+
+class CursorPaginationTests(ClinicTestData, APITestCase):
+    """
+    Cursor pages walk the list in (appointment_date, id) order without
+    repeating or skipping rows, even when rows are added meanwhile.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        start = date(2030, 1, 1)
+        # Two appointments a day, so pages split days and ties fall to the id
+        for i in range(25):
+            cls.create_appointment(cls.patient, cls.doctor, start + timedelta(days=i // 2), time(9 + i % 2))
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client.force_authenticate(self.manager)
+
+    def test_round_trip(self):
+        response = self.client.get("/api/appointments/", {"paginate": "cursor", "page_size": 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data["count"], response.data["total_pages"]), (25, 3))
+        seen = [row["id"] for row in response.data["results"]]
+
+        # A newer appointment lands on the first page, not in the walk
+        self.create_appointment(self.patient, self.doctor, date(2031, 1, 1), time(9, 0))
+        while response.data["next"]:
+            response = self.client.get(response.data["next"])
+            self.assertEqual(response.status_code, 200)
+            seen += [row["id"] for row in response.data["results"]]
+
+        expected = list(
+            Appointment.objects.filter(appointment_date__lt=date(2031, 1, 1))
+            .order_by("-appointment_date", "-id")
+            .values_list("id", flat=True)
+        )
+        self.assertEqual(seen, expected)
+
+    def test_bad_cursor(self):
+        # Not base64, no separator, not a date
+        for cursor in ["not base64!", "bm8tY29sb24=", "MjAzMC0xMy0wMToy"]:
+            response = self.client.get("/api/appointments/", {"cursor": cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+class AppointmentBookingQueryBudgetTests(ClinicTestData, APITestCase):
+    """
+    Booking must resolve, validate and insert in a fixed number of statements
+    and render the response without reloading the appointment.
+    """
+
+    # Doctor, patient with the conflict probe, the appointment and payment
+    # inserts, the calendar feed version bump and the savepoint pair of the
+    # booking transaction inside the test case
+    QUERY_BUDGET = 7
+
+    def test_booking_query_count(self):
+        self.client.force_authenticate(self.manager)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.book(self.patient, self.doctor, "2030-01-01")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["payment"]["amount"], "100.00")
+        self.assertEqual(response.data["patient_name"], "Patient0 Test")
+        self.assertEqual(len(queries), self.QUERY_BUDGET)
+
+    def test_patient_must_exist_and_be_active(self):
+        self.client.force_authenticate(self.manager)
+        inactive = self.create_patient("Inactive", is_active=False)
+        self.assertEqual(self.book(inactive, self.doctor, "2030-01-01").status_code, 400)
+        self.patient.patient_id = "00000000-0000-0000-0000-000000000000"
+        self.assertEqual(self.book(self.patient, self.doctor, "2030-01-01").status_code, 404)
+        self.patient.patient_id = "not-a-uuid"
+        self.assertEqual(self.book(self.patient, self.doctor, "2030-01-01").status_code, 400)
+        self.assertFalse(Appointment.objects.exists())
+
+
+class BulkBookingTests(ClinicTestData, APITestCase):
+    """
+    A batch is booked in full or not at all, in a number of statements
+    that does not grow with its size.
+    """
+
+    PATIENTS = 2
+    # Patient, doctor, conflict probe, the appointment and payment inserts
+    # and the calendar feed version bump
+    QUERY_BUDGET = 6
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def book_bulk(self, patient=None, **fields):
+        return self.client.post(
+            "/api/appointments/bulk/",
+            {
+                "patient_uuid": str((patient or self.patient).patient_id),
+                "doctor_id": self.doctor.id,
+                "billing_amount": "40.00",
+                **fields,
+            },
+            format="json",
+        )
+
+    def test_recurrence(self):
+        response = self.book_bulk(
+            recurrence={"start_date": "2030-01-07", "appointment_time": "09:00", "occurrences": 3}
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data["count"], 3)
+        self.assertEqual(
+            [row["appointment_date"] for row in response.data["results"]],
+            ["2030-01-07", "2030-01-14", "2030-01-21"],
+        )
+        self.assertEqual(response.data["results"][0]["payment"]["amount"], "40.00")
+        self.assertEqual(Payment.objects.filter(amount="40.00", status="Pending").count(), 3)
+
+    def test_conflicts_reject_the_whole_batch(self):
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 14), time(9, 15))
+        response = self.book_bulk(
+            appointments=[
+                {"appointment_date": "2030-01-07", "appointment_time": "09:00"},
+                {"appointment_date": "2030-01-14", "appointment_time": "09:00"},
+                {"appointment_date": "2030-01-21", "appointment_time": "09:00"},
+                {"appointment_date": "2030-01-21", "appointment_time": "09:15"},
+            ]
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [(row["appointment_date"], row["error"]) for row in response.data["appointments"]],
+            [
+                ("2030-01-14", "Doctor already has an appointment at this time"),
+                ("2030-01-21", "Overlaps another appointment in this batch"),
+            ],
+        )
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_query_count_does_not_grow_with_the_batch(self):
+        for patient, appointment_time, occurrences in zip(self.patients, ["09:00", "10:00"], [2, 10]):
+            recurrence = {
+                "start_date": "2030-01-07",
+                "appointment_time": appointment_time,
+                "occurrences": occurrences,
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = self.book_bulk(patient, recurrence=recurrence)
+            self.assertEqual(response.status_code, 201, response.data)
+            self.assertEqual(len(queries), self.QUERY_BUDGET, occurrences)
+
+class FreeSlotTests(ClinicTestData, APITestCase):
+    """
+    Free slots are the step-aligned starts that fit between the busy ranges
+    within working hours.
+    """
+
+    DOCTORS = 2
+    PATIENTS = 2
+
+    def test_sweep_around_overlapping_ranges(self):
+        def at(hour, minute=0):
+            return datetime(2030, 1, 7, hour, minute)
+
+        busy = [(at(10), at(10, 30)), (at(10, 20), at(11))]
+        slots = sweep_free_slots(busy, at(9), at(12), timedelta(minutes=30), timedelta(minutes=15))
+        self.assertEqual(
+            [slot.strftime("%H:%M") for slot in slots], ["09:00", "09:15", "09:30", "11:00", "11:15", "11:30"]
+        )
+        # Not before 9:05, rounded up to the next step
+        slots = sweep_free_slots(
+            [], at(9), at(10), timedelta(minutes=30), timedelta(minutes=15), not_before=at(9, 5)
+        )
+        self.assertEqual([slot.strftime("%H:%M") for slot in slots], ["09:15", "09:30"])
+
+    def test_free_slots_around_a_booking(self):
+        self.create_appointment(self.patients[0], self.doctors[0], date(2030, 1, 7), time(10, 0))
+        # The patient is busy with another doctor at 9:00
+        self.create_appointment(self.patients[1], self.doctors[1], date(2030, 1, 7), time(9, 0))
+        self.client.force_authenticate(self.manager)
+        params = {
+            "date_from": "2030-01-07",
+            "doctor": self.doctors[0].id,
+            "day_start": "09:00",
+            "day_end": "11:00",
+            "step": 30,
+        }
+        response = self.client.get("/api/appointments/free-slots/", params)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data["results"][0]["slots"], ["09:00", "09:30", "10:30"])
+
+        response = self.client.get("/api/appointments/free-slots/", {**params, "patient": self.patients[1].id})
+        self.assertEqual(response.data["results"][0]["slots"], ["09:30", "10:30"])
+
+class AppointmentUpdateTests(ClinicTestData, APITestCase):
+    """
+    The update response must show the appointment as saved, payment included.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.appointment = cls.create_appointment(cls.patient, cls.doctor, date(2030, 1, 1), time(10, 0))
+        Payment.objects.create(
+            patient=cls.patient, appointment=cls.appointment, amount=100, method="Cash"
+        )
+
+    def test_update_returns_new_payment(self):
+        self.client.force_authenticate(self.manager)
+        response = self.client.patch(
+            f"/api/appointments/{self.appointment.appointment_id}/",
+            {"appointment_time": "11:00", "billing_amount": "250.00", "billing_method": "Insurance"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data["appointment_time"], "11:00:00")
+        self.assertEqual(response.data["payment"]["amount"], "250.00")
+        self.assertEqual(response.data["payment"]["method"], "Insurance")
+
+    def test_invalid_billing_amount(self):
+        self.client.force_authenticate(self.manager)
+        for amount in ["abc", "0", "NaN"]:
+            response = self.client.patch(
+                f"/api/appointments/{self.appointment.appointment_id}/",
+                {"billing_amount": amount},
+                format="json",
+            )
+            self.assertEqual(response.status_code, 400, amount)
+        self.assertEqual(Payment.objects.get(appointment=self.appointment).amount, 100)
+
+
+class AppointmentConflictTests(ClinicTestData, APITestCase):
+    """
+    A booking or an update is checked against the whole of every other slot,
+    as it will be saved, and the error names the party that is busy.
+    """
+
+    DOCTORS = 3
+    PATIENTS = 2
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def assertConflict(self, response, party):
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual(
+            response.data["appointment_time"], [f"{party} already has an appointment at this time"]
+        )
+
+    def test_earlier_appointment_running_into_the_slot(self):
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 7), time(9, 40))
+        self.assertConflict(self.book(self.patients[0], self.doctor, "2030-01-07", "10:00"), "Doctor")
+        self.assertConflict(
+            self.book(self.patients[1], self.doctors[1], "2030-01-07", "09:30", duration=15), "Patient"
+        )
+        # Back to back is not a conflict
+        response = self.book(self.patients[0], self.doctor, "2030-01-07", "10:10")
+        self.assertEqual(response.status_code, 201, response.data)
+
+    def test_update_keeps_the_saved_duration_date_and_time(self):
+        appointment = self.create_appointment(
+            self.patients[0], self.doctor, date(2030, 1, 7), time(9, 0), duration=60
+        )
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 7), time(10, 30))
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 8), time(9, 30))
+        url = f"/api/appointments/{appointment.appointment_id}/"
+
+        # Still 60 minutes long, so 10:00 runs into 10:30
+        self.assertConflict(self.client.patch(url, {"appointment_time": "10:00"}, format="json"), "Doctor")
+        # Still at 9:00, so the next day runs into 9:30
+        self.assertConflict(self.client.patch(url, {"appointment_date": "2030-01-08"}, format="json"), "Doctor")
+        self.assertConflict(self.client.patch(url, {"duration": 120}, format="json"), "Doctor")
+
+        # The serializer fills in the saved fields itself, whatever the view sends
+        for data in [{"appointment_time": "10:00"}, {"appointment_date": "2030-01-08"}, {"duration": 120}]:
+            serializer = AppointmentSerializer(appointment, data=data, partial=True)
+            self.assertFalse(serializer.is_valid(), data)
+            self.assertIn("appointment_time", serializer.errors)
+
+        response = self.client.patch(url, {"duration": 90}, format="json")
+        self.assertEqual(response.status_code, 200, response.data)
+        response = self.client.patch(url, {"notes": "Fasting"}, format="json")
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def test_busy_doctor_is_named_among_several_conflicts(self):
+        # The patient's two other appointments are found before the doctor's
+        self.create_appointment(self.patients[0], self.doctors[2], date(2030, 1, 7), time(9, 30))
+        self.create_appointment(self.patients[0], self.doctors[1], date(2030, 1, 7), time(9, 0))
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 7), time(9, 15))
+        self.assertConflict(
+            self.book(self.patients[0], self.doctor, "2030-01-07", "09:00", duration=60), "Doctor"
+        )
+
+    @skipUnless(is_postgres(), "The slot exclusion constraints are PostgreSQL only")
+    def test_constraint_catches_a_booking_that_raced_validation(self):
+        serializer = AppointmentSerializer(
+            data={
+                "patient_id": self.patients[0].id,
+                "doctor_id": self.doctor.id,
+                "appointment_date": "2030-01-07",
+                "appointment_time": "10:00",
+            }
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        # Another request books the slot between validation and save
+        self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 7), time(10, 15))
+
+        with self.assertRaises(ValidationError) as raised, transaction.atomic():
+            serializer.save(created_by=self.manager)
+        self.assertEqual(raised.exception.detail["appointment_time"], ["This time slot has just been booked"])
+
+        with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+            self.create_appointment(self.patients[0], self.doctors[1], date(2030, 1, 7), time(10, 20))
+        self.assertTrue(is_slot_conflict(raised.exception))
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+class ResourceBookingTests(ClinicTestData, APITestCase):
+    """
+    A room or device serves one appointment at a time, whichever doctor
+    books it, until the appointment holding it is canceled.
+    """
+
+    DOCTORS = 2
+    PATIENTS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.room = Resource.objects.create(name="Room 1", kind="room")
+        cls.scanner = Resource.objects.create(name="Scanner", kind="equipment")
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def test_double_booking_is_rejected(self):
+        response = self.book(
+            self.patients[0], self.doctors[0], "2030-01-07", "10:00", resource_ids=[self.room.id, self.scanner.id]
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        held = response.data["appointment_id"]
+
+        response = self.book(self.patients[1], self.doctors[1], "2030-01-07", "10:15", resource_ids=[self.room.id])
+        self.assertEqual(response.status_code, 400, response.data)
+        self.assertEqual(response.data["resource_ids"], ["Already booked at this time: Room 1"])
+        self.assertEqual(ResourceBooking.objects.filter(resource=self.room).count(), 1)
+
+        # Back to back is not a conflict
+        response = self.book(self.patients[1], self.doctors[1], "2030-01-07", "10:30", resource_ids=[self.room.id])
+        self.assertEqual(response.status_code, 201, response.data)
+
+        # Canceling releases the resources
+        response = self.client.post(f"/api/appointments/{held}/cancel/")
+        self.assertEqual(response.status_code, 200, response.data)
+        response = self.book(self.patients[1], self.doctors[1], "2030-01-07", "09:45", resource_ids=[self.scanner.id])
+        self.assertEqual(response.status_code, 201, response.data)
+
+
+class PartitionBoundaryTests(ClinicTestData, APITestCase):
+    """
+    The slot exclusion constraints of a partitioned table hold within each
+    monthly partition, so no slot may run from one month into the next.
+    """
+
+    PATIENTS = 2
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def test_slot_must_end_in_its_month(self):
+        response = self.book(self.patient, self.doctor, "2030-01-31", "23:45")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["duration"], [CROSSES_PARTITION])
+        # Ending at midnight does not reach into February
+        response = self.book(self.patient, self.doctor, "2030-01-31", "23:30")
+        self.assertEqual(response.status_code, 201, response.data)
+
+        response = self.client.post(
+            "/api/appointments/bulk/",
+            {
+                "patient_uuid": str(self.patients[1].patient_id),
+                "doctor_id": self.doctor.id,
+                "billing_amount": "40.00",
+                "duration": 60,
+                "recurrence": {"start_date": "2030-02-28", "appointment_time": "23:30", "occurrences": 2},
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["appointments"][0]["error"], CROSSES_PARTITION)
+
+    @skipUnless(is_postgres(), "Partitioning is PostgreSQL only")
+    def test_partitioned_table_keeps_its_constraints(self):
+        appointment = self.create_appointment(self.patient, self.doctor, date(2030, 1, 7), time(9, 0))
+        Payment.objects.create(patient=self.patient, appointment=appointment, amount=100, method="Cash")
+
+        dropped = convert_to_partitioned(months_ahead=1)
+        self.assertTrue(is_partitioned())
+        self.assertTrue(any(name.startswith("billing_payment_") for name in dropped))
+        ensure_partitions(date(2030, 1, 1), date(2030, 2, 1))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT tableoid::regclass::text FROM {Appointment._meta.db_table} WHERE id = %s",
+                [appointment.pk],
+            )
+            self.assertEqual(cursor.fetchone()[0], partition_name(date(2030, 1, 1)))
+
+        with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+            self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 7), time(9, 15))
+        self.assertTrue(is_slot_conflict(raised.exception))
+
+        # Saved past the serializer, a slot across the boundary hits the check
+        with self.assertRaises(IntegrityError) as raised, transaction.atomic():
+            self.create_appointment(self.patients[1], self.doctor, date(2030, 1, 31), time(23, 45))
+        self.assertIn("slot_within_month", str(raised.exception))
+
+class AppointmentSearchTests(ClinicTestData, APITestCase):
+    """
+    Search matches patient and doctor names through search_text, which
+    follows renames, and status names.
+    """
+
+    DOCTORS = 2
+    PATIENTS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i, (patient, doctor) in enumerate(zip(cls.patients, cls.doctors)):
+            doctor.user.first_name, doctor.user.last_name = f"Doctor{i}", "House"
+            doctor.user.save()
+            cls.create_appointment(
+                patient, doctor, date(2030, 1, 7), time(9 + i), status=["scheduled", "in_queue"][i]
+            )
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def search(self, term):
+        response = self.client.get("/api/appointments/", {"search": term})
+        self.assertEqual(response.status_code, 200)
+        return sorted(row["patient"]["first_name"] for row in response.data["results"])
+
+    def test_names_and_statuses(self):
+        self.assertEqual(self.search("patient1"), ["Patient1"])
+        self.assertEqual(self.search("DOCTOR0 house"), ["Patient0"])
+        self.assertEqual(self.search("house"), ["Patient0", "Patient1"])
+        self.assertEqual(self.search("queue"), ["Patient1"])
+        self.assertEqual(self.search("nobody"), [])
+
+    def test_renames_are_searchable(self):
+        self.patients[0].last_name = "Renamed"
+        self.patients[0].save()
+        user = User.objects.get(pk=self.doctors[1].user_id)
+        user.last_name = "Wilson"
+        user.save()
+        self.assertEqual(self.search("patient0 renamed"), ["Patient0"])
+        self.assertEqual(self.search("wilson"), ["Patient1"])
+        self.assertEqual(self.search("house"), ["Patient0"])
+
+    def test_saves_without_a_rename_cost_no_query(self):
+        user = User.objects.get(pk=self.doctors[0].user_id)
+        # The UPDATE of the save itself only
+        with self.assertNumQueries(1):
+            user.status = User.STATUS_ON_BREAK
+            user.save()
+        with self.assertNumQueries(1):
+            user.last_login = timezone.now()
+            user.save(update_fields=["last_login"])
+
+    @skipUnless(is_postgres(), "Trigram matching is PostgreSQL only")
+    def test_misspelling_matches_on_postgres(self):
+        self.assertEqual(self.search("patiant1"), ["Patient1"])
+
+class AppointmentTransitionTests(ClinicTestData, APITestCase):
+    """
+    Status changes follow Appointment.STATUS_TRANSITIONS, are logged as
+    status events and carry the payment status along.
+    """
+
+    DOCTORS = 2
+    PATIENTS = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        day = date(2030, 1, 7)
+        cls.scheduled = cls.create_appointment(cls.patients[0], cls.doctors[0], day, time(9, 0))
+        cls.completed = cls.create_appointment(
+            cls.patients[1], cls.doctors[0], day, time(10, 0), status="completed"
+        )
+        cls.queued = cls.create_appointment(cls.patients[2], cls.doctors[1], day, time(9, 0), status="in_queue")
+        for appointment in [cls.scheduled, cls.completed, cls.queued]:
+            Payment.objects.create(patient=appointment.patient, appointment=appointment, amount=100, method="Cash")
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def status_of(self, appointment):
+        appointment.refresh_from_db()
+        return appointment.status, Payment.objects.get(appointment=appointment).status
+
+    def test_allowed_transition(self):
+        response = self.client.post(f"/api/appointments/{self.scheduled.appointment_id}/complete/")
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.status_of(self.scheduled), ("completed", "Paid"))
+        event = AppointmentStatusEvent.objects.get()
+        self.assertEqual(
+            (event.appointment_id, event.from_status, event.to_status, event.changed_by),
+            (self.scheduled.pk, "scheduled", "completed", self.manager),
+        )
+
+    def test_rejected_transition(self):
+        response = self.client.post(f"/api/appointments/{self.completed.appointment_id}/queue/")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["error"], "Cannot move appointment from completed to in_queue.")
+        self.assertEqual(self.status_of(self.completed), ("completed", "Pending"))
+        self.assertFalse(AppointmentStatusEvent.objects.exists())
+
+    def test_bulk_with_mixed_outcomes(self):
+        unknown = "00000000-0000-0000-0000-000000000000"
+        ids = [str(a.appointment_id) for a in [self.scheduled, self.completed, self.queued]] + [unknown]
+        response = self.client.post(
+            "/api/appointments/transition/", {"appointment_ids": ids, "status": "canceled"}, format="json"
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(
+            sorted(response.data["updated"]),
+            sorted([str(self.scheduled.appointment_id), str(self.queued.appointment_id)]),
+        )
+        self.assertEqual(
+            [(row["appointment_id"], row["status"]) for row in response.data["skipped"]],
+            [(str(self.completed.appointment_id), "completed")],
+        )
+        self.assertEqual(response.data["not_found"], [unknown])
+
+        self.assertEqual(self.status_of(self.scheduled), ("canceled", "Failed"))
+        self.assertEqual(self.status_of(self.queued), ("canceled", "Failed"))
+        self.assertEqual(self.status_of(self.completed), ("completed", "Pending"))
+        self.assertEqual(
+            sorted(AppointmentStatusEvent.objects.values_list("appointment_id", "from_status", "to_status")),
+            sorted([(self.scheduled.pk, "scheduled", "canceled"), (self.queued.pk, "in_queue", "canceled")]),
+        )
+
+    def test_doctors_only_change_their_own(self):
+        self.client.force_authenticate(self.doctors[0].user)
+        ids = [str(self.scheduled.appointment_id), str(self.queued.appointment_id)]
+        response = self.client.post(
+            "/api/appointments/transition/", {"appointment_ids": ids, "status": "completed"}, format="json"
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data["updated"], [str(self.scheduled.appointment_id)])
+        self.assertEqual(response.data["not_found"], [str(self.queued.appointment_id)])
+        self.assertEqual(self.status_of(self.queued), ("in_queue", "Pending"))
+
+
+class QueueEstimateTests(ClinicTestData, APITestCase):
+    """
+    Queue estimates use the doctor's running mean consult length once it has
+    MIN_SAMPLES consults, and the booked duration before that.
+    """
+
+    PATIENTS = 2
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.today = timezone.localdate()
+
+    def at(self, hour, minute):
+        return timezone.make_aware(datetime.combine(self.today, time(hour, minute)))
+
+    def test_estimates_follow_the_running_mean(self):
+        # A consult starts at check-in or when the previous one ended: the
+        # 8:05 patient's consult starts at 8:10
+        consults = [((8, 0), (8, 10)), ((8, 5), (8, 40)), ((9, 15), (9, 35)), ((9, 50), (10, 10))]
+        for checked_in, completed in consults:
+            record_completions([(self.doctor.id, self.at(*checked_in))], self.at(*completed))
+        stats = cache.get(cache_key(self.doctor.id))
+        self.assertEqual(summarize(stats), {"mean": 20.0, "stddev": 8.2, "samples": 4})
+
+        queue = [
+            self.create_appointment(patient, self.doctor, self.today, time(10, 30), status="in_queue", duration=45)
+            for patient in self.patients
+        ]
+        check_ins = {queue[0].pk: self.at(10, 0), queue[1].pk: self.at(10, 5)}
+        now = self.at(10, 20)
+        # Too few samples: the head, in consult since the 10:10 completion,
+        # is expected to take its booked 45 minutes
+        [estimate] = estimate_queue(queue, check_ins, now=now).values()
+        self.assertEqual([start for _, start in estimate["queue"]], [self.at(10, 10), self.at(10, 55)])
+
+        # A batch completion adds one sample; the zero-length consults
+        # after the first are left out
+        record_completions(
+            [(self.doctor.id, self.at(10, 0)), (self.doctor.id, self.at(10, 5))], self.at(10, 30)
+        )
+        stats = cache.get(cache_key(self.doctor.id))
+        self.assertEqual((stats["count"], stats["mean"]), (5, 20.0))
+        now = self.at(10, 35)
+        [estimate] = estimate_queue(queue, check_ins, now=now).values()
+        self.assertEqual([start for _, start in estimate["queue"]], [self.at(10, 30), self.at(10, 50)])
+
+        # Past its expected end, the next patient is expected now
+        now = self.at(11, 0)
+        [estimate] = estimate_queue(queue, check_ins, now=now).values()
+        self.assertEqual([start for _, start in estimate["queue"]], [self.at(10, 30), now])
+
+
+class IdempotencyKeyTests(ClinicTestData, APITestCase):
+    """
+    A booking retried with the same Idempotency-Key is answered from the
+    stored response instead of booking again.
+    """
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def book_once(self, appointment_time="10:00", key="booking-1"):
+        return self.book(
+            self.patient, self.doctor, "2030-01-07", appointment_time, headers={"Idempotency-Key": key}
+        )
+
+    def test_retry_replays_the_response(self):
+        first = self.book_once()
+        self.assertEqual(first.status_code, 201, first.data)
+        retry = self.book_once()
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data["appointment_id"], first.data["appointment_id"])
+        self.assertEqual(Appointment.objects.count(), 1)
+
+        # Another key is another booking, and conflicts with the first
+        self.assertEqual(self.book_once(key="booking-2").status_code, 400)
+
+    def test_key_reused_for_another_request(self):
+        self.assertEqual(self.book_once().status_code, 201)
+        response = self.book_once("11:00")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_retry_while_in_progress(self):
+        self.assertEqual(self.book_once().status_code, 201)
+        # As seen by a retry before the original stored its response
+        IdempotencyKey.objects.update(response_status=None, response_body=None)
+        self.assertEqual(self.book_once().status_code, 409)
+
+    def test_failed_request_releases_the_key(self):
+        self.create_appointment(self.patient, self.doctor, date(2030, 1, 7), time(10, 0))
+        self.assertEqual(self.book_once().status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_expired_keys_are_purged(self):
+        self.assertEqual(self.book_once().status_code, 201)
+        self.assertEqual(self.book_once("11:00", key="booking-2").status_code, 201)
+        IdempotencyKey.objects.filter(key="booking-1").update(
+            created_at=timezone.now() - IdempotencyKey.TTL - timedelta(minutes=1)
+        )
+        call_command("purge_idempotency_keys", stdout=io.StringIO())
+        self.assertEqual(list(IdempotencyKey.objects.values_list("key", flat=True)), ["booking-2"])
+        # The key is free again
+        self.assertEqual(self.book_once("12:00").status_code, 201)
+
+class WaitlistTests(ClinicTestData, APITestCase):
+    """
+    Canceled slots go to the best matching waitlist entry, which accepts or
+    declines the offer; declined slots move on to the next entry.
+    """
+
+    PATIENTS = 4
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+        response = self.book(self.patients[0], self.doctor, "2030-01-07")
+        self.assertEqual(response.status_code, 201, response.data)
+        self.appointment_id = response.data["appointment_id"]
+
+    def add_entry(self, patient, **fields):
+        response = self.client.post(
+            "/api/appointments/waitlist/",
+            {
+                "patient_uuid": str(patient.patient_id),
+                "date_from": "2030-01-01",
+                "date_to": "2030-01-31",
+                **fields,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data["entry_id"]
+
+    def cancel(self):
+        response = self.client.post(f"/api/appointments/{self.appointment_id}/cancel/")
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data["waitlist"]
+
+    def test_offer_goes_to_highest_priority(self):
+        self.add_entry(self.patients[1], specialization_id=self.specialization.id, priority=1)
+        high = self.add_entry(self.patients[2], doctor_id=self.doctor.id, priority=5)
+        # Outside the entry's time window
+        self.add_entry(self.patients[3], doctor_id=self.doctor.id, priority=9, time_from="14:00")
+
+        offer = self.cancel()
+        self.assertEqual((offer["entry_id"], offer["action"]), (high, "offered"))
+        entry = WaitlistEntry.objects.get(entry_id=high)
+        self.assertEqual(entry.status, "offered")
+        self.assertEqual((entry.offered_date, entry.offered_time), (date(2030, 1, 7), time(10, 0)))
+
+    def test_accept_books_the_offered_slot(self):
+        entry_id = self.add_entry(self.patients[1], doctor_id=self.doctor.id)
+        self.cancel()
+
+        response = self.client.post(
+            f"/api/appointments/waitlist/{entry_id}/accept/", {"billing_amount": "80.00"}, format="json"
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data["status"], "booked")
+        appointment = Appointment.objects.get(appointment_id=response.data["appointment_id"])
+        self.assertEqual(appointment.patient, self.patients[1])
+        self.assertEqual(
+            (appointment.appointment_date, appointment.appointment_time), (date(2030, 1, 7), time(10, 0))
+        )
+        self.assertEqual(Payment.objects.get(appointment=appointment).amount, 80)
+
+        # The offer is used up
+        response = self.client.post(
+            f"/api/appointments/waitlist/{entry_id}/accept/", {"billing_amount": "80.00"}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_accept_rechecks_the_slot(self):
+        entry_id = self.add_entry(self.patients[1], doctor_id=self.doctor.id)
+        self.cancel()
+        # Booked by someone else while the offer was open
+        response = self.book(self.patients[2], self.doctor, "2030-01-07")
+        self.assertEqual(response.status_code, 201, response.data)
+
+        response = self.client.post(
+            f"/api/appointments/waitlist/{entry_id}/accept/", {"billing_amount": "80.00"}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(WaitlistEntry.objects.get(entry_id=entry_id).status, "offered")
+
+    def test_decline_offers_the_next_entry(self):
+        first = self.add_entry(self.patients[1], doctor_id=self.doctor.id, priority=5)
+        second = self.add_entry(self.patients[2], specialization_id=self.specialization.id)
+        self.cancel()
+
+        response = self.client.post(f"/api/appointments/waitlist/{first}/decline/")
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data["status"], "waiting")
+        self.assertIsNone(response.data["offered_date"])
+        self.assertEqual(response.data["next_offer"]["entry_id"], second)
+        self.assertEqual(WaitlistEntry.objects.get(entry_id=second).status, "offered")
+
+        response = self.client.post(f"/api/appointments/waitlist/{first}/decline/")
+        self.assertEqual(response.status_code, 400)
+
+    def test_auto_book(self):
+        entry_id = self.add_entry(
+            self.patients[1], doctor_id=self.doctor.id, auto_book=True, billing_amount="33.00"
+        )
+        result = self.cancel()
+        self.assertEqual(result["action"], "booked")
+        entry = WaitlistEntry.objects.get(entry_id=entry_id)
+        self.assertEqual(entry.status, "booked")
+        self.assertEqual(entry.appointment.patient, self.patients[1])
+        self.assertEqual(Payment.objects.get(appointment=entry.appointment).amount, 33)
+
+
+class ImportConflictTests(ClinicTestData, APITestCase):
+    """
+    Imported rows must not overlap existing appointments or each other,
+    whichever chunk they land in, while canceled rows never conflict.
+    """
+
+    HEADER = "patient_email,doctor_id,appointment_date,appointment_time,duration,status"
+    DOCTORS = 2
+    PATIENTS = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_appointment(cls.patients[0], cls.doctors[0], date(2030, 1, 7), time(9, 0))
+
+    def run_import(self, rows, header=HEADER, **options):
+        data = "\n".join([header, *rows])
+        return import_appointments(io.StringIO(data), "csv", self.manager, **options)
+
+    def errors(self, summary):
+        return {error["row"]: error["error"] for error in summary["errors"]}
+
+    def test_conflicts_with_existing_appointments(self):
+        doctor, other = self.doctors[0].id, self.doctors[1].id
+        summary = self.run_import([
+            # Line 2: the doctor is busy from 9:00 to 9:30
+            f"patient1@example.com,{doctor},2030-01-07,09:15,30,",
+            # Line 3: the patient is busy with another doctor
+            f"patient0@example.com,{other},2030-01-07,08:45,30,",
+            # Line 4: ends as the existing appointment starts
+            f"patient2@example.com,{doctor},2030-01-07,08:30,30,",
+        ])
+        self.assertEqual((summary["created"], summary["failed"]), (1, 2))
+        self.assertEqual(self.errors(summary), {
+            2: "Doctor already has an appointment at this time.",
+            3: "Patient already has an appointment at this time.",
+        })
+
+    def test_conflicts_within_the_file(self):
+        doctor = self.doctors[1].id
+        rows = [
+            f"patient1@example.com,{doctor},2030-01-08,10:00,30,",
+            f"patient2@example.com,{doctor},2030-01-08,10:15,30,",
+            # Runs past midnight into the next row
+            f"patient3@example.com,{doctor},2030-01-08,23:45,30,",
+            f"patient4@example.com,{doctor},2030-01-09,00:00,30,",
+        ]
+        # One chunk, and every row in a chunk of its own
+        for chunk_size in [1_000, 1]:
+            with self.subTest(chunk_size=chunk_size):
+                summary = self.run_import(rows, chunk_size=chunk_size, dry_run=True)
+                self.assertEqual((summary["created"], summary["failed"]), (2, 2))
+                self.assertEqual(set(self.errors(summary)), {3, 5})
+
+    def test_canceled_rows_do_not_conflict(self):
+        summary = self.run_import([
+            f"patient1@example.com,{self.doctors[0].id},2030-01-07,09:00,30,canceled",
+            # The canceled row does not hold the slot either
+            f"patient2@example.com,{self.doctors[1].id},2030-01-07,09:00,30,",
+            f"patient1@example.com,{self.doctors[1].id},2030-01-07,09:00,30,",
+        ])
+        self.assertEqual((summary["created"], summary["failed"]), (2, 1))
+        self.assertEqual(list(self.errors(summary)), [4])
+        self.assertTrue(
+            Appointment.objects.filter(patient=self.patients[1], status="canceled").exists()
+        )
+
+    def test_invalid_billing_amounts_fail_their_row(self):
+        self.client.force_authenticate(self.manager)
+        doctor = self.doctors[1].id
+        rows = "\n".join([
+            f"{self.HEADER},billing_amount",
+            f"patient1@example.com,{doctor},2030-01-08,10:00,30,,NaN",
+            f"patient2@example.com,{doctor},2030-01-08,11:00,30,,Infinity",
+            f"patient3@example.com,{doctor},2030-01-08,12:00,30,,-5",
+            f"patient4@example.com,{doctor},2030-01-08,13:00,30,,0.001",
+            f"patient4@example.com,{doctor},2030-01-08,14:00,30,,12.50",
+        ])
+        response = self.client.post(
+            "/api/appointments/import/",
+            {"file": SimpleUploadedFile("appointments.csv", rows.encode())},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual((response.data["created"], response.data["failed"]), (1, 4))
+        errors = self.errors(response.data)
+        self.assertEqual(errors[2], "billing_amount must be a number.")
+        self.assertEqual(errors[3], "billing_amount must be a number.")
+        self.assertEqual(errors[4], "billing_amount must be positive.")
+        self.assertIn(5, errors)
+        self.assertEqual(Payment.objects.get().amount, 12.5)
+
+    def test_dry_run_creates_nothing(self):
+        self.client.force_authenticate(self.manager)
+        rows = "\n".join([
+            self.HEADER,
+            f"patient1@example.com,{self.doctors[0].id},2030-01-07,09:00,30,",
+            f"patient2@example.com,{self.doctors[1].id},2030-01-07,09:00,30,",
+        ])
+        response = self.client.post(
+            "/api/appointments/import/",
+            {"file": SimpleUploadedFile("appointments.csv", rows.encode()), "dry_run": "true"},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data["created"], response.data["failed"]), (1, 1))
+        self.assertEqual(Appointment.objects.count(), 1)
+
+        response = self.client.post(
+            "/api/appointments/import/",
+            {"file": SimpleUploadedFile("appointments.csv", rows.encode())},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Appointment.objects.count(), 2)
+
+
+class CalendarFeedTests(ClinicTestData, APITestCase):
+    """
+    The feed version lives in the database, so changes made by any process,
+    management commands included, show in every server process's ETag.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.feed = CalendarFeed.objects.create(doctor=cls.doctor)
+
+    def get_feed(self, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        response = self.client.get(f"/api/appointments/calendar/{self.feed.token}.ics", **headers)
+        if response.streaming:
+            b"".join(response.streaming_content)
+        return response
+
+    def test_etag_follows_changes_from_other_processes(self):
+        etag = self.get_feed()["ETag"]
+        # Another process has its own cache
+        cache.clear()
+        self.assertEqual(self.get_feed(etag).status_code, 304)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as csv_file:
+            csv_file.write(
+                "patient_email,doctor_id,appointment_date,appointment_time\n"
+                f"patient0@example.com,{self.doctor.id},{timezone.localdate() + timedelta(days=1)},10:00\n"
+            )
+            csv_file.flush()
+            call_command(
+                "import_appointments", csv_file.name, "--created-by", "manager@example.com", stdout=io.StringIO()
+            )
+        response = self.get_feed(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+class CalendarGridTests(ClinicTestData, APITestCase):
+    """
+    The week view answers 304 until an appointment it shows, or the name of
+    a patient on it, changes.
+    """
+
+    DOCTORS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.appointment = cls.create_appointment(cls.patient, cls.doctors[0], date(2030, 1, 7), time(9, 0))
+        cls.create_appointment(cls.patient, cls.doctors[1], date(2030, 1, 8), time(9, 0))
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def get_grid(self, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(
+            "/api/appointments/calendar/",
+            {
+                "doctors": f"{self.doctors[0].id},{self.doctors[1].id}",
+                "date_from": "2030-01-07",
+                "date_to": "2030-01-13",
+            },
+            **headers,
+        )
+
+    def patient_name(self, response):
+        return response.data["doctors"][str(self.doctors[0].id)]["2030-01-07"][0]["patient_name"]
+
+    def test_not_modified_until_changed(self):
+        response = self.get_grid()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.patient_name(response), "Patient0 Test")
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = self.get_grid(etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Outside the range
+        self.create_appointment(self.patient, self.doctors[0], date(2030, 2, 7), time(9, 0))
+        self.assertEqual(self.get_grid(etag).status_code, 304)
+
+        self.patient.first_name = "Renamed"
+        self.patient.save()
+        response = self.get_grid(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.patient_name(response), "Renamed Test")
+        self.assertNotEqual(response["ETag"], etag)
+        etag = response["ETag"]
+
+        self.client.post(f"/api/appointments/{self.appointment.appointment_id}/cancel/")
+        response = self.get_grid(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+class QueueBoardStreamTests(ClinicTestData, APITestCase):
+    """
+    The queue board stream sends today's queue, then every status change on
+    the boards the user may follow.
+    """
+
+    URL = "/api/appointments/queue-board/stream/"
+    DOCTORS = 2
+    PATIENTS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.secretary = cls.create_user("secretary@example.com", "secretary")
+        today = timezone.localdate()
+        cls.appointments = [
+            cls.create_appointment(patient, doctor, today, time(9, 0))
+            for patient, doctor in zip(cls.patients, cls.doctors)
+        ]
+
+    def transition(self, appointment, status):
+        self.client.force_authenticate(self.manager)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/appointments/transition/",
+                {"appointment_ids": [str(appointment.appointment_id)], "status": status},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def stream(self, user, **params):
+        return self.async_client.get(self.URL, {"token": str(AccessToken.for_user(user)), **params})
+
+    async def read_frame(self, frames):
+        frame = (await asyncio.wait_for(anext(frames), 5)).decode()
+        name, data = frame.strip().split("\n")
+        return name.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+    async def test_status_change_reaches_the_doctors_board(self):
+        response = await self.stream(self.manager, doctor=self.doctors[0].id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        frames = aiter(response.streaming_content)
+        try:
+            name, snapshot = await self.read_frame(frames)
+            self.assertEqual(name, "snapshot")
+            self.assertEqual(
+                [event["appointment_id"] for event in snapshot], [str(self.appointments[0].appointment_id)]
+            )
+
+            # The other doctor's change is not on this board
+            await sync_to_async(self.transition)(self.appointments[1], "in_queue")
+            await sync_to_async(self.transition)(self.appointments[0], "in_queue")
+            name, event = await self.read_frame(frames)
+            self.assertEqual(name, "status")
+            self.assertEqual(event["appointment_id"], str(self.appointments[0].appointment_id))
+            self.assertEqual((event["status"], event["patient_name"]), ("in_queue", "Patient0 Test"))
+        finally:
+            await frames.aclose()
+
+    async def test_staff_follow_every_board(self):
+        response = await self.stream(self.secretary)
+        self.assertEqual(response.status_code, 200)
+        frames = aiter(response.streaming_content)
+        try:
+            name, snapshot = await self.read_frame(frames)
+            self.assertEqual(len(snapshot), 2)
+        finally:
+            await frames.aclose()
+
+    async def test_doctors_follow_their_own_board(self):
+        doctor_user = await sync_to_async(lambda: self.doctors[0].user)()
+        response = await self.stream(doctor_user, doctor=self.doctors[1].id)
+        self.assertEqual(response.status_code, 403)
+
+        response = await self.stream(doctor_user)
+        self.assertEqual(response.status_code, 200)
+        frames = aiter(response.streaming_content)
+        try:
+            name, snapshot = await self.read_frame(frames)
+            self.assertEqual([event["doctor_id"] for event in snapshot], [self.doctors[0].id])
+        finally:
+            await frames.aclose()
+
+    async def test_token_is_required(self):
+        response = await self.async_client.get(self.URL)
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get(self.URL, {"token": "not-a-token"})
+        self.assertEqual(response.status_code, 401)
+        response = await self.stream(self.manager, doctor="abc")
+        self.assertEqual(response.status_code, 400)
+
+    def test_wsgi_answers_503(self):
+        response = self.client.get(self.URL, {"token": str(AccessToken.for_user(self.manager))})
+        self.assertEqual(response.status_code, 503)
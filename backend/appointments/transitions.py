@@ -0,0 +1,136 @@
+"""
+Appointment status state machine.
+
+Transitions lock the affected rows, then move appointments, their payments
+and resource bookings with one UPDATE each, log the changes with one INSERT
+and adjust the report rollups with one upsert per rollup, however many
+appointments are involved.
+"""
+
+from django.db import transaction
+from django.utils import timezone
+
+from .eta import record_completions
+from .events import publish_status_change
+from .ics import touch_calendars
+from .models import Appointment, AppointmentStatusEvent, ResourceBooking
+from reports.rollups import Deltas, appointment_key, revenue_key
+from .waitlist import backfill
+
+
+def record_consults(events, completed_at):
+    """
+    Feed today's completions into the consult-length statistics used for
+    queue estimates, once the transaction commits.
+    """
+    today = [event for event in events if event.appointment_date == timezone.localdate()]
+    if not today:
+        return
+    check_ins = dict(
+        AppointmentStatusEvent.objects.filter(
+            appointment_id__in=[event.appointment_id for event in today], to_status="in_queue"
+        ).values_list("appointment_id", "occurred_at")
+    )
+    completions = [(event.doctor_id, check_ins.get(event.appointment_id)) for event in today]
+    transaction.on_commit(lambda: record_completions(completions, completed_at))
+
+
+def transition_appointments(appointment_ids, target, doctor=None, user=None):
+    """
+    Move the given appointments (by appointment_id) to `target`, recording
+    each change, made by `user`, in the status event log.
+
+    Appointments whose current status does not allow the move are skipped.
+    When `doctor` is given only that doctor's appointments are considered.
+    Returns a dict with the "updated" ids, the "skipped" appointments and
+    their reason, the ids that were "not_found", and for cancellations the
+    "waitlist" offers and bookings made for the freed slots.
+    """
+    from billing.models import Payment
+
+    requested = {str(appointment_id) for appointment_id in appointment_ids}
+    queryset = Appointment.objects.filter(appointment_id__in=requested, is_active=True)
+    if doctor is not None:
+        queryset = queryset.filter(doctor=doctor)
+
+    with transaction.atomic():
+        # Lock in primary key order so concurrent batches cannot deadlock
+        rows = list(
+            queryset.select_for_update()
+            .order_by("pk")
+            .values_list("pk", "appointment_id", "status", "doctor_id", "appointment_date", "archived")
+        )
+
+        allowed, skipped, events = [], [], []
+        deltas = Deltas()
+        doctors = {}
+        for pk, appointment_id, current, doctor_id, appointment_date, archived in rows:
+            if target in Appointment.STATUS_TRANSITIONS.get(current, set()):
+                allowed.append((pk, str(appointment_id)))
+                deltas.add_appointment(appointment_key(appointment_date, doctor_id, current, True, archived), -1)
+                deltas.add_appointment(appointment_key(appointment_date, doctor_id, target, True, archived))
+                doctors[pk] = doctor_id
+                events.append(
+                    AppointmentStatusEvent(
+                        appointment_id=pk,
+                        doctor_id=doctor_id,
+                        appointment_date=appointment_date,
+                        from_status=current,
+                        to_status=target,
+                        changed_by=user,
+                    )
+                )
+            else:
+                skipped.append(
+                    {
+                        "appointment_id": str(appointment_id),
+                        "status": current,
+                        "error": f"Cannot move appointment from {current} to {target}.",
+                    }
+                )
+
+        pks = [pk for pk, _ in allowed]
+        waitlist = []
+        if pks:
+            now = timezone.now()
+            Appointment.objects.filter(pk__in=pks).update(status=target, updated_at=now)
+            for event in events:
+                event.occurred_at = now
+            AppointmentStatusEvent.objects.bulk_create(events)
+            touch_calendars({event.doctor_id for event in events})
+            if target == "completed":
+                record_consults(events, now)
+            if target == "canceled":
+                ResourceBooking.objects.filter(appointment_id__in=pks).update(blocking=False)
+            if target in Appointment.PAYMENT_STATUS_FOR:
+                payment_status = Appointment.PAYMENT_STATUS_FOR[target]
+                payments = Payment.objects.filter(appointment_id__in=pks)
+                for appointment_id, payment_date, method, current, amount in payments.exclude(
+                    status=payment_status
+                ).values_list("appointment_id", "payment_date", "method", "status", "amount"):
+                    doctor_id = doctors[appointment_id]
+                    deltas.add_payment(revenue_key(payment_date, doctor_id, method, current), amount, -1)
+                    deltas.add_payment(revenue_key(payment_date, doctor_id, method, payment_status), amount)
+                payments.update(status=payment_status, updated_at=now)
+            deltas.apply_on_commit()
+
+            today = Appointment.objects.filter(
+                pk__in=pks, appointment_date=timezone.localdate()
+            ).select_related("patient")
+            for appointment in today:
+                publish_status_change(appointment)
+
+            if target == "canceled":
+                waitlist = backfill(
+                    Appointment.objects.filter(pk__in=pks, starts_at__gt=now)
+                    .select_related("doctor")
+                    .order_by("starts_at")
+                )
+
+    found = {str(row[1]) for row in rows}
+    return {
+        "updated": [appointment_id for _, appointment_id in allowed],
+        "skipped": skipped,
+        "not_found": sorted(requested - found),
+        "waitlist": waitlist,
+    }
@@ -1,10 +1,17 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AppointmentViewSet
+from .views import AppointmentViewSet, ResourceViewSet, WaitlistViewSet
+from .ics import doctor_calendar_feed
+from .streams import queue_board_stream
 
 router = DefaultRouter()
+# Before the appointment routes, whose detail pattern would match "waitlist"
+router.register(r"waitlist", WaitlistViewSet, basename="waitlist")
+router.register(r"resources", ResourceViewSet, basename="resource")
 router.register(r"", AppointmentViewSet, basename="appointment")
 
 urlpatterns = [
+    path("queue-board/stream/", queue_board_stream, name="appointment-queue-stream"),
+    path("calendar/<uuid:token>.ics", doctor_calendar_feed, name="appointment-calendar-feed"),
     path("", include(router.urls)),
 ]
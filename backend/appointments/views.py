@@ -1,31 +1,147 @@
 from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.parsers import MultiPartParser
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from django_filters.rest_framework import DjangoFilterBackend
-from .models import Appointment
-from .serializers import AppointmentSerializer
+from .models import Appointment, AppointmentStatusEvent, CalendarFeed, Resource, WaitlistEntry
+from .serializers import (
+    AppointmentImportSerializer,
+    AppointmentSerializer,
+    AppointmentTransitionSerializer,
+    BulkAppointmentSerializer,
+    CalendarQuerySerializer,
+    FreeSlotQuerySerializer,
+    ResourceSerializer,
+    WaitlistAcceptSerializer,
+    WaitlistEntrySerializer,
+    slot_conflict_guard,
+)
+from .scheduling import find_free_slots
+from .eta import estimate_queue, summarize
+from .transitions import transition_appointments
+from .importing import import_appointments
+from .waitlist import book_entry, fill_slot, withdraw_offer
+from .idempotency import idempotent
 from core.permissions import IsManagerOrSecretary, IsDoctor
-from .filters import AppointmentFilter
+from reports.forecasting import no_show_risks
+from .filters import AppointmentFilter, AppointmentSearchFilter
+import base64
+import io
+import hashlib
 import logging
+import math
+from decimal import Decimal, InvalidOperation
 from uuid import UUID
-from django.core.exceptions import ValidationError
+from django.core.exceptions import EmptyResultSet, ValidationError
 from patients.models import Patient
-from django.db.models import Value, CharField, F, Q, Func
+from doctors.models import Doctor
+from datetime import date, timedelta
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import Value, CharField, F, Q, Func, Count, Max
 from django.db.models.functions import Concat
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
 from rest_framework.response import Response
 
 logger = logging.getLogger(__name__)
 
 
 class AppointmentPagination(PageNumberPagination):
+    """
+    Page-number pagination with an opt-in keyset (cursor) mode.
+
+    Passing ``?paginate=cursor`` (first page) or ``?cursor=<token>`` switches
+    to keyset pagination on ``(appointment_date, id)`` descending, which
+    avoids OFFSET scans on deep pages. In that mode ``count`` and
+    ``total_pages`` come from a short-lived cache instead of a COUNT(*) on
+    every request.
+    """
+
     page_size = 10
     page_size_query_param = "page_size"
     max_page_size = 50
+    cursor_query_param = "cursor"
+    count_cache_timeout = 60
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.cursor_mode = (
+            self.cursor_query_param in request.query_params
+            or request.query_params.get("paginate") == "cursor"
+        )
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+
+        self.keyset_page_size = self.get_page_size(request)
+        self.count = self.get_cached_count(queryset)
+
+        queryset = queryset.order_by("-appointment_date", "-id")
+        token = request.query_params.get(self.cursor_query_param)
+        if token:
+            appointment_date, pk = self.decode_cursor(token)
+            queryset = queryset.filter(
+                Q(appointment_date__lt=appointment_date)
+                | Q(appointment_date=appointment_date, id__lt=pk)
+            )
+
+        page = list(queryset[: self.keyset_page_size + 1])
+        self.has_next = len(page) > self.keyset_page_size
+        page = page[: self.keyset_page_size]
+        self.last = page[-1] if page else None
+        return page
+
+    def get_cached_count(self, queryset):
+        try:
+            sql = str(queryset.query)
+        except EmptyResultSet:
+            return 0
+        key = "appointments:count:" + hashlib.sha1(sql.encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def encode_cursor(self, appointment):
+        raw = f"{appointment.appointment_date.isoformat()}:{appointment.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, token):
+        try:
+            raw = base64.urlsafe_b64decode(token.encode()).decode()
+            appointment_date, pk = raw.split(":")
+            return date.fromisoformat(appointment_date), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound("Invalid cursor")
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, "paginate")
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.last)
+        )
 
     def get_paginated_response(self, data):
+        if self.cursor_mode:
+            return Response(
+                {
+                    "count": self.count,
+                    "total_pages": max(1, math.ceil(self.count / self.keyset_page_size)),
+                    "next": self.get_next_link(),
+                    "results": data,
+                }
+            )
         return Response(
             {
                 "count": self.page.paginator.count,
@@ -42,7 +158,7 @@ class AppointmentViewSet(viewsets.ModelViewSet):
     queryset = Appointment.objects.all()
     serializer_class = AppointmentSerializer
     permission_classes = [IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, AppointmentSearchFilter]
     filterset_class = AppointmentFilter
     pagination_class = AppointmentPagination
     ordering_fields = ["appointment_date"]
@@ -52,14 +168,16 @@ class AppointmentViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         # Use super() to allow DjangoFilterBackend to apply filters from request
         queryset = (
-            super().get_queryset().filter(is_active=True).order_by("-appointment_date")
-        )
-        queryset = queryset.annotate(
-            patient_first_name=F("patient__first_name"),
-            patient_last_name=F("patient__last_name"),
-            doctor_first_name=F("doctor__user__first_name"),
-            doctor_last_name=F("doctor__user__last_name"),
+            super()
+            .get_queryset()
+            .filter(is_active=True)
+            .with_details()
+            .order_by("-appointment_date")
         )
+        # Archived appointments are left out unless asked for, which keeps
+        # the scan to the live partitions on a partitioned table
+        if self.request.query_params.get("include_archived") != "true":
+            queryset = queryset.live()
 
         if not self.request.user.is_authenticated:
             return queryset.none()
@@ -75,13 +193,9 @@ class AppointmentViewSet(viewsets.ModelViewSet):
         # For manager, secretary, or other roles: apply filters as requested
         return queryset
 
-    search_fields = [
-        "patient_first_name",
-        "patient_last_name",
-        "doctor_first_name",
-        "doctor_last_name",
-        "status",
-    ]
+    # Used by AppointmentSearchFilter for the schema; matching goes through
+    # the trigram-indexed search_text column.
+    search_fields = ["search_text", "status"]
 
     def get_object(self):
         # Get the appointment ID from the URL
@@ -95,7 +209,9 @@ class AppointmentViewSet(viewsets.ModelViewSet):
 
         try:
             # First try to get the appointment without any filters
-            appointment = Appointment.objects.get(appointment_id=appointment_id)
+            appointment = Appointment.objects.with_details().get(
+                appointment_id=appointment_id
+            )
 
             # Then check if the user has permission to view it
             if self.request.user.role == "doctor":
@@ -134,11 +250,19 @@ class AppointmentViewSet(viewsets.ModelViewSet):
             )
         return super().list(request, *args, **kwargs)
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            # At most one query, see no_show_risks()
+            for appointment, risk in zip(page, no_show_risks(page)):
+                appointment.no_show_risk = risk
+        return page
+
     def get_permissions(self):
         if not self.request.user.is_authenticated:
             return [IsAuthenticated()]
 
-        if self.action in ["create", "update", "partial_update", "destroy"]:
+        if self.action in ["create", "bulk", "update", "partial_update", "destroy"]:
             if self.request.user.role in ["manager", "secretary"]:
                 return [IsManagerOrSecretary()]
             elif self.request.user.role == "doctor":
@@ -164,27 +288,19 @@ class AppointmentViewSet(viewsets.ModelViewSet):
         )
 
     def create(self, request, *args, **kwargs):
-        # Extract the patient's UUID from the request data
-        patient_uuid = request.data.get("patient_uuid")
-        if not patient_uuid:
-            return Response(
-                {"error": "Patient UUID is required."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        # Fetch the patient using the UUID
-        try:
-            patient = get_object_or_404(Patient, patient_id=patient_uuid)
-        except ValidationError:
-            return Response(
-                {"error": "Invalid UUID format."},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
-        # Add the patient to the request data
-        request.data["patient_id"] = patient.id
-
-        # Extract billing amount from request data
+        # Retries carrying the same Idempotency-Key get the stored response
+        return idempotent(request, lambda: self.book(request))
+
+    def book(self, request):
+        """
+        Book an appointment and its billing record in one transaction.
+
+        The request costs a fixed set of statements: the doctor lookup, one
+        query that finds the patient and probes the slot for conflicts, the
+        two inserts and the calendar feed version bump. The response is
+        rendered from the saved instances instead of being reloaded.
+        """
+        # Check the billing fields first, they need no queries
         billing_amount = request.data.pop("billing_amount", None)
         if billing_amount is None:
             return Response(
@@ -193,13 +309,15 @@ class AppointmentViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            billing_amount = float(billing_amount)
+            billing_amount = Decimal(str(billing_amount))
+            if not billing_amount.is_finite():
+                raise InvalidOperation
             if billing_amount <= 0:
                 return Response(
                     {"error": "Billing amount must be greater than zero."},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-        except (ValueError, TypeError):
+        except (InvalidOperation, ValueError, TypeError):
             return Response(
                 {"error": "Invalid billing amount format."},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -215,34 +333,56 @@ class AppointmentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Use the serializer to validate and save the appointment
-        serializer = self.get_serializer(data=request.data)
-        serializer.is_valid(raise_exception=True)
-        appointment = serializer.save(created_by=request.user)
+        # Extract the patient's UUID from the request data
+        patient_uuid = request.data.get("patient_uuid")
+        if not patient_uuid:
+            return Response(
+                {"error": "Patient UUID is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        # Create billing record
         try:
-            from billing.models import Payment
-
-            payment = Payment.objects.create(
-                patient=patient,
-                appointment=appointment,
-                amount=billing_amount,
-                method=billing_method,
-                status="Pending",
-            )
-        except Exception as e:
-            # If billing record creation fails, delete the appointment
-            appointment.delete()
+            UUID(str(patient_uuid))
+        except ValueError:
             return Response(
-                {"error": f"Failed to create billing record: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"error": "Invalid UUID format."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Get the updated appointment with payment information
-        appointment.refresh_from_db()
-        serializer = self.get_serializer(appointment)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+        # The serializer finds the patient with the same query that probes
+        # the slot for conflicts
+        request.data.pop("patient_id", None)
+        context = self.get_serializer_context()
+        context["patient_uuid"] = patient_uuid
+        serializer = self.get_serializer_class()(data=request.data, context=context)
+        serializer.is_valid(raise_exception=True)
+        patient = serializer.validated_data["patient"]
+
+        from billing.models import Payment
+
+        with transaction.atomic():
+            appointment = serializer.save(created_by=request.user)
+            try:
+                payment = Payment.objects.create(
+                    patient=patient,
+                    appointment=appointment,
+                    amount=billing_amount,
+                    method=billing_method,
+                    status="Pending",
+                )
+            except DatabaseError as e:
+                # Roll the appointment back together with the payment
+                transaction.set_rollback(True)
+                return Response(
+                    {"error": f"Failed to create billing record: {str(e)}"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+
+        # Everything the response renders is already in memory
+        appointment.payments = [payment]
+        return Response(
+            self.get_serializer(appointment).data, status=status.HTTP_201_CREATED
+        )
 
     def update(self, request, *args, **kwargs):
         # Extract the patient's UUID from the request data
@@ -301,14 +441,16 @@ class AppointmentViewSet(viewsets.ModelViewSet):
 
                 if billing_amount is not None:
                     try:
-                        billing_amount = float(billing_amount)
+                        billing_amount = Decimal(str(billing_amount))
+                        if not billing_amount.is_finite():
+                            raise InvalidOperation
                         if billing_amount <= 0:
                             return Response(
                                 {"error": "Billing amount must be greater than zero."},
                                 status=status.HTTP_400_BAD_REQUEST,
                             )
                         payment.amount = billing_amount
-                    except (ValueError, TypeError):
+                    except (InvalidOperation, ValueError, TypeError):
                         return Response(
                             {"error": "Invalid billing amount format."},
                             status=status.HTTP_400_BAD_REQUEST,
@@ -336,8 +478,9 @@ class AppointmentViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_404_NOT_FOUND,
                 )
 
-        # Get the updated appointment with payment information
-        appointment.refresh_from_db()
+        # Reload with its payment; refresh_from_db() keeps the prefetched
+        # payments from before the update
+        appointment = Appointment.objects.with_details().get(pk=appointment.pk)
         serializer = self.get_serializer(appointment)
         return Response(serializer.data)
 
@@ -345,45 +488,471 @@ class AppointmentViewSet(viewsets.ModelViewSet):
         instance.is_active = False
         instance.save()
 
-    @action(detail=True, methods=["post"])
-    def cancel(self, request, pk=None):
-        appointment = self.get_object()
-        appointment.status = "canceled"
-        appointment.save()
+    def get_doctor_scope(self):
+        """
+        Return (doctor, error_response): the doctor whose appointments the
+        user may change, or None for managers and secretaries.
+        """
+        if self.request.user.role != "doctor":
+            return None, None
+        if not hasattr(self.request.user, "doctor_profile"):
+            return None, Response(
+                {
+                    "error": "Your doctor profile is not set up. Please contact the administrator to complete your doctor profile setup."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return self.request.user.doctor_profile, None
 
-        # Update billing record if exists
+    def transition_one(self, target, message):
         try:
-            from billing.models import Payment
-
-            payment = Payment.objects.get(appointment=appointment)
-            payment.status = "Failed"
-            payment.save()
-        except Payment.DoesNotExist:
-            pass
+            appointment_id = UUID(str(self.kwargs.get("pk")))
+        except ValueError:
+            appointment_id = None
+        doctor, error = self.get_doctor_scope()
+        if error:
+            return error
+
+        result = transition_appointments(
+            [appointment_id] if appointment_id else [],
+            target,
+            doctor=doctor,
+            user=self.request.user,
+        )
+        if result["skipped"]:
+            return Response(
+                {"error": result["skipped"][0]["error"]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not result["updated"]:
+            return Response(
+                {"error": "Appointment not found."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if result["waitlist"]:
+            # A canceled slot that went to a waiting patient
+            return Response({"status": message, "waitlist": result["waitlist"][0]})
+        return Response({"status": message})
 
-        return Response({"status": "appointment canceled"})
+    @action(detail=True, methods=["post"])
+    def cancel(self, request, pk=None):
+        return self.transition_one("canceled", "appointment canceled")
 
     @action(detail=True, methods=["post"])
     def complete(self, request, pk=None):
-        appointment = self.get_object()
-        appointment.status = "completed"
-        appointment.save()
+        return self.transition_one("completed", "appointment completed")
 
-        # Update billing record if exists
+    @action(detail=True, methods=["post"])
+    def queue(self, request, pk=None):
+        return self.transition_one("in_queue", "appointment moved to queue")
+
+    @action(detail=False, methods=["post"])
+    def transition(self, request):
+        """
+        Move many appointments to one status, e.g. an end-of-day close-out.
+        Rows are locked and updated set-wise; appointments whose current
+        status does not allow the move are reported and left unchanged.
+        """
+        serializer = AppointmentTransitionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        doctor, error = self.get_doctor_scope()
+        if error:
+            return error
+
+        result = transition_appointments(
+            serializer.validated_data["appointment_ids"],
+            serializer.validated_data["status"],
+            doctor=doctor,
+            user=request.user,
+        )
+        return Response({"status": serializer.validated_data["status"], **result})
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        Book a recurring series or a list of appointments in one request.
+        Conflicts are checked for the whole batch before anything is written.
+        """
+        serializer = BulkAppointmentSerializer(
+            data=request.data, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        appointments = serializer.save(created_by=request.user)
+        data = self.get_serializer(appointments, many=True).data
+        return Response(
+            {"count": len(appointments), "results": data},
+            status=status.HTTP_201_CREATED,
+        )
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        parser_classes=[MultiPartParser],
+        permission_classes=[IsAuthenticated, IsManagerOrSecretary],
+    )
+    def import_file(self, request):
+        """
+        Import existing appointments from an uploaded CSV or iCalendar file
+        (``file``), e.g. when onboarding a branch. Rows are validated and
+        inserted in chunks; rows that fail are reported, the rest imported.
+        With ``dry_run`` nothing is inserted.
+        """
+        serializer = AppointmentImportSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        upload = serializer.validated_data["file"]
+        stream = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
         try:
-            from billing.models import Payment
+            summary = import_appointments(
+                stream,
+                serializer.validated_data["format"],
+                request.user,
+                dry_run=serializer.validated_data["dry_run"],
+            )
+        finally:
+            stream.detach()
+        return Response(
+            {"dry_run": serializer.validated_data["dry_run"], **summary},
+            status=status.HTTP_200_OK if serializer.validated_data["dry_run"] else status.HTTP_201_CREATED,
+        )
+
+    @action(detail=False, methods=["get"])
+    def calendar(self, request):
+        """
+        Active appointments of several doctors over a date range, grouped by
+        doctor and day, for the week view. Supports If-None-Match: the ETag
+        only changes when an appointment in the range is added, edited or
+        removed, or its patient renamed, and a match answers 304 without
+        loading any rows.
+        """
+        params = CalendarQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        doctors = params["doctors"]
+        if request.user.role == "doctor":
+            if not hasattr(request.user, "doctor_profile"):
+                return Response(
+                    {
+                        "error": "Your doctor profile is not set up. Please contact the administrator to complete your doctor profile setup."
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            doctors = [request.user.doctor_profile.id]
+
+        in_range = Appointment.objects.filter(
+            doctor_id__in=doctors,
+            appointment_date__gte=params["date_from"],
+            appointment_date__lte=params["date_to"],
+        )
+        # Soft deletes and status changes bump updated_at without removing
+        # the row, so the version covers inactive rows too. Patient renames
+        # bump it through refresh_search_text().
+        version = in_range.aggregate(last_change=Max("updated_at"), rows=Count("id"))
+        etag = quote_etag(
+            hashlib.sha1(
+                f"{doctors}|{params['date_from']}|{params['date_to']}|"
+                f"{version['last_change']}|{version['rows']}".encode()
+            ).hexdigest()
+        )
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        rows = (
+            in_range.filter(is_active=True)
+            .order_by("appointment_date", "appointment_time")
+            .values(
+                "appointment_id",
+                "doctor_id",
+                "appointment_date",
+                "appointment_time",
+                "duration",
+                "status",
+                "patient_id",
+                "patient__first_name",
+                "patient__last_name",
+            )
+        )
+        grid = {str(doctor_id): {} for doctor_id in doctors}
+        for row in rows:
+            day = grid[str(row["doctor_id"])].setdefault(row["appointment_date"].isoformat(), [])
+            day.append(
+                {
+                    "appointment_id": row["appointment_id"],
+                    "time": row["appointment_time"].strftime("%H:%M"),
+                    "duration": row["duration"],
+                    "status": row["status"],
+                    "patient_id": row["patient_id"],
+                    "patient_name": f"{row['patient__first_name']} {row['patient__last_name']}",
+                }
+            )
+        return Response(
+            {
+                "date_from": params["date_from"],
+                "date_to": params["date_to"],
+                "doctors": grid,
+            },
+            headers=headers,
+        )
+
+    @action(detail=False, methods=["get"])
+    def eta(self, request):
+        """
+        Estimated start times of today's in-queue patients, per doctor, from
+        the doctors' running consult-length statistics. Doctors only see
+        their own queue; others may pass ``?doctor=<id>``.
+        """
+        doctor, error = self.get_doctor_scope()
+        if error:
+            return error
+        queue = (
+            Appointment.objects.live()
+            .filter(status="in_queue", is_active=True, appointment_date=timezone.localdate())
+            .select_related("patient")
+            .order_by("doctor_id", "starts_at", "pk")
+        )
+        if doctor is not None:
+            queue = queue.filter(doctor=doctor)
+        elif request.query_params.get("doctor"):
+            try:
+                queue = queue.filter(doctor_id=int(request.query_params["doctor"]))
+            except ValueError:
+                return Response({"error": "Invalid doctor ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+        queue = list(queue)
+        check_ins = dict(
+            AppointmentStatusEvent.objects.filter(
+                appointment_id__in=[appointment.pk for appointment in queue], to_status="in_queue"
+            ).values_list("appointment_id", "occurred_at")
+        )
+        now = timezone.now()
+        estimates = estimate_queue(queue, check_ins, now=now)
+        return Response(
+            {
+                "generated_at": now,
+                "doctors": [
+                    {
+                        "doctor_id": doctor_id,
+                        "consult_minutes": summarize(estimate["stats"]),
+                        "queue": [
+                            {
+                                "position": position,
+                                "appointment_id": appointment.appointment_id,
+                                "patient_id": appointment.patient_id,
+                                "patient_name": f"{appointment.patient.first_name} {appointment.patient.last_name}",
+                                "appointment_time": appointment.appointment_time.strftime("%H:%M"),
+                                "estimated_start": start,
+                                "estimated_wait_minutes": max(0, round((start - now).total_seconds() / 60)),
+                            }
+                            for position, (appointment, start) in enumerate(estimate["queue"], 1)
+                        ],
+                    }
+                    for doctor_id, estimate in estimates.items()
+                ],
+            }
+        )
+
+    @action(detail=False, methods=["get", "post"], url_path="calendar-feed")
+    def calendar_feed(self, request):
+        """
+        The iCalendar feed URL of a doctor's schedule, for calendar apps.
+        Doctors get their own; managers and secretaries pass ``?doctor=<id>``.
+        POST issues a new URL and revokes the old one.
+        """
+        doctor, error = self.get_doctor_scope()
+        if error:
+            return error
+        if doctor is None:
+            if request.user.role not in ["manager", "secretary"]:
+                return Response(
+                    {"error": "You don't have permission to access calendar feeds."},
+                    status=status.HTTP_403_FORBIDDEN,
+                )
+            try:
+                doctor = get_object_or_404(Doctor, pk=int(request.query_params.get("doctor", "")))
+            except ValueError:
+                return Response({"error": "Invalid doctor ID."}, status=status.HTTP_400_BAD_REQUEST)
+
+        feed, created = CalendarFeed.objects.get_or_create(doctor=doctor)
+        if request.method == "POST" and not created:
+            feed.rotate()
+        url = reverse("appointment-calendar-feed", kwargs={"token": feed.token})
+        return Response(
+            {
+                "doctor_id": doctor.id,
+                "url": request.build_absolute_uri(url),
+                "issued_at": feed.issued_at,
+            }
+        )
 
-            payment = Payment.objects.get(appointment=appointment)
-            payment.status = "Paid"
-            payment.save()
-        except Payment.DoesNotExist:
-            pass
+    @action(detail=False, methods=["get"], url_path="free-slots")
+    def free_slots(self, request):
+        """
+        Open slots of the requested duration per doctor and day, for a
+        doctor, a specialization or all active doctors.
+        """
+        params = FreeSlotQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        doctors = Doctor.objects.filter(user__is_active=True).select_related("user")
+        if request.user.role == "doctor":
+            if not hasattr(request.user, "doctor_profile"):
+                return Response(
+                    {
+                        "error": "Your doctor profile is not set up. Please contact the administrator to complete your doctor profile setup."
+                    },
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            doctors = doctors.filter(pk=request.user.doctor_profile.pk)
+        if "doctor" in params:
+            doctors = doctors.filter(pk=params["doctor"])
+        if "specialization" in params:
+            doctors = doctors.filter(specialization_id=params["specialization"])
+
+        patient = None
+        if "patient" in params:
+            patient = get_object_or_404(Patient, pk=params["patient"], is_active=True)
+
+        results = find_free_slots(
+            list(doctors.order_by("id")),
+            params["date_from"],
+            params["date_to"],
+            duration=timedelta(minutes=params["duration"]),
+            day_start=params["day_start"],
+            day_end=params["day_end"],
+            step=timedelta(minutes=params["step"]),
+            patient=patient,
+        )
+        return Response(
+            {
+                "duration": params["duration"],
+                "results": [
+                    {
+                        "doctor_id": entry["doctor"].id,
+                        "doctor_name": f"{entry['doctor'].user.first_name} {entry['doctor'].user.last_name}",
+                        "date": entry["date"],
+                        "slots": [
+                            timezone.localtime(start).strftime("%H:%M")
+                            for start in entry["slots"]
+                        ],
+                    }
+                    for entry in results
+                ],
+            }
+        )
+
+
+class WaitlistViewSet(viewsets.ModelViewSet):
+    """
+    Patients waiting for a slot. Canceling an appointment offers its slot to
+    the best matching entry, or books it for entries with auto_book; offers
+    are accepted or declined here.
+    """
+
+    serializer_class = WaitlistEntrySerializer
+    permission_classes = [IsAuthenticated, IsManagerOrSecretary]
+    lookup_field = "entry_id"
+    filterset_fields = ["status", "doctor", "specialization", "patient"]
 
-        return Response({"status": "appointment completed"})
+    def get_queryset(self):
+        return WaitlistEntry.objects.select_related("patient", "appointment").order_by(
+            "status", "-priority", "created_at"
+        )
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user)
+
+    def perform_destroy(self, instance):
+        instance.status = "withdrawn"
+        instance.save(update_fields=["status", "updated_at"])
+
+    def get_offer(self):
+        entry = self.get_object()
+        if entry.status != "offered":
+            return entry, Response(
+                {"error": "This waitlist entry has no open offer."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return entry, None
 
     @action(detail=True, methods=["post"])
-    def queue(self, request, pk=None):
-        appointment = self.get_object()
-        appointment.status = "in_queue"
-        appointment.save()
-        return Response({"status": "appointment moved to queue"})
+    def accept(self, request, entry_id=None):
+        """
+        Book the offered slot. The slot is not held while an offer is open,
+        so it is validated again like any new booking.
+        """
+        entry, error = self.get_offer()
+        if error:
+            return error
+        billing = WaitlistAcceptSerializer(data=request.data)
+        billing.is_valid(raise_exception=True)
+
+        context = self.get_serializer_context()
+        context["patient"] = entry.patient
+        slot = AppointmentSerializer(
+            data={
+                "doctor_id": entry.offered_doctor_id,
+                "appointment_date": entry.offered_date,
+                "appointment_time": entry.offered_time,
+                "duration": entry.duration,
+            },
+            context=context,
+        )
+        slot.is_valid(raise_exception=True)
+        with slot_conflict_guard():
+            book_entry(
+                entry,
+                slot.validated_data["doctor"],
+                entry.offered_date,
+                entry.offered_time,
+                request.user,
+                billing.validated_data["billing_amount"],
+                billing.validated_data["billing_method"],
+            )
+        return Response(self.get_serializer(entry).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["post"])
+    def decline(self, request, entry_id=None):
+        """
+        Put the entry back in the queue and offer the slot to the next
+        matching entry.
+        """
+        entry, error = self.get_offer()
+        if error:
+            return error
+        doctor = entry.offered_doctor
+        slot = (entry.offered_date, entry.offered_time, entry.offered_duration)
+        with transaction.atomic():
+            withdraw_offer(entry)
+            result = None
+            if doctor is not None and Appointment.slot_bounds(*slot)[0] > timezone.now():
+                result = fill_slot(doctor, *slot, exclude=entry.pk)
+        return Response({**self.get_serializer(entry).data, "next_offer": result})
+
+
+class ResourceViewSet(viewsets.ModelViewSet):
+    """
+    Rooms and equipment that appointments hold through resource_ids.
+    Anyone may list them; managers and secretaries maintain them. Deleting
+    deactivates, so past bookings keep their resource.
+    """
+
+    serializer_class = ResourceSerializer
+    filterset_fields = ["kind"]
+
+    def get_permissions(self):
+        if self.action in ("list", "retrieve"):
+            return [IsAuthenticated()]
+        return [IsAuthenticated(), IsManagerOrSecretary()]
+
+    def get_queryset(self):
+        queryset = Resource.objects.all()
+        if self.request.query_params.get("include_inactive") != "true":
+            queryset = queryset.filter(is_active=True)
+        return queryset
+
+    def perform_destroy(self, instance):
+        instance.is_active = False
+        instance.save(update_fields=["is_active", "updated_at"])
@@ -0,0 +1,179 @@
+"""
+Waitlist matching.
+
+The waiting entries for a doctor, and for any doctor of a specialization,
+are each kept in serving order (highest priority, then oldest) by a partial
+index. Matching a freed slot reads the head of both queues, walking each
+index in order up to the first entry that fits and whose patient is free,
+so it stays cheap however long the waitlist grows.
+"""
+
+from datetime import datetime, timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .events import publish_status_change
+from .models import Appointment, WaitlistEntry, is_slot_conflict
+
+
+def find_match(doctor, appointment_date, appointment_time, duration, exclude=None):
+    """
+    Return the best waiting entry the slot fits whose patient is free at
+    that time, or None. The entry is locked; entries locked by a concurrent
+    cancellation are skipped.
+    """
+    starts = datetime.combine(appointment_date, appointment_time)
+    ends = starts + timedelta(minutes=duration)
+    fits = Q(date_from__lte=appointment_date, date_to__gte=appointment_date, duration__lte=duration)
+    fits &= Q(time_from__isnull=True) | Q(time_from__lte=appointment_time)
+    if ends.date() == starts.date():
+        fits &= Q(time_to__isnull=True) | Q(time_to__gte=ends.time())
+    else:
+        fits &= Q(time_to__isnull=True)
+
+    starts_at, ends_at = Appointment.slot_bounds(appointment_date, appointment_time, duration)
+    # The date bound lets a partitioned table prune to the slot's month;
+    # it admits appointments that started the day before and run past
+    # midnight
+    busy = (
+        Appointment.objects.blocking()
+        .overlapping(starts_at, ends_at)
+        .filter(
+            patient=OuterRef("patient"),
+            appointment_date__range=(appointment_date - timedelta(days=1), ends.date()),
+        )
+    )
+    entries = WaitlistEntry.objects.filter(fits, ~Exists(busy), status="waiting")
+    if exclude is not None:
+        entries = entries.exclude(pk=exclude)
+
+    # Head of each queue: an ordered scan of its index that stops at the
+    # first entry that fits
+    queues = [entries.filter(doctor=doctor)]
+    if doctor.specialization_id is not None:
+        queues.append(entries.filter(doctor__isnull=True, specialization_id=doctor.specialization_id))
+    heads = [
+        queue.select_for_update(skip_locked=True).order_by("-priority", "created_at", "pk").first()
+        for queue in queues
+    ]
+    return min(
+        (head for head in heads if head is not None),
+        key=lambda entry: (-entry.priority, entry.created_at, entry.pk),
+        default=None,
+    )
+
+
+def book_entry(entry, doctor, appointment_date, appointment_time, created_by, billing_amount, billing_method):
+    """
+    Book the entry's patient into the slot with a pending payment and mark
+    the entry booked.
+    """
+    from billing.models import Payment
+
+    appointment = Appointment(
+        patient=entry.patient,
+        doctor=doctor,
+        appointment_date=appointment_date,
+        appointment_time=appointment_time,
+        duration=entry.duration,
+        notes=entry.notes,
+        status="scheduled",
+        created_by=created_by,
+    )
+    appointment.save()
+    Payment.objects.create(
+        patient=entry.patient,
+        appointment=appointment,
+        amount=billing_amount,
+        method=billing_method,
+        status="Pending",
+    )
+    entry.status = "booked"
+    entry.appointment = appointment
+    entry.save(update_fields=["status", "appointment", "updated_at"])
+    publish_status_change(appointment)
+    return appointment
+
+
+OFFER_FIELDS = ["offered_doctor", "offered_date", "offered_time", "offered_duration", "offered_at"]
+
+
+def offer_entry(entry, doctor, appointment_date, appointment_time, duration):
+    entry.status = "offered"
+    entry.offered_doctor = doctor
+    entry.offered_date = appointment_date
+    entry.offered_time = appointment_time
+    entry.offered_duration = duration
+    entry.offered_at = timezone.now()
+    entry.save(update_fields=["status", *OFFER_FIELDS, "updated_at"])
+
+
+def withdraw_offer(entry):
+    """
+    Put an offered entry back in the queue.
+    """
+    entry.status = "waiting"
+    for field in OFFER_FIELDS:
+        setattr(entry, field, None)
+    entry.save(update_fields=["status", *OFFER_FIELDS, "updated_at"])
+
+
+def fill_slot(doctor, appointment_date, appointment_time, duration, exclude=None):
+    """
+    Hand a free slot to the best matching waiting entry: book it when the
+    entry asks for that and carries a billing amount, offer it otherwise.
+    Must run inside a transaction. Returns a summary dict or None.
+    """
+    starts_at, ends_at = Appointment.slot_bounds(appointment_date, appointment_time, duration)
+    if Appointment.objects.blocking().overlapping(starts_at, ends_at).filter(doctor=doctor).exists():
+        return None
+
+    entry = find_match(doctor, appointment_date, appointment_time, duration, exclude=exclude)
+    if entry is None:
+        return None
+
+    summary = {"entry_id": str(entry.entry_id), "patient_id": entry.patient_id}
+    if entry.auto_book and entry.billing_amount is not None:
+        try:
+            with transaction.atomic():
+                appointment = book_entry(
+                    entry,
+                    doctor,
+                    appointment_date,
+                    appointment_time,
+                    entry.created_by,
+                    entry.billing_amount,
+                    entry.billing_method,
+                )
+        except IntegrityError as e:
+            if not is_slot_conflict(e):
+                raise
+            # Someone booked the slot in the meantime
+            return None
+        return {**summary, "action": "booked", "appointment_id": str(appointment.appointment_id)}
+
+    offer_entry(entry, doctor, appointment_date, appointment_time, duration)
+    return {**summary, "action": "offered"}
+
+
+def backfill(appointments):
+    """
+    Offer or book the slots of just canceled appointments. Returns one
+    summary per slot that found a taker.
+    """
+    now = timezone.now()
+    results = []
+    for appointment in appointments:
+        if appointment.starts_at <= now:
+            continue
+        result = fill_slot(
+            appointment.doctor,
+            appointment.appointment_date,
+            appointment.appointment_time,
+            appointment.duration,
+        )
+        if result:
+            results.append({"canceled_appointment_id": str(appointment.appointment_id), **result})
+    return results
@@ -31,5 +31,15 @@ class Payment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Changing these moves the payment between report rollups, see
+    # reports/rollups.py
+    ROLLUP_FIELDS = ('appointment_id', 'payment_date', 'method', 'status', 'amount')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_rollup_values = {name: instance.__dict__.get(name) for name in cls.ROLLUP_FIELDS}
+        return instance
+
     def __str__(self):
         return f"Payment for {self.appointment} - {self.status}"
@@ -2,6 +2,8 @@
 ASGI config for clinic_management project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve the project through it (e.g. uvicorn core.asgi:application) for the
+long-lived appointment queue board stream.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -0,0 +1,30 @@
+"""
+Database helpers shared by the project apps.
+
+Production runs on PostgreSQL, but some schema features (GiST exclusion
+constraints, partial expression indexes, extensions) have no equivalent on
+other backends. The helpers below let migrations and queries use them when
+available and degrade to plain Django elsewhere.
+"""
+
+from django.db import connection as default_connection, migrations
+
+
+def is_postgres(connection=None):
+    """Return True when the given (or default) connection is PostgreSQL."""
+    connection = connection or default_connection
+    return connection.vendor == "postgresql"
+
+
+class PostgresRunSQL(migrations.RunSQL):
+    """
+    RunSQL operation that is a no-op on non-PostgreSQL databases.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if is_postgres(schema_editor.connection):
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if is_postgres(schema_editor.connection):
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
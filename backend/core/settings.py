@@ -41,6 +41,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "corsheaders",
     "rest_framework",
     "djoser",
@@ -241,6 +242,7 @@ CORS_ALLOWED_ORIGINS = ["http://localhost:3000"]
 
 CORS_ALLOW_HEADERS = list(default_headers) + [
     "authorization",
+    "idempotency-key",
 ]
 SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ("JWT",),
@@ -0,0 +1,81 @@
+"""
+Test data shared by the app test suites.
+
+ClinicTestData gives a test case a manager, a specialization, DOCTORS doctors
+and PATIENTS patients, with predictable emails (doctor0@example.com,
+patient0@example.com, ...), plus helpers to add appointments directly or book
+them through the API.
+"""
+
+from datetime import date
+
+from appointments.models import Appointment
+from doctors.models import Doctor, Specialization
+from patients.models import Patient
+from users.models import User
+
+
+class ClinicTestData:
+    DOCTORS = 1
+    PATIENTS = 1
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.manager = cls.create_user("manager@example.com", "manager")
+        cls.specialization = Specialization.objects.create(name="Cardiology", description="Heart")
+        cls.doctors = [cls.create_doctor(f"doctor{i}@example.com") for i in range(cls.DOCTORS)]
+        cls.patients = [
+            cls.create_patient(f"Patient{i}", email=f"patient{i}@example.com") for i in range(cls.PATIENTS)
+        ]
+        cls.doctor = cls.doctors[0] if cls.doctors else None
+        cls.patient = cls.patients[0] if cls.patients else None
+
+    @classmethod
+    def create_user(cls, email, role, **fields):
+        return User.objects.create_user(email=email, password="pass", role=role, **fields)
+
+    @classmethod
+    def create_doctor(cls, email, **fields):
+        return Doctor.objects.create(
+            user=cls.create_user(email, "doctor", **fields), specialization=cls.specialization
+        )
+
+    @classmethod
+    def create_patient(cls, first_name, **fields):
+        fields = {"birth_date": date(1990, 1, 1), "gender": "female", **fields}
+        return Patient.objects.create(
+            first_name=first_name, last_name="Test", created_by=cls.manager, **fields
+        )
+
+    @classmethod
+    def create_appointment(cls, patient, doctor, appointment_date, appointment_time, **fields):
+        """
+        Save an appointment directly, without the API's validation.
+        """
+        return Appointment.objects.create(
+            patient=patient,
+            doctor=doctor,
+            appointment_date=appointment_date,
+            appointment_time=appointment_time,
+            created_by=cls.manager,
+            **fields,
+        )
+
+    def book(self, patient, doctor, appointment_date, appointment_time="10:00", headers=None, **fields):
+        """
+        POST a booking as the client's current user and return the response.
+        """
+        return self.client.post(
+            "/api/appointments/",
+            {
+                "patient_uuid": str(patient.patient_id),
+                "doctor_id": doctor.id,
+                "appointment_date": str(appointment_date),
+                "appointment_time": appointment_time,
+                "billing_amount": "100.00",
+                **fields,
+            },
+            format="json",
+            headers=headers,
+        )
@@ -0,0 +1,136 @@
+"""
+Patient counts by age bucket, gender, blood type and city.
+
+The whole cube is one query: patients grouped by gender, blood type and
+city, with one conditional COUNT per age bucket. Any slice of it is summed
+from the cube, so a dashboard showing several slices still costs one query.
+
+Cubes are cached under a version stamp of the patient table that patient
+saves and deletes replace once they commit, see touch_patients(), and under
+the day, as ages move on with birthdays.
+"""
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from patients.models import Patient
+
+VERSION_KEY = 'reports:patients-version'
+CUBE_KEY = 'reports:demographics:{}:{}:{}'
+CUBE_TIMEOUT = 24 * 60 * 60
+DIMENSIONS = ['age', 'gender', 'blood_type', 'city']
+# Lower bounds of the age buckets: 0-10, 11-20, ..., 61+
+AGE_BOUNDS = [0, 11, 21, 31, 41, 51, 61]
+MAX_AGE_BUCKETS = 20
+MAX_AGE = 150
+
+
+def touch_patients():
+    """
+    Give the patient table a new version once the current transaction
+    commits.
+    """
+    transaction.on_commit(lambda: cache.set(VERSION_KEY, uuid4().hex, timeout=None))
+
+
+def patients_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def parse_age_bounds(text):
+    """
+    Age bucket lower bounds from a comma-separated list such as "0,18,65".
+    Raises ValueError unless they are ascending whole years.
+    """
+    try:
+        bounds = [int(bound) for bound in text.split(',')]
+    except ValueError:
+        raise ValueError('Age buckets must be whole numbers of years.') from None
+    if not 1 <= len(bounds) <= MAX_AGE_BUCKETS:
+        raise ValueError(f'Give 1 to {MAX_AGE_BUCKETS} age buckets.')
+    if bounds[0] < 0 or bounds[-1] > MAX_AGE or any(a >= b for a, b in zip(bounds, bounds[1:])):
+        raise ValueError(f'Age buckets must be ascending ages from 0 to {MAX_AGE}.')
+    return bounds
+
+
+def age_buckets(bounds):
+    """
+    (label, youngest, oldest) per bucket; the last has no oldest age.
+    """
+    buckets = [(f'{low}-{high - 1}', low, high - 1) for low, high in zip(bounds, bounds[1:])]
+    buckets.append((f'{bounds[-1]}+', bounds[-1], None))
+    return buckets
+
+
+def years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        # 29 February
+        return day.replace(year=day.year - years, day=28)
+
+
+def age_filter(youngest, oldest, today):
+    condition = Q(birth_date__lte=years_before(today, youngest))
+    if oldest is not None:
+        condition &= Q(birth_date__gt=years_before(today, oldest + 1))
+    return condition
+
+
+def build_cube(bounds, today):
+    buckets = age_buckets(bounds)
+    counts = {
+        f'age_{index}': Count('id', filter=age_filter(youngest, oldest, today))
+        for index, (_, youngest, oldest) in enumerate(buckets)
+    }
+    cells = []
+    for row in Patient.objects.values('gender', 'blood_type', 'city').annotate(**counts).order_by():
+        for index, (label, _, _) in enumerate(buckets):
+            if row[f'age_{index}']:
+                cells.append({
+                    'age': label,
+                    'gender': row['gender'],
+                    'blood_type': row['blood_type'],
+                    'city': row['city'],
+                    'count': row[f'age_{index}'],
+                })
+    return {'buckets': [label for label, _, _ in buckets], 'cells': cells}
+
+
+def demographics_cube(bounds=AGE_BOUNDS, today=None):
+    """
+    The cube for these age bucket bounds: ``buckets``, the bucket labels,
+    and ``cells``, one per age bucket, gender, blood type and city that
+    has patients, with their ``count``. Patients younger than the first
+    bound are in no cell.
+    """
+    today = today or timezone.localdate()
+    key = CUBE_KEY.format(patients_version(), today.isoformat(), ','.join(map(str, bounds)))
+    cube = cache.get(key)
+    if cube is None:
+        cube = build_cube(bounds, today)
+        cache.set(key, cube, CUBE_TIMEOUT)
+    return cube
+
+
+def cube_slice(cube, dimension):
+    """
+    Counts per value of one dimension, in bucket order for ages and
+    largest first otherwise.
+    """
+    totals = {}
+    for cell in cube['cells']:
+        totals[cell[dimension]] = totals.get(cell[dimension], 0) + cell['count']
+    if dimension == 'age':
+        return [{'name': label, 'count': totals.get(label, 0)} for label in cube['buckets']]
+    return [
+        {'name': name, 'count': count}
+        for name, count in sorted(totals.items(), key=lambda item: (-item[1], str(item[0])))
+    ]
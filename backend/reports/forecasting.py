@@ -0,0 +1,381 @@
+"""
+Appointment volume and no-show forecasts.
+
+Both models are fitted offline by the train_forecasts command and stored in
+ForecastModel rows, so every server process reads the same models. Scoring
+only reads them back and does arithmetic, so no-show risks are computed
+inline when a page of appointments is rendered.
+
+No-show risk is a naive Bayes model over the booking's weekday, hour, lead
+time and doctor, and the patient's record of earlier no-shows. It is stored
+as outcome counts per feature value, so a refresh counts the days finished
+since the previous one and adds them in. An appointment is a no-show when
+its day passed without the patient being checked in or seen, or when it was
+canceled less than LATE_CANCEL_HOURS before its start; earlier cancellations
+free the slot for someone else and are left out.
+
+Volume is forecast per doctor and weekday as an exponentially weighted
+average of past weeks, folded in one finished week at a time.
+
+Patients' records of shows and no-shows are NoShowRecord rows. Server
+processes keep a model they have read in the cache for MODEL_TIMEOUT, so
+they pick up a refreshed model within that time even when the cache is not
+shared with the command.
+"""
+import math
+from bisect import bisect_right
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.utils import timezone
+
+from appointments.models import Appointment, AppointmentStatusEvent
+
+from .models import ForecastModel, NoShowRecord
+
+NO_SHOW_MODEL = 'no-show'
+VOLUME_MODEL = 'volume'
+MODEL_KEY = 'reports:forecast:{}'
+MODEL_TIMEOUT = 5 * 60
+
+LATE_CANCEL_HOURS = 24
+# Lower bounds of the lead time buckets, in days
+LEAD_DAYS = [0, 1, 3, 7, 14, 30]
+FEATURES = ['weekday', 'hour', 'lead', 'doctor', 'history']
+# The model abstains until it has seen this many outcomes of each kind
+MIN_OUTCOMES = 30
+# Scheduled appointments at or above this risk are overbooking candidates
+OVERBOOK_RISK = 0.3
+CHUNK_DAYS = 31
+HISTORY_WEEKS = 26
+ALPHA = 0.3
+
+OUTCOME_COLUMNS = [
+    'patient_id', 'doctor_id', 'appointment_date', 'appointment_time', 'starts_at', 'created_at',
+    'status', 'canceled_at',
+]
+
+
+def lead_bucket(days):
+    return str(LEAD_DAYS[max(bisect_right(LEAD_DAYS, days) - 1, 0)])
+
+
+def history_bucket(shows, no_shows):
+    if shows + no_shows == 0:
+        return 'new'
+    return str(min(no_shows, 2))
+
+
+def stored_model(name):
+    """
+    The model stored under this name, or None before it is trained.
+    """
+    row = ForecastModel.objects.filter(name=name).first()
+    if row is None:
+        return None
+    return {**row.state, 'trained_through': row.trained_through, 'trained_at': row.trained_at}
+
+
+def load_model(name):
+    """
+    stored_model() through the cache, for scoring. Training reads the
+    stored model, as a cached one may be out of date.
+    """
+    key = MODEL_KEY.format(name)
+    model = cache.get(key)
+    if model is None:
+        model = stored_model(name)
+        if model is not None:
+            cache.set(key, model, MODEL_TIMEOUT)
+    return model
+
+
+def save_model(name, model):
+    ForecastModel.objects.update_or_create(
+        name=name,
+        defaults={
+            'state': {
+                field: value for field, value in model.items() if field not in ('trained_through', 'trained_at')
+            },
+            'trained_through': model['trained_through'],
+            'trained_at': model['trained_at'],
+        },
+    )
+    transaction.on_commit(lambda: cache.set(MODEL_KEY.format(name), model, MODEL_TIMEOUT))
+
+
+def patient_records(patient_ids):
+    """
+    {patient_id: (shows, no_shows)} of the patients with a record.
+    """
+    return {
+        patient_id: (shows, no_shows)
+        for patient_id, shows, no_shows in NoShowRecord.objects.filter(patient_id__in=patient_ids).values_list(
+            'patient_id', 'shows', 'no_shows'
+        )
+    }
+
+
+def empty_no_show_model(trained_through):
+    return {
+        'counts': {feature: {} for feature in FEATURES},
+        'outcomes': [0, 0],
+        'trained_through': trained_through,
+        'trained_at': None,
+    }
+
+
+def load_outcomes(date_from, date_to):
+    """
+    Active appointments from date_from to date_to with their no-show label,
+    in start order. Early cancellations are left out.
+    """
+    canceled_at = AppointmentStatusEvent.objects.filter(
+        appointment_id=OuterRef('pk'), to_status='canceled',
+    ).values('occurred_at')[:1]
+    # Archived appointments are history too, so all partitions are read
+    rows = (
+        Appointment.objects.filter(is_active=True, appointment_date__range=(date_from, date_to))
+        .annotate(canceled_at=Subquery(canceled_at))
+        .values_list(*OUTCOME_COLUMNS)
+    )
+    frame = pd.DataFrame.from_records(rows, columns=OUTCOME_COLUMNS)
+    if frame.empty:
+        return frame
+    for column in ['starts_at', 'created_at', 'canceled_at']:
+        frame[column] = pd.to_datetime(frame[column], utc=True)
+
+    canceled = frame['status'] == 'canceled'
+    late = frame['canceled_at'] > frame['starts_at'] - pd.Timedelta(hours=LATE_CANCEL_HOURS)
+    frame = frame[~canceled | late].copy()
+    frame['no_show'] = (frame['status'] == 'scheduled') | (frame['status'] == 'canceled')
+    return frame.sort_values('starts_at', kind='stable')
+
+
+def outcome_features(frame, records):
+    """
+    The feature values of each outcome, with the patient history counted up
+    to it from `records`, {patient_id: [shows, no_shows]} before the frame.
+    """
+    no_show = frame['no_show'].astype(int)
+    base = pd.DataFrame.from_dict(records, orient='index', columns=['shows', 'no_shows'])
+    base = base.reindex(frame['patient_id'].to_numpy(), fill_value=0)
+    by_patient = frame.groupby('patient_id')
+    prior_no_shows = base['no_shows'].to_numpy() + (by_patient['no_show'].cumsum().astype(int) - no_show).to_numpy()
+    prior_total = base['shows'].to_numpy() + base['no_shows'].to_numpy() + by_patient.cumcount().to_numpy()
+
+    lead = ((frame['starts_at'] - frame['created_at']) / pd.Timedelta(days=1)).to_numpy()
+    lead_index = np.clip(np.searchsorted(LEAD_DAYS, np.floor(lead), side='right') - 1, 0, None)
+    return pd.DataFrame({
+        'weekday': pd.to_datetime(frame['appointment_date']).dt.weekday.astype(str).to_numpy(),
+        'hour': [str(moment.hour) for moment in frame['appointment_time']],
+        'lead': np.array(LEAD_DAYS)[lead_index].astype(str),
+        'doctor': frame['doctor_id'].astype(str).to_numpy(),
+        'history': np.where(prior_total == 0, 'new', np.minimum(prior_no_shows, 2).astype(str)),
+        'no_show': no_show.to_numpy(),
+    })
+
+
+def fold_outcomes(model, frame):
+    """
+    Add the outcomes in `frame` to the model's counts and to the patients'
+    records.
+    """
+    patient_ids = frame['patient_id'].unique().tolist()
+    stored = patient_records(patient_ids)
+    records = {patient_id: stored.get(patient_id, (0, 0)) for patient_id in patient_ids}
+    features = outcome_features(frame, records)
+
+    for feature in FEATURES:
+        table = model['counts'][feature]
+        totals = features.groupby(feature)['no_show'].agg(['size', 'sum'])
+        for value, size, no_shows in totals.itertuples():
+            shows_so_far, no_shows_so_far = table.get(value, (0, 0))
+            table[value] = [shows_so_far + int(size - no_shows), no_shows_so_far + int(no_shows)]
+    no_shows = int(features['no_show'].sum())
+    model['outcomes'] = [model['outcomes'][0] + len(features) - no_shows, model['outcomes'][1] + no_shows]
+
+    totals = frame.groupby('patient_id')['no_show'].agg(['size', 'sum'])
+    NoShowRecord.objects.bulk_create(
+        [
+            NoShowRecord(
+                patient_id=int(patient_id),
+                shows=records[patient_id][0] + int(size - no_shows),
+                no_shows=records[patient_id][1] + int(no_shows),
+            )
+            for patient_id, size, no_shows in totals.itertuples()
+        ],
+        batch_size=1_000,
+        update_conflicts=True,
+        unique_fields=['patient'],
+        update_fields=['shows', 'no_shows'],
+    )
+
+
+def refresh_no_show_model(today=None, full=False, progress=None):
+    """
+    Fold the days finished since the model was last refreshed into it, or
+    fit it on the whole history when there is no model yet or `full` is set.
+    """
+    today = today or timezone.localdate()
+    model = None if full else stored_model(NO_SHOW_MODEL)
+    if model is None:
+        first = (
+            Appointment.objects.filter(is_active=True)
+            .order_by('appointment_date')
+            .values_list('appointment_date', flat=True)
+            .first()
+        )
+        model = empty_no_show_model((first or today) - timedelta(days=1))
+        # The records start afresh with the model
+        with transaction.atomic():
+            NoShowRecord.objects.all().delete()
+            save_model(NO_SHOW_MODEL, model)
+
+    through = today - timedelta(days=1)
+    start = model['trained_through'] + timedelta(days=1)
+    while start <= through:
+        end = min(start + timedelta(days=CHUNK_DAYS - 1), through)
+        frame = load_outcomes(start, end)
+        # Saved per chunk, so an interrupted run resumes where it stopped
+        with transaction.atomic():
+            if not frame.empty:
+                fold_outcomes(model, frame)
+            model['trained_through'] = end
+            model['trained_at'] = timezone.now()
+            save_model(NO_SHOW_MODEL, model)
+        if progress:
+            progress(start, end, len(frame))
+        start = end + timedelta(days=1)
+    return model
+
+
+def is_usable(model):
+    return model is not None and min(model['outcomes']) >= MIN_OUTCOMES
+
+
+def no_show_probability(model, values):
+    """
+    Naive Bayes posterior from the feature values, Laplace-smoothed.
+    """
+    shows, no_shows = model['outcomes']
+    log_odds = math.log(no_shows / shows)
+    for feature, value in values.items():
+        table = model['counts'][feature]
+        if value not in table:
+            # Never seen in training, e.g. a new doctor: no evidence either way
+            continue
+        feature_shows, feature_no_shows = table[value]
+        values_seen = len(table) + 1
+        log_odds += math.log((feature_no_shows + 1) / (no_shows + values_seen))
+        log_odds -= math.log((feature_shows + 1) / (shows + values_seen))
+    return 1 / (1 + math.exp(-min(max(log_odds, -30), 30)))
+
+
+def no_show_risks(appointments, model=None):
+    """
+    No-show probability of each appointment that is still scheduled, None
+    for the others or while there is no usable model. Costs at most the
+    model lookup and one query for the patients' records, whatever the
+    number of appointments.
+    """
+    appointments = list(appointments)
+    model = load_model(NO_SHOW_MODEL) if model is None else model
+    if not is_usable(model):
+        return [None] * len(appointments)
+
+    scheduled = {appointment.patient_id for appointment in appointments if appointment.status == 'scheduled'}
+    records = patient_records(scheduled) if scheduled else {}
+    risks = []
+    for appointment in appointments:
+        if appointment.status != 'scheduled':
+            risks.append(None)
+            continue
+        shows, no_shows = records.get(appointment.patient_id, (0, 0))
+        values = {
+            'weekday': str(appointment.appointment_date.weekday()),
+            'hour': str(appointment.appointment_time.hour),
+            'lead': lead_bucket((appointment.starts_at - appointment.created_at) // timedelta(days=1)),
+            'doctor': str(appointment.doctor_id),
+            'history': history_bucket(shows, no_shows),
+        }
+        risks.append(round(no_show_probability(model, values), 3))
+    return risks
+
+
+def load_daily_volume(date_from, date_to):
+    rows = (
+        Appointment.objects.blocking()
+        .filter(appointment_date__range=(date_from, date_to))
+        .values('doctor_id', 'appointment_date')
+        .annotate(count=Count('id'))
+        .values_list('doctor_id', 'appointment_date', 'count')
+    )
+    return pd.DataFrame.from_records(rows, columns=['doctor_id', 'appointment_date', 'count'])
+
+
+def refresh_volume_model(today=None, full=False):
+    """
+    Fold the weeks finished since the model was last refreshed into the
+    per-doctor weekday levels, starting HISTORY_WEEKS back for a new model.
+    """
+    today = today or timezone.localdate()
+    this_monday = today - timedelta(days=today.weekday())
+    model = None if full else stored_model(VOLUME_MODEL)
+    if model is None:
+        model = {
+            'levels': {},
+            'weeks': 0,
+            'trained_through': this_monday - timedelta(weeks=HISTORY_WEEKS, days=1),
+            'trained_at': None,
+        }
+
+    start = model['trained_through'] + timedelta(days=1)
+    weeks = (this_monday - start).days // 7
+    if weeks <= 0:
+        return model
+
+    daily = load_daily_volume(start, this_monday - timedelta(days=1))
+    # Doctors are keyed by their ID as text, like the stored JSON
+    daily_doctors = daily['doctor_id'].astype(str)
+    doctors = sorted(set(model['levels']) | set(daily_doctors))
+    position = {doctor_id: index for index, doctor_id in enumerate(doctors)}
+    days = (pd.to_datetime(daily['appointment_date']) - pd.Timestamp(start)).dt.days.to_numpy()
+    observed = np.zeros((weeks, len(doctors), 7))
+    np.add.at(
+        observed,
+        (days // 7, daily_doctors.map(position).to_numpy(dtype=int), days % 7),
+        daily['count'].to_numpy(),
+    )
+
+    levels = np.array([model['levels'].get(doctor_id, [np.nan] * 7) for doctor_id in doctors]).reshape(len(doctors), 7)
+    for week in observed:
+        # A doctor's level starts with their first week of appointments
+        new = np.isnan(levels) & (week.sum(axis=1, keepdims=True) > 0)
+        levels = np.where(new, week, ALPHA * week + (1 - ALPHA) * levels)
+
+    model = {
+        'levels': {
+            doctor_id: [round(float(value), 3) for value in row]
+            for doctor_id, row in zip(doctors, levels)
+            if not np.isnan(row).any()
+        },
+        'weeks': model['weeks'] + weeks,
+        'trained_through': start + timedelta(weeks=weeks, days=-1),
+        'trained_at': timezone.now(),
+    }
+    save_model(VOLUME_MODEL, model)
+    return model
+
+
+def volume_forecast(model, doctor_id):
+    """
+    Expected appointments of the doctor per weekday, Monday first.
+    """
+    if model is None:
+        return None
+    return model['levels'].get(str(doctor_id), [0.0] * 7)
@@ -0,0 +1,26 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from reports.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recomputes the daily appointment and revenue rollups behind the "
+        "reports from the appointment and payment tables"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--since",
+            type=date.fromisoformat,
+            help="Only rebuild the days from this date (YYYY-MM-DD) on.",
+        )
+        parser.add_argument("--batch-size", type=int, default=5_000)
+
+    def handle(self, *args, **options):
+        written = rebuild_rollups(since=options["since"], batch_size=options["batch_size"])
+        for name, rows in written.items():
+            self.stdout.write(f"  {name}: {rows} rows")
+        self.stdout.write(self.style.SUCCESS("Rollups rebuilt"))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from reports.forecasting import is_usable, refresh_no_show_model, refresh_volume_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Folds the appointments finished since the last run into the stored "
+        "no-show and volume forecast models; run it daily"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Refit both models from scratch instead of updating them.",
+        )
+
+    def handle(self, *args, **options):
+        def progress(date_from, date_to, outcomes):
+            self.stdout.write(f"  {date_from} to {date_to}: {outcomes} outcomes")
+
+        no_show = refresh_no_show_model(full=options["full"], progress=progress)
+        shows, no_shows = no_show["outcomes"]
+        self.stdout.write(
+            f"No-show model through {no_show['trained_through']}: "
+            f"{shows} shows, {no_shows} no-shows"
+        )
+        if not is_usable(no_show):
+            self.stdout.write(self.style.WARNING("Too few outcomes yet; no-show risks are not scored"))
+
+        volume = refresh_volume_model(full=options["full"])
+        self.stdout.write(
+            f"Volume model through {volume['trained_through']}: "
+            f"{len(volume['levels'])} doctors, {volume['weeks']} weeks"
+        )
+        self.stdout.write(self.style.SUCCESS("Forecast models refreshed"))
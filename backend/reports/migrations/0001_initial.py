@@ -0,0 +1,86 @@
+# Generated by Django 5.2 on 2026-10-18 20:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    Appointment = apps.get_model('appointments', 'Appointment')
+    Payment = apps.get_model('billing', 'Payment')
+    AppointmentRollup = apps.get_model('reports', 'AppointmentRollup')
+    RevenueRollup = apps.get_model('reports', 'RevenueRollup')
+    AppointmentRollup.objects.bulk_create(
+        (
+            AppointmentRollup(
+                date=row['appointment_date'], doctor_id=row['doctor_id'], status=row['status'],
+                is_active=row['is_active'], archived=row['archived'], count=row['total'],
+            )
+            for row in Appointment.objects.values('appointment_date', 'doctor_id', 'status', 'is_active', 'archived')
+            .annotate(total=Count('id'))
+            .order_by()
+            .iterator(chunk_size=5000)
+        ),
+        batch_size=5000,
+    )
+    RevenueRollup.objects.bulk_create(
+        (
+            RevenueRollup(
+                date=row['date'], doctor_id=row['appointment__doctor_id'], method=row['method'],
+                status=row['status'], count=row['total'], amount=row['total_amount'],
+            )
+            for row in Payment.objects.annotate(date=TruncDate('payment_date'))
+            .values('date', 'appointment__doctor_id', 'method', 'status')
+            .annotate(total=Count('id'), total_amount=Sum('amount'))
+            .order_by()
+            .iterator(chunk_size=5000)
+        ),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('appointments', '0011_resources'),
+        ('billing', '0003_alter_payment_appointment'),
+        ('doctors', '0003_alter_doctor_bio_alter_doctor_license_number_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AppointmentRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('status', models.CharField(max_length=20)),
+                ('is_active', models.BooleanField()),
+                ('archived', models.BooleanField()),
+                ('count', models.IntegerField(default=0)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='doctors.doctor')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['doctor', 'date'], name='appointment_rollup_doctor_idx')],
+                'constraints': [models.UniqueConstraint(fields=('date', 'doctor', 'status', 'is_active', 'archived'), name='appointment_rollup_key')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RevenueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('method', models.CharField(max_length=50)),
+                ('status', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='doctors.doctor')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('date', 'doctor', 'method', 'status'), name='revenue_rollup_key')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
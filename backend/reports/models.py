@@ -1,3 +1,65 @@
 from django.db import models
 
-# Create your models here.
+from doctors.models import Doctor
+from patients.models import Patient
+
+
+class AppointmentRollup(models.Model):
+    """
+    Number of appointments per day, doctor, status and active and archived
+    flag. Kept up to date as appointments change, see rollups.py.
+    """
+    date = models.DateField()
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=20)
+    is_active = models.BooleanField()
+    archived = models.BooleanField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'doctor', 'status', 'is_active', 'archived'], name='appointment_rollup_key',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['doctor', 'date'], name='appointment_rollup_doctor_idx'),
+        ]
+
+
+class RevenueRollup(models.Model):
+    """
+    Number and sum of payments per day of payment, doctor, method and
+    status. Kept up to date as payments change, see rollups.py.
+    """
+    date = models.DateField()
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='+')
+    method = models.CharField(max_length=50)
+    status = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'doctor', 'method', 'status'], name='revenue_rollup_key'),
+        ]
+
+
+class ForecastModel(models.Model):
+    """
+    Fitted state of a forecast model, see forecasting.py. Written by the
+    train_forecasts command and read by every server process.
+    """
+    name = models.CharField(max_length=50, primary_key=True)
+    state = models.JSONField()
+    trained_through = models.DateField()
+    trained_at = models.DateTimeField(null=True)
+
+
+class NoShowRecord(models.Model):
+    """
+    A patient's shows and no-shows counted into the no-show model so far.
+    """
+    patient = models.OneToOneField(Patient, on_delete=models.CASCADE, primary_key=True, related_name='+')
+    shows = models.PositiveIntegerField(default=0)
+    no_shows = models.PositiveIntegerField(default=0)
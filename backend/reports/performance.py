@@ -0,0 +1,93 @@
+"""
+Per-doctor performance figures for the doctor performance report.
+
+doctor_performance() annotates the doctors with their figures through
+correlated subqueries over the daily rollups, so a page of doctors, in any
+order, is one query however many doctors it holds. The figures cover the
+appointments dated, and the payments made, from ``date_from`` to
+``date_to``; either bound is optional.
+
+    completion rate    = completed / appointments, in percent
+    cancellation rate  = canceled / appointments, in percent
+    revenue            = sum of paid payments
+    average daily load = appointments not canceled / days with any of them
+"""
+from django.db.models import Count, DecimalField, FloatField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from doctors.models import Doctor
+
+from .models import AppointmentRollup, RevenueRollup
+
+# Report field: what it is sorted on
+ORDERINGS = {
+    'id': ['id'],
+    'name': ['user__first_name', 'user__last_name'],
+    'specialization': ['specialization__name'],
+    'appointments': ['total_appointments'],
+    'completed': ['completed_appointments'],
+    'canceled': ['canceled_appointments'],
+    'completionRate': ['completion_rate'],
+    'cancellationRate': ['cancellation_rate'],
+    'revenue': ['revenue'],
+    'avgDailyLoad': ['avg_daily_load'],
+}
+
+
+def parse_ordering(text):
+    """
+    Sort fields from a comma-separated list of report fields, each
+    optionally prefixed with "-" for descending. Raises ValueError for
+    unknown fields.
+    """
+    fields = []
+    for name in filter(None, (part.strip() for part in text.split(','))):
+        descending = name.startswith('-')
+        if name.lstrip('-') not in ORDERINGS:
+            raise ValueError(f'Cannot sort on {name.lstrip("-")}; use one of {", ".join(ORDERINGS)}.')
+        fields += [f'-{field}' if descending else field for field in ORDERINGS[name.lstrip('-')]]
+    # Ties, and so pages, in a stable order
+    return fields + ['id']
+
+
+def per_doctor(rollups, total):
+    return Subquery(
+        rollups.filter(doctor=OuterRef('pk')).order_by().values('doctor').annotate(total=total).values('total')
+    )
+
+
+def ratio(part, whole):
+    return Cast(part, FloatField()) / Cast(NullIf(whole, 0), FloatField())
+
+
+def doctor_performance(date_from=None, date_to=None):
+    appointments = AppointmentRollup.objects.filter(count__gt=0)
+    payments = RevenueRollup.objects.filter(status='Paid')
+    if date_from is not None:
+        appointments = appointments.filter(date__gte=date_from)
+        payments = payments.filter(date__gte=date_from)
+    if date_to is not None:
+        appointments = appointments.filter(date__lte=date_to)
+        payments = payments.filter(date__lte=date_to)
+
+    # Seven correlated subqueries, one per figure, each a grouped pass over
+    # the doctor's rollup rows. A rate sums its own counts again inside its
+    # subquery: built on the count annotations instead, Django would inline
+    # their subqueries into it, twice the work
+    total = Sum('count')
+    completed = Sum('count', filter=Q(status='completed'))
+    canceled = Sum('count', filter=Q(status='canceled'))
+    booked = Sum('count', filter=~Q(status='canceled'))
+    active_days = Count('date', distinct=True, filter=~Q(status='canceled'))
+    return Doctor.objects.select_related('user', 'specialization').annotate(
+        total_appointments=Coalesce(per_doctor(appointments, total), 0),
+        completed_appointments=Coalesce(per_doctor(appointments, completed), 0),
+        canceled_appointments=Coalesce(per_doctor(appointments, canceled), 0),
+        completion_rate=Coalesce(per_doctor(appointments, ratio(completed, total) * 100.0), 0.0),
+        cancellation_rate=Coalesce(per_doctor(appointments, ratio(canceled, total) * 100.0), 0.0),
+        avg_daily_load=Coalesce(per_doctor(appointments, ratio(booked, active_days)), 0.0),
+        revenue=Coalesce(
+            per_doctor(payments, Sum('amount')), Value(0),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        ),
+    )
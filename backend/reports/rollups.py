@@ -0,0 +1,184 @@
+"""
+Daily rollups behind the manager reports.
+
+AppointmentRollup and RevenueRollup hold counts, and payment sums, per day
+and a few dimensions, so the reports read a few rows per day instead of
+scanning appointments and payments. They are maintained with deltas: a
+write that moves an appointment or payment from one rollup key to another
+takes it off the old key and adds it to the new one, with one upsert per
+table. Saves and deletes are picked up by the handlers in signals.py;
+set-wise writes (status transitions, bulk booking and import, archiving)
+pass their changes in through Deltas.
+
+Deltas are applied once the transaction commits, so a rolled back write
+leaves the rollups alone and bookings for the same doctor and day do not
+queue up behind a rollup row lock. Writes that bypass these hooks, such as
+raw SQL, are repaired by the rebuild_rollups command, best run while few
+writes come in: a change committed while it runs may be counted twice.
+"""
+from collections import Counter
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from appointments.models import Appointment
+from billing.models import Payment
+
+from .models import AppointmentRollup, RevenueRollup
+
+APPOINTMENT_KEY = ['date', 'doctor_id', 'status', 'is_active', 'archived']
+REVENUE_KEY = ['date', 'doctor_id', 'method', 'status']
+UPSERT_BATCH = 500
+# Payment amounts are stored to the cent
+CENTS = Decimal('0.01')
+
+
+def appointment_key(appointment_date, doctor_id, status, is_active, archived):
+    return (appointment_date, doctor_id, status, is_active, archived)
+
+
+def revenue_key(payment_date, doctor_id, method, status):
+    return (timezone.localdate(payment_date), doctor_id, method, status)
+
+
+def add_to_rollup(model, key_fields, value_fields, rows):
+    """
+    Add each row's values to the rollup row with the same key, creating it
+    when there is none. Rows are (*key, *values) tuples.
+    """
+    opts = model._meta
+    fields = [opts.get_field(name) for name in key_fields + value_fields]
+    quote = connection.ops.quote_name
+    table = quote(opts.db_table)
+    columns = [quote(field.column) for field in fields]
+    keys, values = columns[:len(key_fields)], columns[len(key_fields):]
+    placeholder = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    # Sorted, so concurrent upserts lock rows in the same order
+    rows = sorted(rows)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH):
+            batch = rows[start:start + UPSERT_BATCH]
+            cursor.execute(
+                f'INSERT INTO {table} ({", ".join(columns)}) VALUES {", ".join([placeholder] * len(batch))} '
+                f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET '
+                + ', '.join(f'{column} = {table}.{column} + EXCLUDED.{column}' for column in values),
+                [
+                    field.get_db_prep_save(value, connection)
+                    for row in batch
+                    for field, value in zip(fields, row)
+                ],
+            )
+
+
+class Deltas:
+    """
+    Changes to both rollups, collected and then applied together.
+    """
+
+    def __init__(self):
+        self.appointments = Counter()
+        self.payments = Counter()
+        self.amounts = Counter()
+
+    def add_appointment(self, key, count=1):
+        self.appointments[key] += count
+        return self
+
+    def add_payment(self, key, amount, count=1):
+        # Amounts set by views may be floats or have more places than are
+        # stored; count them as the database will hold them
+        amount = Decimal(str(amount)).quantize(CENTS)
+        self.payments[key] += count
+        self.amounts[key] += amount * count
+        return self
+
+    def add_new(self, appointments=(), payments=()):
+        """
+        Count in just created appointments and payments; the payments must
+        have their appointment set.
+        """
+        for appointment in appointments:
+            self.add_appointment(appointment_key(
+                appointment.appointment_date, appointment.doctor_id, appointment.status,
+                appointment.is_active, appointment.archived,
+            ))
+        for payment in payments:
+            self.add_payment(
+                revenue_key(payment.payment_date, payment.appointment.doctor_id, payment.method, payment.status),
+                payment.amount,
+            )
+        return self
+
+    def apply(self):
+        add_to_rollup(
+            AppointmentRollup, APPOINTMENT_KEY, ['count'],
+            [(*key, count) for key, count in self.appointments.items() if count],
+        )
+        add_to_rollup(
+            RevenueRollup, REVENUE_KEY, ['count', 'amount'],
+            [
+                (*key, count, self.amounts[key])
+                for key, count in self.payments.items()
+                if count or self.amounts[key]
+            ],
+        )
+
+    def apply_on_commit(self):
+        if self.appointments or self.payments:
+            transaction.on_commit(self.apply, robust=True)
+
+
+def rebuild_rollups(since=None, batch_size=5000):
+    """
+    Recompute the rollups from the appointment and payment tables, all of
+    them or the days from `since` on. Returns the number of rollup rows
+    written to each.
+    """
+    appointments = Appointment.objects.all()
+    payments = Payment.objects.annotate(date=TruncDate('payment_date'))
+    appointment_rollups = AppointmentRollup.objects.all()
+    revenue_rollups = RevenueRollup.objects.all()
+    if since is not None:
+        appointments = appointments.filter(appointment_date__gte=since)
+        payments = payments.filter(date__gte=since)
+        appointment_rollups = appointment_rollups.filter(date__gte=since)
+        revenue_rollups = revenue_rollups.filter(date__gte=since)
+
+    appointment_rows = (
+        AppointmentRollup(
+            date=row['appointment_date'], doctor_id=row['doctor_id'], status=row['status'],
+            is_active=row['is_active'], archived=row['archived'], count=row['total'],
+        )
+        for row in appointments.values('appointment_date', 'doctor_id', 'status', 'is_active', 'archived')
+        .annotate(total=Count('id'))
+        .order_by()
+        .iterator(chunk_size=batch_size)
+    )
+    revenue_rows = (
+        RevenueRollup(
+            date=row['date'], doctor_id=row['appointment__doctor_id'], method=row['method'],
+            status=row['status'], count=row['total'], amount=row['total_amount'],
+        )
+        for row in payments.values('date', 'appointment__doctor_id', 'method', 'status')
+        .annotate(total=Count('id'), total_amount=Sum('amount'))
+        .order_by()
+        .iterator(chunk_size=batch_size)
+    )
+
+    written = {}
+    with transaction.atomic():
+        appointment_rollups.delete()
+        revenue_rollups.delete()
+        for model, rows in [(AppointmentRollup, appointment_rows), (RevenueRollup, revenue_rows)]:
+            written[model.__name__] = 0
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    written[model.__name__] += len(model.objects.bulk_create(batch))
+                    batch = []
+            written[model.__name__] += len(model.objects.bulk_create(batch))
+    return written
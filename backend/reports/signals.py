@@ -0,0 +1,99 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from appointments.models import Appointment
+from billing.models import Payment
+from patients.models import Patient
+
+from .demographics import touch_patients
+from .rollups import Deltas, appointment_key, revenue_key
+
+
+def current_values(instance):
+    return {name: instance.__dict__.get(name) for name in instance.ROLLUP_FIELDS}
+
+
+def stored_values(instance, created=False):
+    """
+    The rollup fields as they are in the database before this write, or None
+    for a new row. Rows loaded without some of the fields count as unchanged.
+    """
+    if created:
+        return None
+    loaded = getattr(instance, '_loaded_rollup_values', None)
+    if loaded is None or None in loaded.values():
+        return current_values(instance)
+    return loaded
+
+
+def appointment_rollup_key(values):
+    return appointment_key(
+        values['appointment_date'], values['doctor_id'], values['status'], values['is_active'], values['archived'],
+    )
+
+
+def appointment_doctor_id(payment, appointment_id):
+    if appointment_id == payment.appointment_id and Payment.appointment.is_cached(payment):
+        return payment.appointment.doctor_id
+    return Appointment.objects.filter(pk=appointment_id).values_list('doctor_id', flat=True).first()
+
+
+def payment_rollup_key(values, doctor_id):
+    return revenue_key(values['payment_date'], doctor_id, values['method'], values['status'])
+
+
+@receiver(post_save, sender=Appointment)
+def roll_up_appointment(sender, instance, created, **kwargs):
+    old, new = stored_values(instance, created), current_values(instance)
+    instance._loaded_rollup_values = new
+    if old == new:
+        return
+    deltas = Deltas()
+    if old is not None:
+        deltas.add_appointment(appointment_rollup_key(old), -1)
+    deltas.add_appointment(appointment_rollup_key(new))
+    if old is not None and old['doctor_id'] != new['doctor_id']:
+        # Revenue is rolled up by doctor, so the payments move along
+        for payment_date, method, status, amount in Payment.objects.filter(appointment=instance).values_list(
+            'payment_date', 'method', 'status', 'amount',
+        ):
+            deltas.add_payment(revenue_key(payment_date, old['doctor_id'], method, status), amount, -1)
+            deltas.add_payment(revenue_key(payment_date, new['doctor_id'], method, status), amount)
+    deltas.apply_on_commit()
+
+
+@receiver(post_delete, sender=Appointment)
+def roll_down_appointment(sender, instance, **kwargs):
+    Deltas().add_appointment(appointment_rollup_key(stored_values(instance)), -1).apply_on_commit()
+
+
+@receiver(post_save, sender=Payment)
+def roll_up_payment(sender, instance, created, **kwargs):
+    old, new = stored_values(instance, created), current_values(instance)
+    instance._loaded_rollup_values = new
+    if old == new:
+        return
+    deltas = Deltas()
+    doctor_id = appointment_doctor_id(instance, new['appointment_id'])
+    if old is not None:
+        old_doctor_id = doctor_id
+        if old['appointment_id'] != new['appointment_id']:
+            old_doctor_id = appointment_doctor_id(instance, old['appointment_id'])
+        deltas.add_payment(payment_rollup_key(old, old_doctor_id), old['amount'], -1)
+    deltas.add_payment(payment_rollup_key(new, doctor_id), new['amount'])
+    deltas.apply_on_commit()
+
+
+@receiver(post_delete, sender=Payment)
+def roll_down_payment(sender, instance, **kwargs):
+    values = stored_values(instance)
+    doctor_id = appointment_doctor_id(instance, values['appointment_id'])
+    if doctor_id is None:
+        return
+    Deltas().add_payment(payment_rollup_key(values, doctor_id), values['amount'], -1).apply_on_commit()
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def patients_changed(sender, **kwargs):
+    touch_patients()
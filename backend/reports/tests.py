@@ -1,3 +1,519 @@
-from django.test import TestCase
+import io
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db.models import Sum
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from appointments.models import Appointment, AppointmentStatusEvent
+from billing.models import Payment
+from core.testing import ClinicTestData
+from medical_records.models import MedicalRecord
+from reports.demographics import cube_slice, demographics_cube
+from reports.forecasting import NO_SHOW_MODEL, VOLUME_MODEL, stored_model
+from reports.models import AppointmentRollup, NoShowRecord, RevenueRollup
+from reports.rollups import rebuild_rollups
+from reports.timeseries import time_series
+
+
+class RollupDeltaTests(ClinicTestData, APITestCase):
+    """
+    Every way of writing appointments and payments must leave the rollups
+    as rebuild_rollups() would compute them from scratch.
+    """
+
+    DOCTORS = 2
+    PATIENTS = 3
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def rollups(self):
+        # Rows whose deltas cancelled out are left behind with zeros
+        return (
+            sorted(
+                AppointmentRollup.objects.filter(count__gt=0).values_list(
+                    'date', 'doctor_id', 'status', 'is_active', 'archived', 'count'
+                )
+            ),
+            sorted(
+                RevenueRollup.objects.exclude(count=0, amount=0).values_list(
+                    'date', 'doctor_id', 'method', 'status', 'count', 'amount'
+                )
+            ),
+        )
+
+    def assertRollupsMatchRebuild(self):
+        live = self.rollups()
+        rebuild_rollups()
+        self.assertEqual(live, self.rollups())
+
+    def book_committed(self, *args, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.book(*args, **fields)
+        self.assertEqual(response.status_code, 201, response.data)
+        return response.data
+
+    def test_booking_and_update(self):
+        booked = self.book_committed(self.patients[0], self.doctors[0], '2030-01-07')
+        self.assertRollupsMatchRebuild()
+        self.assertEqual(
+            AppointmentRollup.objects.get(date=date(2030, 1, 7), doctor=self.doctors[0]).count, 1
+        )
+
+        # Moving to another doctor and day moves the appointment and its
+        # payment between rollup rows
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/appointments/{booked["appointment_id"]}/',
+                {'doctor_id': self.doctors[1].id, 'appointment_date': '2030-01-08'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertRollupsMatchRebuild()
+        self.assertEqual(
+            RevenueRollup.objects.get(doctor=self.doctors[1], status='Pending').amount, Decimal('100.00')
+        )
+
+    def test_billing_update(self):
+        booked = self.book_committed(self.patients[0], self.doctors[0], '2030-01-07')
+        # The old and new amount land on the same rollup row
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/appointments/{booked["appointment_id"]}/', {'billing_amount': '250.00'}, format='json'
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertRollupsMatchRebuild()
+        rollup = RevenueRollup.objects.get(doctor=self.doctors[0], status='Pending')
+        self.assertEqual((rollup.count, rollup.amount), (1, Decimal('250.00')))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/appointments/{booked["appointment_id"]}/',
+                {'billing_amount': '99.99', 'billing_method': 'Insurance'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertRollupsMatchRebuild()
+        rollup = RevenueRollup.objects.get(method='Insurance')
+        self.assertEqual((rollup.count, rollup.amount), (1, Decimal('99.99')))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f'/api/appointments/{booked["appointment_id"]}/',
+                {'billing_amount': 'abc'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, 400)
+
+    def test_transitions_and_bulk_booking(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/appointments/bulk/',
+                {
+                    'patient_uuid': str(self.patients[1].patient_id),
+                    'doctor_id': self.doctors[1].id,
+                    'billing_amount': '40.00',
+                    'recurrence': {'start_date': '2030-02-04', 'appointment_time': '09:00', 'occurrences': 3},
+                },
+                format='json',
+            )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertRollupsMatchRebuild()
+
+        ids = [
+            str(appointment_id)
+            for appointment_id in Appointment.objects.order_by('appointment_date').values_list(
+                'appointment_id', flat=True
+            )[:2]
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/appointments/transition/', {'appointment_ids': ids, 'status': 'canceled'}, format='json'
+            )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertRollupsMatchRebuild()
+        self.assertEqual(
+            AppointmentRollup.objects.filter(status='canceled').values_list('count', flat=True).get(
+                date=date(2030, 2, 4)
+            ),
+            1,
+        )
+
+    def test_import(self):
+        self.book_committed(self.patients[0], self.doctors[0], '2030-03-04', '09:00')
+        rows = [
+            'patient_email,doctor_id,appointment_date,appointment_time,duration,status,billing_amount,billing_method',
+            f'patient1@example.com,{self.doctors[0].id},2030-03-05,09:00,30,completed,25.00,Cash',
+            f'patient2@example.com,{self.doctors[1].id},2030-03-05,09:00,30,,,',
+            # Conflicts with the booking above, so it is not counted
+            f'patient1@example.com,{self.doctors[0].id},2030-03-04,09:15,30,,,',
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/appointments/import/',
+                {'file': SimpleUploadedFile('appointments.csv', '\n'.join(rows).encode())},
+                format='multipart',
+            )
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['created'], 2)
+        self.assertRollupsMatchRebuild()
+
+    def test_delete_and_archive(self):
+        for i, patient in enumerate(self.patients):
+            self.book(patient, self.doctors[0], f'2030-04-0{i + 1}')
+        # Push one far into the past, bypassing the hooks, then repair
+        old = Appointment.objects.order_by('appointment_date').first()
+        Appointment.objects.filter(pk=old.pk).update(
+            appointment_date=timezone.localdate() - timedelta(days=800), status='completed'
+        )
+        rebuild_rollups()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_appointments', stdout=open('/dev/null', 'w'))
+        self.assertTrue(Appointment.objects.get(pk=old.pk).archived)
+        self.assertRollupsMatchRebuild()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Payment.objects.filter(appointment__appointment_date=date(2030, 4, 2)).get().delete()
+            Appointment.objects.get(appointment_date=date(2030, 4, 3)).delete()
+        self.assertRollupsMatchRebuild()
+
+    def test_rolled_back_write_leaves_rollups(self):
+        # A conflicting booking fails inside its transaction, and its deltas
+        # are never applied
+        self.book_committed(self.patients[0], self.doctors[0], '2030-05-06')
+        before = self.rollups()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.book(self.patients[1], self.doctors[0], '2030-05-06')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(before, self.rollups())
+
+
+class ForecastTests(ClinicTestData, APITestCase):
+    """
+    train_forecasts stores the models in the database, where every server
+    process finds them, and refreshes them without counting a day twice.
+    """
+
+    PATIENTS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # Patient0 never turns up, Patient1 always does
+        today = timezone.localdate()
+        history = []
+        for days in range(1, 61):
+            for hour, (patient, status) in enumerate(zip(cls.patients, ['scheduled', 'completed'])):
+                appointment = Appointment(
+                    patient=patient,
+                    doctor=cls.doctor,
+                    appointment_date=today - timedelta(days=days),
+                    appointment_time=time(9 + hour),
+                    status=status,
+                    created_by=cls.manager,
+                )
+                appointment.sync_denormalized_fields()
+                history.append(appointment)
+        Appointment.objects.bulk_create(history)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def train(self, *args):
+        call_command('train_forecasts', *args, stdout=io.StringIO())
+        return stored_model(NO_SHOW_MODEL), sorted(NoShowRecord.objects.values_list('patient_id', 'shows', 'no_shows'))
+
+    def test_models_are_shared_and_refreshed_once(self):
+        model, records = self.train()
+        self.assertEqual(model['outcomes'], [60, 60])
+        self.assertEqual(records, [(self.patients[0].id, 0, 60), (self.patients[1].id, 60, 0)])
+        self.assertIsNotNone(stored_model(VOLUME_MODEL))
+
+        # Nothing new to fold in
+        self.assertEqual(self.train(), (model, records))
+        refitted, refitted_records = self.train('--full')
+        self.assertEqual((refitted['outcomes'], refitted['counts']), (model['outcomes'], model['counts']))
+        self.assertEqual(refitted_records, records)
+
+        # A server process with a cache of its own scores from the stored model
+        cache.clear()
+        next_week = timezone.localdate() + timedelta(days=7)
+        for hour, patient in enumerate(self.patients):
+            self.create_appointment(patient, self.doctor, next_week, time(9 + hour))
+        self.client.force_authenticate(self.manager)
+        response = self.client.get('/api/appointments/', {'appointment_date': next_week.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        risks = {row['patient']['first_name']: row['no_show_risk'] for row in response.data['results']}
+        self.assertGreater(risks['Patient0'], 0.5)
+        self.assertLess(risks['Patient1'], 0.5)
+
+        response = self.client.get('/api/reports/forecast/', {'week': next_week.isoformat()})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['doctors'][0]['booked'], 2)
+        self.assertEqual(len(response.data['doctors'][0]['overbooking_candidates']), 1)
+
+
+class TurnaroundTests(ClinicTestData, APITestCase):
+    """
+    A consult starts at check-in or when the doctor's previous consult
+    ended, whichever is later.
+    """
+
+    PATIENTS = 4
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def log(self, appointment, to_status, hour, minute):
+        AppointmentStatusEvent.objects.create(
+            appointment=appointment,
+            doctor=appointment.doctor,
+            appointment_date=appointment.appointment_date,
+            from_status='scheduled',
+            to_status=to_status,
+            occurred_at=timezone.make_aware(datetime.combine(appointment.appointment_date, time(hour, minute))),
+        )
+
+    def test_percentiles(self):
+        day = date(2030, 6, 3)
+        queued, overran, late, walked_in = [
+            self.create_appointment(patient, self.doctor, day, time(9, 10 * i), duration=30)
+            for i, patient in enumerate(self.patients)
+        ]
+        # Waits 0, 15 and 40 minutes; consults 20, 30 and 40 minutes
+        self.log(queued, 'in_queue', 9, 0)
+        self.log(queued, 'completed', 9, 20)
+        self.log(overran, 'in_queue', 9, 5)
+        self.log(overran, 'completed', 9, 50)
+        self.log(late, 'in_queue', 9, 10)
+        self.log(late, 'completed', 10, 30)
+        # Never checked in: completed, but not measured
+        self.log(walked_in, 'completed', 11, 0)
+
+        response = self.client.get('/api/reports/turnaround/', {'date_from': day, 'date_to': day})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['percentiles'], [50, 75, 90])
+        [row] = response.data['results']
+        self.assertEqual(
+            (row['date'], row['doctor_id'], row['completed'], row['measured'], row['booked_duration']),
+            (day, self.doctor.id, 4, 3, 30.0),
+        )
+        self.assertEqual(row['wait'], {'mean': 18.3, 'p50': 15.0, 'p75': 27.5, 'p90': 35.0})
+        self.assertEqual(row['consult'], {'mean': 30.0, 'p50': 30.0, 'p75': 35.0, 'p90': 38.0})
+        self.assertEqual(row['overrun'], {'mean': 0.0, 'p50': 0.0, 'p75': 5.0, 'p90': 8.0})
+
+
+class TimeSeriesTests(ClinicTestData, APITestCase):
+    """
+    time_series() has a row for every period, empty or not, and with
+    ``compare`` the totals of the period a year earlier.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for day, amount in [
+            # Before date_from, in the first week
+            (date(2029, 12, 31), 999),
+            (date(2030, 1, 6), 100),
+            (date(2030, 1, 8), 50),
+            # 52 weeks before 2030-01-10, in the same month a year earlier
+            (date(2029, 1, 11), 30),
+        ]:
+            RevenueRollup.objects.create(
+                date=day, doctor=cls.doctor, method='Cash', status='Paid', count=1, amount=amount
+            )
+
+    def series(self, granularity, date_from, date_to, compare=False):
+        return [
+            (row['period'], row['revenue'], row['payments'], *([row['previous']['revenue']] if compare else []))
+            for row in time_series(
+                RevenueRollup.objects.all(), 'date', granularity, date_from, date_to, compare=compare,
+                revenue=Sum('amount'), payments=Sum('count'),
+            )
+        ]
+
+    def test_empty_periods_are_zero(self):
+        self.assertEqual(
+            self.series('week', date(2030, 1, 1), date(2030, 1, 20)),
+            [(date(2029, 12, 31), 100, 1), (date(2030, 1, 7), 50, 1), (date(2030, 1, 14), 0, 0)],
+        )
+        self.assertEqual(
+            self.series('day', date(2030, 1, 6), date(2030, 1, 8)),
+            [(date(2030, 1, 6), 100, 1), (date(2030, 1, 7), 0, 0), (date(2030, 1, 8), 50, 1)],
+        )
+
+    def test_compare_with_a_year_earlier(self):
+        self.assertEqual(
+            self.series('week', date(2030, 1, 1), date(2030, 1, 20), compare=True),
+            [(date(2029, 12, 31), 100, 1, 0), (date(2030, 1, 7), 50, 1, 30), (date(2030, 1, 14), 0, 0, 0)],
+        )
+        self.assertEqual(
+            self.series('quarter', date(2030, 1, 1), date(2030, 6, 30), compare=True),
+            [(date(2030, 1, 1), 150, 2, 30), (date(2030, 4, 1), 0, 0, 0)],
+        )
+        with self.assertRaises(ValueError):
+            self.series('year', date(2030, 1, 1), date(2030, 12, 31))
+
+
+class TopConditionsTests(ClinicTestData, APITestCase):
+    """
+    Diagnoses are counted regardless of case and surrounding spaces, leaving
+    out blank and deleted records.
+    """
+
+    DOCTORS = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        diagnoses = [
+            (cls.doctors[0], 'Flu'), (cls.doctors[0], ' flu '), (cls.doctors[1], 'FLU'),
+            (cls.doctors[1], 'Asthma'), (cls.doctors[1], 'asthma'), (cls.doctors[0], '  '),
+        ]
+        for hour, (doctor, diagnosis) in enumerate(diagnoses, 8):
+            MedicalRecord.objects.create(
+                patient=cls.patient,
+                doctor=doctor,
+                appointment=cls.create_appointment(cls.patient, doctor, date(2030, 1, 7), time(hour)),
+                diagnosis=diagnosis,
+                description='',
+            )
+        deleted = MedicalRecord.objects.create(
+            patient=cls.patient,
+            doctor=cls.doctors[0],
+            appointment=cls.create_appointment(cls.patient, cls.doctors[0], date(2030, 1, 7), time(15)),
+            diagnosis='Asthma',
+            description='',
+        )
+        deleted.delete()
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client.force_authenticate(self.manager)
+
+    def top_conditions(self, **params):
+        response = self.client.get('/api/reports/patients-analysis/', params)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [(row['name'].lower(), row['count']) for row in response.data['topConditions']]
+
+    def test_diagnoses_are_case_folded(self):
+        self.assertEqual(self.top_conditions(), [('flu', 3), ('asthma', 2)])
+        self.assertEqual(self.top_conditions(top=1), [('flu', 3)])
+        self.assertEqual(self.top_conditions(doctor=self.doctors[1].id), [('asthma', 2), ('flu', 1)])
+
+
+class DemographicsTests(ClinicTestData, APITestCase):
+    """
+    The demographics cube puts every patient in the age bucket of their age
+    on the day, and is rebuilt once a patient change commits.
+    """
+
+    PATIENTS = 0
+    TODAY = date(2030, 6, 15)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for name, birth_date, gender, city in [
+            # 10 today, 10 until tomorrow, 11 today, 70
+            ('Ten', date(2020, 6, 15), 'female', 'Lyon'),
+            ('Almost', date(2019, 6, 16), 'male', 'Lyon'),
+            ('Eleven', date(2019, 6, 15), 'female', 'Paris'),
+            ('Seventy', date(1960, 1, 1), 'female', 'Lyon'),
+        ]:
+            cls.create_patient(name, birth_date=birth_date, gender=gender, city=city)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_slices(self):
+        cube = demographics_cube(today=self.TODAY)
+        self.assertEqual(
+            [(row['name'], row['count']) for row in cube_slice(cube, 'age')],
+            [('0-10', 2), ('11-20', 1), ('21-30', 0), ('31-40', 0), ('41-50', 0), ('51-60', 0), ('61+', 1)],
+        )
+        self.assertEqual(cube_slice(cube, 'gender'), [{'name': 'female', 'count': 3}, {'name': 'male', 'count': 1}])
+        self.assertEqual(cube_slice(cube, 'city'), [{'name': 'Lyon', 'count': 3}, {'name': 'Paris', 'count': 1}])
+
+        # Patients younger than the first bound are left out
+        cube = demographics_cube([11, 65], today=self.TODAY)
+        self.assertEqual(
+            [(row['name'], row['count']) for row in cube_slice(cube, 'age')], [('11-64', 1), ('65+', 1)]
+        )
+
+    def test_cached_until_a_patient_changes(self):
+        demographics_cube(today=self.TODAY)
+        with self.assertNumQueries(0):
+            demographics_cube(today=self.TODAY)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_patient('Newborn', birth_date=date(2030, 6, 1), city='Paris')
+        cube = demographics_cube(today=self.TODAY)
+        self.assertEqual(cube_slice(cube, 'age')[0], {'name': '0-10', 'count': 3})
+
+    def test_age_buckets_parameter(self):
+        self.client.force_authenticate(self.manager)
+        response = self.client.get('/api/reports/demographics/', {'age_buckets': '0,11'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['total'], response.data['age_buckets']), (4, ['0-10', '11+']))
+        for buckets in ['10,5', '0,x', '-1,10']:
+            response = self.client.get('/api/reports/demographics/', {'age_buckets': buckets})
+            self.assertEqual(response.status_code, 400, buckets)
+
+
+class DoctorPerformanceTests(ClinicTestData, APITestCase):
+    """
+    The performance report sorts on any of its figures, and a page of it is
+    the same number of queries however many doctors it holds.
+    """
+
+    DOCTORS = 3
+    PATIENTS = 2
+    # The paginator's count and the page of doctors with their figures
+    QUERY_BUDGET = 2
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        day = date(2030, 1, 7)
+        # Completion rates of 50, 100 and 0 percent
+        rates = [['completed', 'scheduled'], ['completed'], ['canceled']]
+        for hour, (doctor, statuses) in enumerate(zip(cls.doctors, rates), 9):
+            for patient, appointment_status in zip(cls.patients, statuses):
+                cls.create_appointment(patient, doctor, day, time(hour), status=appointment_status)
+        rebuild_rollups()
+
+    def setUp(self):
+        self.client.force_authenticate(self.manager)
+
+    def test_sort_by_completion_rate(self):
+        response = self.client.get('/api/reports/doctor-performance/', {'ordering': '-completionRate'})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(
+            [(row['id'], row['appointments'], row['completionRate']) for row in response.data['results']],
+            [(self.doctors[1].id, 1, 100.0), (self.doctors[0].id, 2, 50.0), (self.doctors[2].id, 1, 0.0)],
+        )
+
+    def test_unknown_sort_field(self):
+        response = self.client.get('/api/reports/doctor-performance/', {'ordering': 'completionRate,-rating'})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(response.data['error'].startswith('Cannot sort on rating;'))
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        for page_size in [1, 3]:
+            with self.assertNumQueries(self.QUERY_BUDGET):
+                response = self.client.get(
+                    '/api/reports/doctor-performance/', {'ordering': '-revenue,name', 'page_size': page_size}
+                )
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(len(response.data['results']), page_size)
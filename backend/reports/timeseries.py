@@ -0,0 +1,107 @@
+"""
+Totals per day, week, month or quarter for the reports.
+
+time_series() groups a queryset by a date or datetime column truncated to
+the period, in one query, and fills in the periods without rows. With
+``compare`` the same query also covers the range a year earlier, and each
+period carries the totals of the period a year before it: the same day,
+month or quarter of the previous year, or the week 52 weeks earlier, so
+weeks still start on a Monday.
+
+Periods are named by their first day. The first and last period can be
+partial: only rows between ``date_from`` and ``date_to`` are counted.
+"""
+from datetime import date, datetime, time, timedelta
+
+from django.db.models import DateField, Q
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+GRANULARITIES = ['day', 'week', 'month', 'quarter']
+
+
+def period_start(day, granularity):
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+
+
+def next_period(start, granularity):
+    if granularity == 'day':
+        return start + timedelta(days=1)
+    if granularity == 'week':
+        return start + timedelta(weeks=1)
+    months = 1 if granularity == 'month' else 3
+    month = start.month - 1 + months
+    return date(start.year + month // 12, month % 12 + 1, 1)
+
+
+def periods(date_from, date_to, granularity):
+    """
+    First days of the periods from the one holding date_from to the one
+    holding date_to.
+    """
+    start = period_start(date_from, granularity)
+    result = []
+    while start <= date_to:
+        result.append(start)
+        start = next_period(start, granularity)
+    return result
+
+
+def year_before(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(weeks=52)
+    try:
+        return day.replace(year=day.year - 1)
+    except ValueError:
+        # 29 February
+        return day.replace(year=day.year - 1, day=28)
+
+
+def day_range(date_field, date_from=None, date_to=None):
+    """
+    Rows from the start of date_from to the end of date_to, either bound
+    optional. Local midnights bound a datetime column as well as a date
+    column.
+    """
+    bounds = {}
+    if date_from is not None:
+        bounds[f'{date_field}__gte'] = timezone.make_aware(datetime.combine(date_from, time()))
+    if date_to is not None:
+        bounds[f'{date_field}__lt'] = timezone.make_aware(datetime.combine(date_to + timedelta(days=1), time()))
+    return Q(**bounds)
+
+
+def time_series(queryset, date_field, granularity, date_from, date_to, compare=False, **aggregates):
+    """
+    One row per period between date_from and date_to: ``period`` and the
+    named aggregates, 0 for periods without rows. With ``compare``, also
+    ``previous``: the aggregates of the period a year earlier.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'Unknown granularity: {granularity}')
+    in_range = day_range(date_field, date_from, date_to)
+    if compare:
+        in_range |= day_range(date_field, year_before(date_from, granularity), year_before(date_to, granularity))
+    totals = {
+        row.pop('period'): {name: value or 0 for name, value in row.items()}
+        for row in queryset.filter(in_range)
+        .annotate(period=Trunc(date_field, granularity, output_field=DateField()))
+        .values('period')
+        .annotate(**aggregates)
+        .order_by()
+    }
+
+    empty = dict.fromkeys(aggregates, 0)
+    series = []
+    for start in periods(date_from, date_to, granularity):
+        row = {'period': start, **totals.get(start, empty)}
+        if compare:
+            row['previous'] = totals.get(year_before(start, granularity), empty)
+        series.append(row)
+    return series
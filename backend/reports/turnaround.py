@@ -0,0 +1,108 @@
+"""
+Wait-time and consult-length statistics from the appointment status log.
+
+The log records when a patient was checked in (moved to in_queue) and when
+the consult ended (completed), but not when it began. A doctor sees one
+patient at a time, so a consult is taken to start at check-in or when the
+doctor's previous consult that day ended, whichever is later:
+
+    start   = max(checked in, previous consult completed)
+    wait    = start - checked in
+    consult = completed - start
+
+Appointments completed without being checked in have no wait or consult
+length. All figures are minutes.
+"""
+import numpy as np
+import pandas as pd
+
+from appointments.models import AppointmentStatusEvent
+
+PERCENTILES = [0.5, 0.75, 0.9]
+EVENT_COLUMNS = ['appointment_id', 'doctor_id', 'appointment_date', 'to_status', 'occurred_at', 'duration']
+
+
+def load_events(date_from, date_to, doctor_id=None):
+    # The bound on the joined appointment prunes a partitioned table to the
+    # months asked for
+    events = AppointmentStatusEvent.objects.filter(
+        appointment_date__range=(date_from, date_to),
+        appointment__appointment_date__range=(date_from, date_to),
+        to_status__in=['in_queue', 'completed'],
+    )
+    if doctor_id is not None:
+        events = events.filter(doctor_id=doctor_id)
+    return pd.DataFrame.from_records(
+        events.values_list(
+            'appointment_id', 'doctor_id', 'appointment_date', 'to_status', 'occurred_at',
+            'appointment__duration',
+        ),
+        columns=EVENT_COLUMNS,
+    )
+
+
+def consult_intervals(events):
+    """
+    One row per completed appointment with its wait, consult length and
+    overrun of the booked duration.
+    """
+    keys = ['appointment_id', 'doctor_id', 'appointment_date', 'duration']
+    times = (
+        events.groupby(keys + ['to_status'])['occurred_at'].max()
+        .unstack('to_status')
+        .reindex(columns=['in_queue', 'completed'])
+        .dropna(subset=['completed'])
+        .reset_index()
+    )
+    for column in ['in_queue', 'completed']:
+        times[column] = pd.to_datetime(times[column], utc=True)
+    times = times.sort_values(['doctor_id', 'appointment_date', 'completed'])
+    previous = times.groupby(['doctor_id', 'appointment_date'])['completed'].shift()
+    start = times['in_queue'].where(~(previous > times['in_queue']), previous)
+    start = start.where(times['in_queue'].notna())
+
+    minute = np.timedelta64(1, 'm')
+    times['wait'] = (start - times['in_queue']) / minute
+    times['consult'] = (times['completed'] - start) / minute
+    times['overrun'] = times['consult'] - times['duration']
+    return times
+
+
+def turnaround_by_doctor_day(events):
+    """
+    Wait, consult and overrun distributions per doctor per day, as a list
+    of dicts ordered by day, then doctor.
+    """
+    if events.empty:
+        return []
+    grouped = consult_intervals(events).groupby(['appointment_date', 'doctor_id'])
+    metrics = ['wait', 'consult', 'overrun']
+    quantiles = grouped[metrics].quantile(PERCENTILES).unstack()
+    quantiles.columns = [f'{metric}_p{round(q * 100)}' for metric, q in quantiles.columns]
+    stats = (
+        grouped.agg(
+            completed=('completed', 'size'),
+            measured=('consult', 'count'),
+            booked_duration=('duration', 'mean'),
+        )
+        .join(grouped[metrics].mean().add_suffix('_mean'))
+        .join(quantiles)
+        .round(1)
+    )
+    stats = stats.astype(object).where(stats.notna(), None).reset_index()
+
+    statistics = ['mean'] + [f'p{round(q * 100)}' for q in PERCENTILES]
+    return [
+        {
+            'date': record['appointment_date'],
+            'doctor_id': record['doctor_id'],
+            'completed': record['completed'],
+            'measured': record['measured'],
+            'booked_duration': record['booked_duration'],
+            **{
+                metric: {statistic: record[f'{metric}_{statistic}'] for statistic in statistics}
+                for metric in metrics
+            },
+        }
+        for record in stats.to_dict('records')
+    ]
@@ -1,12 +1,15 @@
 from django.urls import path
-from .views import AppointmentMetricsView,PatientAnalysisView,DoctorPerformanceView, FinancialMetricsView 
+from .views import AppointmentMetricsView,PatientAnalysisView,DemographicsView,DoctorPerformanceView, FinancialMetricsView, ForecastView, TurnaroundView
 
 urlpatterns = [
 
     path('appointment-metrics/', AppointmentMetricsView.as_view(), name='appointment-metrics'),
     path('patients-analysis/', PatientAnalysisView.as_view(), name='patient-analysis'),
+    path('demographics/', DemographicsView.as_view(), name='demographics'),
     path('doctor-performance/', DoctorPerformanceView.as_view(), name='doctor-performance'),
     path('financial-metrics/', FinancialMetricsView.as_view(), name='financial-metrics'),
+    path('turnaround/', TurnaroundView.as_view(), name='turnaround'),
+    path('forecast/', ForecastView.as_view(), name='forecast'),
 
 
 ]
\ No newline at end of file
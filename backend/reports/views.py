@@ -4,35 +4,59 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from appointments.models import Appointment
 from django.utils.timezone import now
-from datetime import timedelta, datetime
-from django.db.models import Count, Sum
+from datetime import date, timedelta
+from django.db.models import Count, Min, Sum
+from django.db.models.functions import Lower, Trim
 from patients.models import Patient
 from doctors.models import Doctor, Specialization
 from rest_framework.pagination import PageNumberPagination
 from core.permissions import IsManager
 from billing.models import Payment
+from medical_records.models import MedicalRecord
+from django.utils.dateparse import parse_date
+from rest_framework import status
+from django.db.models import Q
+from .demographics import AGE_BOUNDS, DIMENSIONS, cube_slice, demographics_cube, parse_age_bounds
+from .forecasting import (
+    NO_SHOW_MODEL, OVERBOOK_RISK, VOLUME_MODEL, is_usable, load_model, no_show_risks, volume_forecast,
+)
+from .models import AppointmentRollup, RevenueRollup
+from .performance import doctor_performance, parse_ordering
+from .timeseries import GRANULARITIES, day_range, time_series
+from .turnaround import PERCENTILES, load_events, turnaround_by_doctor_day
 
 class AppointmentMetricsView(APIView):
     permission_classes = [IsAuthenticated,IsManager]
 
     def get(self, request):
+        # Read from the daily rollups; archived appointments are left out
+        rollups = AppointmentRollup.objects.filter(archived=False)
+
         # Appointment Status Data
-        statuses = Appointment.objects.values('status').annotate(count=models.Count('status'))
+        statuses = [
+            {'status': row['status'], 'count': row['total']}
+            for row in rollups.values('status').annotate(total=Sum('count')).filter(total__gt=0).order_by('status')
+        ]
 
         # Appointment Completion Data
-        total = Appointment.objects.count()
-        completed = Appointment.objects.filter(status='completed').count()
+        total = sum(row['count'] for row in statuses)
+        completed = sum(row['count'] for row in statuses if row['status'] == 'completed')
         remaining = total - completed
         completion_rate = round((remaining / total) * 100) if total > 0 else 0
         
 
-        # Daily Completion Data
+        # Daily Completion Data, one query bounded to the last 7 days
         today = now().date()
         last_7_days = [today - timedelta(days=i) for i in range(7)]
-        daily_completion = []
-        for day in last_7_days:
-            completed_count = Appointment.objects.filter(appointment_date=day, status='completed').count()
-            daily_completion.append({"date": day, "completed": completed_count})
+        completed_by_day = dict(
+            rollups.filter(
+                date__range=(last_7_days[-1], today), status='completed'
+            ).values_list('date').annotate(total=Sum('count'))
+        )
+        daily_completion = [
+            {"date": day, "completed": completed_by_day.get(day, 0)}
+            for day in last_7_days
+        ]
 
         return Response({
             "statuses": statuses,
@@ -46,51 +70,59 @@ class AppointmentMetricsView(APIView):
         })
 
 
+TOP_CONDITIONS = 10
+MAX_TOP_CONDITIONS = 100
+
+
 class PatientAnalysisView(APIView):
+    """
+    Age, gender and growth figures over all patients, and the ``top``
+    (default: TOP_CONDITIONS) most common diagnoses. The diagnoses can be
+    narrowed to records made from ``date_from`` to ``date_to``, by a
+    ``doctor`` or by doctors of a ``specialization``.
+    """
     permission_classes = [IsAuthenticated,IsManager]
 
     def get(self, request):
-        # Age Distribution
-        today = now().date()
-        age_buckets = [
-            {"label": "0-10", "min": 0, "max": 10},
-            {"label": "11-20", "min": 11, "max": 20},
-            {"label": "21-30", "min": 21, "max": 30},
-            {"label": "31-40", "min": 31, "max": 40},
-            {"label": "41-50", "min": 41, "max": 50},
-            {"label": "51-60", "min": 51, "max": 60},
-            {"label": "61+", "min": 61, "max": None},
-        ]
-        age_distribution = []
-        for bucket in age_buckets:
-            if bucket["max"] is not None:
-                count = Patient.objects.filter(
-                    birth_date__lte=today.replace(year=today.year - bucket["min"]),
-                    birth_date__gt=today.replace(year=today.year - bucket["max"]),
-                ).count()
-            else:
-                count = Patient.objects.filter(
-                    birth_date__lte=today.replace(year=today.year - bucket["min"])
-                ).count()
-            age_distribution.append({"name": bucket["label"], "count": count})
-
-        # Gender Ratio
-        gender_counts = Patient.objects.values("gender").annotate(count=Count("gender"))
+        params = request.query_params
+        try:
+            top = int(params.get('top') or TOP_CONDITIONS)
+            date_from = parse_date(params.get('date_from') or '')
+            date_to = parse_date(params.get('date_to') or '')
+            doctor_id = int(params['doctor']) if params.get('doctor') else None
+            specialization_id = int(params['specialization']) if params.get('specialization') else None
+        except ValueError:
+            return Response({'error': 'Invalid date, doctor, specialization or top.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= top <= MAX_TOP_CONDITIONS:
+            return Response(
+                {'error': f'top must be between 1 and {MAX_TOP_CONDITIONS}.'}, status=status.HTTP_400_BAD_REQUEST,
+            )
+        if date_from and date_to and date_from > date_to:
+            return Response({'error': 'date_from must not be after date_to.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Age Distribution and Gender Ratio, from the cached demographics cube
+        cube = demographics_cube()
+        age_distribution = cube_slice(cube, 'age')
         gender_ratio = [
-            {"name": gender["gender"].capitalize(), "value": gender["count"]}
-            for gender in gender_counts
+            {"name": gender["name"].capitalize(), "value": gender["count"]}
+            for gender in cube_slice(cube, 'gender')
         ]
 
-        # Top Conditions
-        condition_counts = {}
-        for patient in Patient.objects.prefetch_related("medical_records"):
-            for condition in patient.medical_records.all():
-                condition_counts[condition.diagnosis] = condition_counts.get(condition.diagnosis, 0) + 1
-
-        top_conditions = [
-            {"name": name, "count": count}
-            for name, count in sorted(condition_counts.items(), key=lambda x: x[1], reverse=True)
-        ]
+        # Top Conditions, counted in the database by diagnosis regardless
+        # of case and surrounding spaces
+        records = MedicalRecord.objects.filter(day_range('created_at', date_from, date_to), is_active=True)
+        if doctor_id is not None:
+            records = records.filter(doctor_id=doctor_id)
+        if specialization_id is not None:
+            records = records.filter(doctor__specialization_id=specialization_id)
+        top_conditions = list(
+            records.annotate(condition=Lower(Trim('diagnosis')))
+            .exclude(condition='')
+            .values('condition')
+            .annotate(name=Min(Trim('diagnosis')), count=Count('id'))
+            .order_by('-count', 'condition')
+            .values('name', 'count')[:top]
+        )
 
         # Patient Growth
         today = now().date()
@@ -116,6 +148,29 @@ class PatientAnalysisView(APIView):
         })
 
 
+class DemographicsView(APIView):
+    """
+    Patient counts by age bucket, gender, blood type and city, as cells of
+    the full cube and as a slice per dimension. ``age_buckets`` takes the
+    lower bounds of the age buckets (default: 0,11,21,31,41,51,61).
+    """
+    permission_classes = [IsAuthenticated, IsManager]
+
+    def get(self, request):
+        try:
+            bounds = parse_age_bounds(request.query_params.get('age_buckets') or ','.join(map(str, AGE_BOUNDS)))
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        cube = demographics_cube(bounds)
+        return Response({
+            'total': sum(cell['count'] for cell in cube['cells']),
+            'age_buckets': cube['buckets'],
+            'slices': {dimension: cube_slice(cube, dimension) for dimension in DIMENSIONS},
+            'cells': cube['cells'],
+        })
+
+
 class DoctorPerformancePagination(PageNumberPagination):
     page_size = 10  # Default number of items per page
     page_size_query_param = 'page_size'  # Allow client to override page size
@@ -123,119 +178,283 @@ class DoctorPerformancePagination(PageNumberPagination):
 
 
 class DoctorPerformanceView(APIView):
+    """
+    Appointment counts, completion and cancellation rates, revenue and
+    average daily load per doctor, for appointments and payments from
+    ``date_from`` to ``date_to`` (default: all). ``ordering`` sorts on any
+    of the figures, e.g. ``-completionRate,name`` (default: id).
+    """
     permission_classes = [IsAuthenticated,IsManager]
     def get(self, request):
-        # Aggregate doctor performance data
-        doctors = Doctor.objects.all().order_by('id')
+        try:
+            date_from = parse_date(request.query_params.get('date_from') or '')
+            date_to = parse_date(request.query_params.get('date_to') or '')
+        except ValueError:
+            return Response({'error': 'Invalid date.'}, status=status.HTTP_400_BAD_REQUEST)
+        if date_from and date_to and date_from > date_to:
+            return Response({'error': 'date_from must not be after date_to.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ordering = parse_ordering(request.query_params.get('ordering') or '')
+        except ValueError as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # The page and all its figures are one query
+        doctors = doctor_performance(date_from, date_to).order_by(*ordering)
         paginator = DoctorPerformancePagination()
         paginated_doctors = paginator.paginate_queryset(doctors, request)
 
-        performance_data = []
-        for doctor in paginated_doctors:
-            total_appointments = doctor.appointments.count()
-            completed_appointments = doctor.appointments.filter(status="completed").count()
-            completion_rate = (
-                (completed_appointments / total_appointments) * 100
-                if total_appointments > 0
-                else 0
-            )
-
-            performance_data.append({
+        performance_data = [
+            {
                 "id": doctor.id,
                 "name": f"{doctor.user.first_name} {doctor.user.last_name}",
                 "specialization": doctor.specialization.name if doctor.specialization else "N/A",
-                "appointments": total_appointments,
-                "completionRate": round(completion_rate, 2),
-            })
+                "appointments": doctor.total_appointments,
+                "completed": doctor.completed_appointments,
+                "canceled": doctor.canceled_appointments,
+                "completionRate": round(doctor.completion_rate, 2),
+                "cancellationRate": round(doctor.cancellation_rate, 2),
+                "revenue": doctor.revenue,
+                "avgDailyLoad": round(doctor.avg_daily_load, 2),
+            }
+            for doctor in paginated_doctors
+        ]
 
         return paginator.get_paginated_response(performance_data)
 
 
 class FinancialMetricsView(APIView):
+    """
+    Revenue totals and distributions, and revenue per period from
+    ``date_from`` to ``date_to`` (default: this year) per ``granularity``
+    (day, week, month or quarter; default: month) next to a year earlier.
+    """
     permission_classes = [IsAuthenticated, IsManager]
 
     def get(self, request):
-        # Total Revenue
-        total_revenue = Payment.objects.filter(status='Paid').aggregate(total=Sum('amount'))['total'] or 0
-        
-        # Pending Payments
-        pending_payments = Payment.objects.filter(status='Pending').aggregate(total=Sum('amount'))['total'] or 0
-        pending_payments_count = Payment.objects.filter(status='Pending').count()
-        
-        # Monthly Revenue (this year vs last year)
-        today = now()
-        current_year = today.year
-        last_year = current_year - 1
-        
-        monthly_revenue = []
-        for month in range(1, 13):
-            # This year's revenue for the month
-            this_year_start = datetime(current_year, month, 1)
-            this_year_end = (this_year_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-            this_year_revenue = Payment.objects.filter(
-                status='Paid',
-                payment_date__year=current_year,
-                payment_date__month=month
-            ).aggregate(total=Sum('amount'))['total'] or 0
-            
-            # Last year's revenue for the month
-            last_year_start = datetime(last_year, month, 1)
-            last_year_end = (last_year_start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
-            last_year_revenue = Payment.objects.filter(
-                status='Paid',
-                payment_date__year=last_year,
-                payment_date__month=month
-            ).aggregate(total=Sum('amount'))['total'] or 0
-            
-            monthly_revenue.append({
-                'month': this_year_start.strftime('%b'),
-                'thisYear': this_year_revenue,
-                'lastYear': last_year_revenue
-            })
+        today = now().date()
+        year_start, year_end = date(today.year, 1, 1), date(today.year, 12, 31)
+        granularity = request.query_params.get('granularity') or 'month'
+        try:
+            date_from = parse_date(request.query_params.get('date_from') or '') or year_start
+            date_to = parse_date(request.query_params.get('date_to') or '') or year_end
+        except ValueError:
+            return Response({'error': 'Invalid date.'}, status=status.HTTP_400_BAD_REQUEST)
+        if granularity not in GRANULARITIES:
+            return Response(
+                {'error': f"granularity must be one of {', '.join(GRANULARITIES)}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if date_from > date_to:
+            return Response({'error': 'date_from must not be after date_to.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Read from the daily revenue rollups
+        rollups = RevenueRollup.objects.all()
+        paid = rollups.filter(status='Paid')
+
+        # Total Revenue and Pending Payments
+        totals = rollups.aggregate(
+            total_revenue=Sum('amount', filter=Q(status='Paid')),
+            total_payments=Sum('count', filter=Q(status='Paid')),
+            pending_amount=Sum('amount', filter=Q(status='Pending')),
+            pending_count=Sum('count', filter=Q(status='Pending')),
+        )
+        total_revenue = totals['total_revenue'] or 0
+        total_payments = totals['total_payments'] or 0
+
+        # Revenue per period, this year vs last year
+        revenue = time_series(
+            paid, 'date', granularity, date_from, date_to, compare=True,
+            revenue=Sum('amount'), payments=Sum('count'),
+        )
+        monthly = revenue
+        if (granularity, date_from, date_to) != ('month', year_start, year_end):
+            monthly = time_series(paid, 'date', 'month', year_start, year_end, compare=True, revenue=Sum('amount'))
+        monthly_revenue = [
+            {
+                'month': row['period'].strftime('%b'),
+                'thisYear': row['revenue'],
+                'lastYear': row['previous']['revenue'],
+            }
+            for row in monthly
+        ]
         
         # Payment Method Distribution (as percentages)
-        total_payments = Payment.objects.filter(status='Paid').count()
         payment_methods = []
-        
         if total_payments > 0:
-            method_counts = Payment.objects.filter(status='Paid').values('method').annotate(
-                count=Count('method')
-            ).order_by('-count')
-            
+            method_counts = paid.values('method').annotate(total=Sum('count')).filter(total__gt=0).order_by('-total')
             for method in method_counts:
-                percentage = round((method['count'] / total_payments) * 100)
                 payment_methods.append({
                     'name': method['method'],
-                    'value': percentage
+                    'value': round((method['total'] / total_payments) * 100)
                 })
         
         # Payment Distribution by Specialization
         specialization_payments = []
         if total_payments > 0:
-            # Get all specializations with their payment counts
-            spec_counts = Payment.objects.filter(
-                status='Paid',
-                appointment__doctor__specialization__isnull=False
+            spec_counts = paid.filter(
+                doctor__specialization__isnull=False
             ).values(
-                'appointment__doctor__specialization__name'
+                'doctor__specialization__name'
             ).annotate(
-                count=Count('id')
-            ).order_by('-count')
+                total=Sum('count')
+            ).filter(total__gt=0).order_by('-total')
             
             for spec in spec_counts:
-                percentage = round((spec['count'] / total_payments) * 100)
                 specialization_payments.append({
-                    'name': spec['appointment__doctor__specialization__name'],
-                    'value': percentage
+                    'name': spec['doctor__specialization__name'],
+                    'value': round((spec['total'] / total_payments) * 100)
                 })
         
         return Response({
             'total_revenue': total_revenue,
             'pending_payments': {
-                'amount': pending_payments,
-                'count': pending_payments_count
+                'amount': totals['pending_amount'] or 0,
+                'count': totals['pending_count'] or 0
             },
             'monthly_revenue': monthly_revenue,
+            'revenue': {
+                'granularity': granularity,
+                'date_from': date_from,
+                'date_to': date_to,
+                'results': revenue,
+            },
             'payment_methods': payment_methods,
             'specialization_payments': specialization_payments
         })
+
+
+class TurnaroundView(APIView):
+    """
+    Wait-time and consult-length distributions per doctor per day, from the
+    appointment status log. Takes ``date_from`` and ``date_to`` (default:
+    the last 30 days) and an optional ``doctor`` id.
+    """
+    permission_classes = [IsAuthenticated, IsManager]
+
+    def get(self, request):
+        today = now().date()
+        try:
+            date_from = parse_date(request.query_params.get('date_from') or '') or today - timedelta(days=30)
+            date_to = parse_date(request.query_params.get('date_to') or '') or today
+            doctor_id = request.query_params.get('doctor')
+            doctor_id = int(doctor_id) if doctor_id else None
+        except ValueError:
+            return Response({'error': 'Invalid date or doctor ID.'}, status=status.HTTP_400_BAD_REQUEST)
+        if date_from > date_to:
+            return Response({'error': 'date_from must not be after date_to.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = turnaround_by_doctor_day(load_events(date_from, date_to, doctor_id))
+        names = {
+            doctor.id: f"{doctor.user.first_name} {doctor.user.last_name}"
+            for doctor in Doctor.objects.filter(id__in={row['doctor_id'] for row in rows}).select_related('user')
+        }
+        for row in rows:
+            row['doctor_name'] = names.get(row['doctor_id'])
+
+        return Response({
+            'date_from': date_from,
+            'date_to': date_to,
+            'percentiles': [round(q * 100) for q in PERCENTILES],
+            'results': rows,
+        })
+
+
+class ForecastView(APIView):
+    """
+    Expected appointment volume of a week (``week``: any day of it, default:
+    next week) per doctor and specialization, next to what is booked and
+    the no-show risk of those bookings. Scheduled appointments at or above
+    ``risk`` (default: OVERBOOK_RISK) are listed as overbooking candidates.
+    The models are fitted by the train_forecasts command.
+    """
+    permission_classes = [IsAuthenticated, IsManager]
+
+    def get(self, request):
+        today = now().date()
+        try:
+            day = parse_date(request.query_params.get('week') or '') or today + timedelta(days=7)
+            threshold = float(request.query_params.get('risk') or OVERBOOK_RISK)
+        except ValueError:
+            return Response({'error': 'Invalid week or risk.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= threshold <= 1:
+            return Response({'error': 'risk must be between 0 and 1.'}, status=status.HTTP_400_BAD_REQUEST)
+        week_start = day - timedelta(days=day.weekday())
+        week_end = week_start + timedelta(days=6)
+
+        no_show_model, volume_model = load_model(NO_SHOW_MODEL), load_model(VOLUME_MODEL)
+        scored = is_usable(no_show_model)
+
+        booked = list(
+            Appointment.objects.live()
+            .blocking()
+            .filter(appointment_date__range=(week_start, week_end))
+            .only(
+                'appointment_id', 'patient_id', 'doctor_id', 'appointment_date', 'appointment_time',
+                'starts_at', 'created_at', 'status',
+            )
+            .order_by('starts_at')
+        )
+        bookings = {}
+        for appointment, risk in zip(booked, no_show_risks(booked, no_show_model)):
+            row = bookings.setdefault(appointment.doctor_id, {'booked': 0, 'expected_no_shows': 0.0, 'candidates': []})
+            row['booked'] += 1
+            if risk is not None:
+                row['expected_no_shows'] += risk
+                if risk >= threshold:
+                    row['candidates'].append({
+                        'appointment_id': appointment.appointment_id,
+                        'starts_at': appointment.starts_at,
+                        'risk': risk,
+                    })
+
+        doctors = (
+            Doctor.objects.filter(Q(user__is_active=True) | Q(id__in=bookings))
+            .select_related('user', 'specialization')
+            .order_by('id')
+        )
+        doctor_rows, specializations = [], {}
+        for doctor in doctors:
+            booking = bookings.get(doctor.id, {'booked': 0, 'expected_no_shows': 0.0, 'candidates': []})
+            by_day = volume_forecast(volume_model, doctor.id)
+            row = {
+                'doctor_id': doctor.id,
+                'doctor_name': f"{doctor.user.first_name} {doctor.user.last_name}",
+                'specialization_id': doctor.specialization_id,
+                'specialization': doctor.specialization.name if doctor.specialization else None,
+                'booked': booking['booked'],
+                'forecast': round(sum(by_day), 1) if by_day is not None else None,
+                'forecast_by_day': [round(value, 1) for value in by_day] if by_day is not None else None,
+                'expected_no_shows': round(booking['expected_no_shows'], 1) if scored else None,
+                'overbooking_candidates': booking['candidates'],
+            }
+            doctor_rows.append(row)
+
+            total = specializations.setdefault(doctor.specialization_id, {
+                'specialization_id': doctor.specialization_id,
+                'specialization': row['specialization'],
+                'booked': 0,
+                'forecast': 0.0 if by_day is not None else None,
+                'expected_no_shows': 0.0 if scored else None,
+            })
+            total['booked'] += row['booked']
+            if by_day is not None:
+                total['forecast'] = round(total['forecast'] + row['forecast'], 1)
+            if scored:
+                total['expected_no_shows'] = round(total['expected_no_shows'] + booking['expected_no_shows'], 1)
+
+        def trained(model):
+            if model is None:
+                return None
+            return {'trained_through': model['trained_through'], 'trained_at': model['trained_at']}
+
+        return Response({
+            'week_start': week_start,
+            'week_end': week_end,
+            'risk_threshold': threshold,
+            'models': {
+                'no_show': trained(no_show_model) if scored else None,
+                'volume': trained(volume_model),
+            },
+            'doctors': doctor_rows,
+            'specializations': list(specializations.values()),
+        })
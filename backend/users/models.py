@@ -54,6 +54,13 @@ class User(AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return self.email
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Renaming a doctor rewrites their appointments' search text
+        instance._loaded_name = (instance.__dict__.get("first_name"), instance.__dict__.get("last_name"))
+        return instance
+
     def get_allowed_statuses(self):
         """
         Returns the list of allowed statuses based on user role